@@ -1,6 +1,11 @@
 """This software is for stitching images created by Dark Spot Mapper
 
 Dark Spot Mapper is a measurement device at the Optoelectronics Research Centre of Tampere University of Technology
+
+Without arguments a wafer folder is asked with a dialog. Given glob patterns of wafer folders, all of them are
+re-stitched in parallel without a GUI, for example:
+    python cross_stitcher.py "archive/*/WAFER*" --jobs 8
+Stitches that are newer than their pictures are skipped unless --force is given.
 """
 
 __author__ = "Mika Mäki"
@@ -9,34 +14,159 @@ __credits__ = ["Mika Mäki"]
 __maintainer__ = "Mika Mäki"
 __email__ = "mika.maki@tuni.fi"
 
+import argparse
+import concurrent.futures
+import glob
+import os.path
+import time
 import tkinter.filedialog
-import os
+import typing as tp
 
+import pyramid
+import stitch_scheduler
+import stitching
 
-def main():
+WAFER_STITCH_NAME = "WAFER_stitch.png"
+
+
+def needs_update(output: str, inputs: tp.Iterable[str]) -> bool:
+    """Whether an output file is missing or older than any of its inputs
+
+    :param output: path of the output file
+    :param inputs: paths of the input files
+    :return: True if the output should be regenerated
+    """
+    if not os.path.isfile(output):
+        return True
+    output_time = os.path.getmtime(output)
+    return any(os.path.getmtime(path) > output_time for path in inputs)
+
+
+def site_stitch_path(site_path: str) -> str:
+    """Path of the stitch of a wafer site
+
+    An existing stitch is overwritten, so that re-stitching does not add stitches to the folder. If there are several,
+    the newest one is used. Otherwise the stitch is named after the site folder.
+    :param site_path: folder of the site
+    :return: path of the stitch
+    """
+    try:
+        # The same choice as in stitching.wafer_tiles()
+        return stitching.find_newest(os.path.join(site_path, "*stitch.png"))
+    except stitching.StitchError:
+        return os.path.join(site_path, f"{os.path.basename(site_path)}_stitch.png")
+
+
+def restitch_wafer(
+        wafer_path: str,
+        force: bool = False,
+        register: bool = True,
+        write_pyramid: bool = True) -> tp.Tuple[int, float]:
+    """Re-stitch the sites and the composite of a wafer measurement
+
+    The site stitches are regenerated first, so the composite is then updated if any of them changed.
+    :param wafer_path: folder of the wafer measurement
+    :param force: regenerate the stitches even if they are up to date
+    :param register: whether to refine the positions of the site pictures by registration
+    :param write_pyramid: whether to write a Deep Zoom pyramid of the composite
+    :return: number of stitches written and the time taken in seconds
+    """
+    start_time = time.perf_counter()
+    written = 0
+    # The composite is made of the same site stitches that are written here, even if a site has older ones
+    site_tiles = []
+    for site, offset in stitching.WAFER_LAYOUT.items():
+        site_path = os.path.join(wafer_path, site)
+        pictures = [path for path, _ in stitching.nine_tiles(site_path)]
+        path = site_stitch_path(site_path)
+        if force or needs_update(path, pictures):
+            stitch_scheduler.stitch_9_job(site_path, path, register)
+            written += 1
+        site_tiles.append((path, offset))
+
+    path = os.path.join(wafer_path, WAFER_STITCH_NAME)
+    if force or needs_update(path, [site_stitch for site_stitch, _ in site_tiles]):
+        wafer_img = stitching.stitch_to_file(site_tiles, stitching.WAFER_CANVAS, path)
+        written += 1
+        if write_pyramid:
+            pyramid.write_pyramid(wafer_img, os.path.splitext(path)[0] + ".dzi")
+    return written, time.perf_counter() - start_time
+
+
+def restitch_all(wafer_paths: tp.Sequence[str], jobs: tp.Optional[int] = None, **kwargs) -> int:
+    """Re-stitch wafer measurements in parallel and print the timing of each
+
+    :param wafer_paths: folders of the wafer measurements
+    :param jobs: number of worker processes, by default the number of cores
+    :param kwargs: arguments for restitch_wafer()
+    :return: number of failed wafers
+    """
+    start_time = time.perf_counter()
+    failures = 0
+    with stitch_scheduler.StitchScheduler(max_workers=jobs) as scheduler:
+        futures = {scheduler.submit(restitch_wafer, wafer_path, **kwargs): wafer_path for wafer_path in wafer_paths}
+        for future in concurrent.futures.as_completed(futures):
+            wafer_path = futures[future]
+            try:
+                written, duration = future.result()
+            # Any error fails only its own wafer, so the rest of the batch is still stitched and summarized
+            except Exception as e:  # pylint: disable=broad-except
+                failures += 1
+                print(f"{wafer_path}: failed: {type(e).__name__}: {e}")
+                continue
+            if written:
+                print(f"{wafer_path}: {written} stitches in {duration:.1f} s")
+            else:
+                print(f"{wafer_path}: up to date")
+    print(
+        f"Stitched {len(wafer_paths) - failures} of {len(wafer_paths)} wafers "
+        f"in {time.perf_counter() - start_time:.1f} s"
+    )
+    return failures
+
+
+def stitch_dialog():
     wafer_path = tkinter.filedialog.askdirectory()
 
     if wafer_path != "":
         print("Stitching wafer")
-        cmdstr = "magick convert background_wafer.png "
-        cmdstr += wafer_path + "/00x20/*stitch.png -gravity Northwest -geometry +5800+0 -composite "
-        cmdstr += wafer_path + "/00x10/*stitch.png -geometry +5800+2580 -composite "
-        cmdstr += wafer_path + "/-10x10/*stitch.png -geometry +2900+2580 -composite "
-        cmdstr += wafer_path + "/10x10/*stitch.png -geometry +8700+2580 -composite "
-        cmdstr += wafer_path + "/00x00/*stitch.png -geometry +5800+5160 -composite "
-        cmdstr += wafer_path + "/-20x00/*stitch.png -geometry +0+5160 -composite "
-        cmdstr += wafer_path + "/-10x00/*stitch.png -geometry +2900+5160 -composite "
-        cmdstr += wafer_path + "/10x00/*stitch.png -geometry +8700+5160 -composite "
-        cmdstr += wafer_path + "/20x00/*stitch.png -geometry +11600+5160 -composite "
-        cmdstr += wafer_path + "/00x-10/*stitch.png -geometry +5800+7740 -composite "
-        cmdstr += wafer_path + "/-10x-10/*stitch.png -geometry +2900+7740 -composite "
-        cmdstr += wafer_path + "/10x-10/*stitch.png -geometry +8700+7740 -composite "
-        cmdstr += wafer_path + "/00x-20/*stitch.png -geometry +5800+10320 -composite "
-        cmdstr += wafer_path + "/WAFER_stitch.png"
-        # TODO: Replace this with a subprocess call
-        os.system(cmdstr)
+        try:
+            wafer_img = stitching.stitch_wafer(wafer_path, os.path.join(wafer_path, WAFER_STITCH_NAME))
+            pyramid.write_pyramid(wafer_img, os.path.join(wafer_path, "WAFER_stitch.dzi"))
+        except OSError as e:
+            print(f"Stitching failed: {e}")
+            return
         print("Stitch ready")
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Stitch wafer measurements of Dark Spot Mapper")
+    parser.add_argument("wafers", nargs="*", help="glob patterns of wafer folders, a dialog is shown if not given")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes, by default the number of cores")
+    parser.add_argument("-f", "--force", action="store_true", help="re-stitch also the up-to-date stitches")
+    parser.add_argument("--no-register", action="store_true", help="place the site pictures on the nominal grid")
+    parser.add_argument("--no-pyramid", action="store_true", help="do not write Deep Zoom pyramids")
+    args = parser.parse_args()
+
+    if not args.wafers:
+        stitch_dialog()
+        return
+
+    wafer_paths = sorted({
+        path for pattern in args.wafers for path in glob.glob(pattern) if os.path.isdir(path)
+    })
+    if not wafer_paths:
+        parser.error("No wafer folders found")
+    failures = restitch_all(
+        wafer_paths,
+        jobs=args.jobs,
+        force=args.force,
+        register=not args.no_register,
+        write_pyramid=not args.no_pyramid
+    )
+    if failures:
+        raise SystemExit(1)
+
+
 if __name__ == "__main__":
     main()
@@ -9,16 +9,11 @@ Requires
 - NI IMAQdx
 - Pynivision
 - Granite Devices SimpleMotion DLL (bitness must match that of Python)
-- ImageMagick
 
 TODO LIST
 - code reorganising & rework
 - add focusing spots to the chip view
-- save camera parameters
 - averaging to remove ripple
-- stitching on the numpy level (matrix concatenation?)
-- support for multiple cameras
-- fix the long camera startup time
 - click-to-move
 - connection to vxl_intra (log uploads?)
 - autofocus
@@ -31,27 +26,36 @@ __credits__ = ["Mika Mäki"]
 __maintainer__ = "Mika Mäki"
 __email__ = "mika.maki@tuni.fi"
 
-# PyQt[Graph] has to be loaded before OpenCV to ensure that the correct Qt libraries are loaded
-import pyqtgraph as pg
-
 # Program modules
 import dsm_exceptions
+import frame_metrics
+import image_writer
+import live_view
+import mosaic
+import settle
 import stagecontrol
+import stitch_scheduler
+import stitching
+from devices import camera_group
 from devices import camera_opencv
+from devices import camera_service
+from devices import simplemotion as sm
 
 # GUI
 import tkinter
 import tkinter.filedialog
 
 # Basic libraries
+import concurrent.futures
 import logging
 import math
+import subprocess
 import threading
 import time
 import os.path
+import typing as tp
 
 # Graphing
-from pyqtgraph.Qt import QtCore, QtGui
 # import matplotlib.image
 import numpy as np
 
@@ -72,53 +76,34 @@ logging.basicConfig(
 
 WINDOW_TITLE = "ORC Dark Spot Mapper"
 
+# The camera settings in the GUI
+CAM_PROPS = [
+    camera_opencv.Props.AUTO_EXPOSURE,
+    camera_opencv.Props.BRIGHTNESS,
+    camera_opencv.Props.GAIN,
+    camera_opencv.Props.GAMMA,
+    camera_opencv.Props.SHARPNESS,
+    camera_opencv.Props.EXPOSURE
+]
 
-class QtDisp:
-    """This class provides a window for the camera video"""
-    def __init__(self, camera: camera_opencv.CameraCV, auto_levels: bool):
-        self.__camera = camera
-
-        self.__auto_levels = auto_levels
-
-        app = pg.mkQApp()
-
-        win = QtGui.QMainWindow()
-        win.resize(1200, 700)
-        self.__imv = pg.ImageView()
-        win.setCentralWidget(self.__imv)
-        win.setWindowTitle(WINDOW_TITLE)
-        win.show()
-
-        # This line prevents a bug at image leveling
-        self.__imv.setLevels(0.1, 0.9)
-
-        self.take_frame()
-
-        timer = QtCore.QTimer()
-        timer.timeout.connect(self.take_frame)
-        timer.start(50)
+# With settle detection the fixed wait times of the measurements are used to derive the limits of the waiting
+# Minimum waiting time after the image has been seen moving. If it has not moved, for example because the stage has
+# not started yet or the area is featureless, the full fixed time is waited.
+SETTLE_MIN_FRACTION = 0.2
+# The waiting is continued beyond the fixed time if the image is still moving
+SETTLE_TIMEOUT_FACTOR = 2
 
-        app.exec_()
+# Maximum time to wait for the camera to open when it is needed, in seconds
+CAMERA_OPEN_TIMEOUT = 60
 
-    def take_frame(self) -> None:
-        """Fetches a frame from the camera and displays it
+# Interval of updating the focus and exposure metrics in the main window, in milliseconds
+METRICS_INTERVAL = 200
 
-        :return: -
-        """
-        # self.__camera.save_frame("R:\\nivisiontemp.png")
-
-        # The camera.take_frame() saves the frame on a RAM disk since transporting the image directly from
-        # NI Vision to Python would result in a memory leak
-        # mat_img = matplotlib.image.imread("R:\\nivisiontemp.png")
-        # transposed = np.transpose(mat_img)
-
-        img = self.__camera.get_frame()
-        transposed = np.transpose(img) / 255
-
-        if self.__auto_levels:
-            self.__imv.setImage(transposed, autoLevels=True)
-        else:
-            self.__imv.setImage(transposed, levels=(0, 1))
+# The measurements capture a picture from every camera at each position
+# The primary camera is the one in the live view, and its pictures are stitched
+PRIMARY_CAMERA = "main"
+# Additional cameras, for example for another magnification or a filter channel: name -> OpenCV address
+EXTRA_CAMERAS: tp.Dict[str, int] = {}
 
 
 class DSM:
@@ -134,7 +119,14 @@ class DSM:
         self.__time_str = time.strftime("%Y-%m-%d")
         self.__measuring = False
         self.__aborting = False
-        self.__stitch_lock = threading.Lock()
+        # The stitches are run in parallel in worker processes
+        self.__stitcher = stitch_scheduler.StitchScheduler()
+        # The pictures are encoded and written while the stage moves to the next position
+        self.__writer = image_writer.ImageWriter()
+        # Refine the tile positions of the stitches by registering the overlapping pictures
+        self.__register_tiles = True
+        # mean, sigma_clip or median
+        self.__average_method = "mean"
 
         self.__corner1 = (0, 0)
         self.__corner2 = (0, 0)
@@ -149,20 +141,14 @@ class DSM:
         self.stages = stagecontrol.StageControl()
 
         # Camera setup
-        self.camera = camera_opencv.CameraCV()
-        try:
-            self.camera.set_prop(camera_opencv.Props.ISO_SPEED, 800)
-        except ValueError as e:
-            logger.warning(f"Could not set ISO speed for the camera: {e}")
-        try:
-            self.camera.set_resolution(width=1280, height=960)
-        except ValueError as e:
-            logger.warning(f"Could not set camera resolution: {e}")
-
-        # Qt thread & window
-
-        self.qt_thread = threading.Thread(target=QtDisp, args=(self.camera, False))
-        self.qt_thread.start()
+        # Opening the camera takes several seconds, so it is done in the background once the GUI is up
+        self.__camera: tp.Optional[tp.Union[camera_opencv.CameraCV, camera_service.CameraClient]] = None
+        self.__cameraReady = threading.Event()
+        self.__cameraError: tp.Optional[Exception] = None
+        self.__cameras: tp.Optional[camera_group.CameraGroup] = None
+        # The live view runs in a process of its own and gets the frames through shared memory
+        self.__publisher: tp.Optional[live_view.FramePublisher] = None
+        self.__viewer: tp.Optional[subprocess.Popen] = None
 
         # UI creation
 
@@ -179,6 +165,11 @@ class DSM:
         info_label = tkinter.Label(self.__mainWindow, textvar=self.__infoVar)
         info_label.grid(row=8, columnspan=11)
 
+        # Focus and exposure of the live view, for focusing with the z buttons and for setting the exposure
+        self.__metricsVar = tkinter.StringVar()
+        metrics_label = tkinter.Label(self.__mainWindow, textvar=self.__metricsVar)
+        metrics_label.grid(row=3, column=0, columnspan=5)
+
         # Navigation elements
 
         self.__upButton = tkinter.Button(self.__mainWindow, text="▲", command=self.up)
@@ -233,6 +224,10 @@ class DSM:
         )
         self.__resetCoords_Button.grid(row=4, column=5)
 
+        # The moves use absolute targets once the stage has been homed
+        self.__homeButton = tkinter.Button(self.__mainWindow, text="Home stage", command=self.home_stage)
+        self.__homeButton.grid(row=4, column=4)
+
         self.__abortButton = tkinter.Button(self.__mainWindow, text="Abort", command=self.abort)
         self.__abortButton.grid(row=5, column=5)
 
@@ -270,6 +265,10 @@ class DSM:
         self.__areaButton = tkinter.Button(self.__mainWindow, text="Measure area", command=self.measure_area_threaded)
         self.__areaButton.grid(row=7, column=6)
 
+        # The video is recorded in the background, also during the measurements
+        self.__videoButton = tkinter.Button(self.__mainWindow, text="Record video", command=self.toggle_video)
+        self.__videoButton.grid(row=9, column=6)
+
         cam_column = 7
 
         # Elements for Qt
@@ -294,6 +293,38 @@ class DSM:
         self.__debugButton = tkinter.Button(self.__mainWindow, text="Debug", command=self.debug)
         self.__debugButton.grid(row=4, column=cam_column)
 
+        # Averaging of the measurement pictures to remove ripple
+        average_label = tkinter.Label(self.__mainWindow, text="Frames averaged")
+        average_label.grid(row=5, column=cam_column)
+
+        self.__averageVar = tkinter.StringVar()
+        self.__averageVar.set("1")
+        self.__averageEntry = tkinter.Entry(self.__mainWindow, textvariable=self.__averageVar)
+        self.__averageEntry.grid(row=6, column=cam_column)
+
+        # Storage format of the area measurement pictures, the faster formats can be recompressed later
+        area_format_label = tkinter.Label(self.__mainWindow, text="Area format")
+        area_format_label.grid(row=7, column=cam_column)
+
+        self.__areaFormatVar = tkinter.StringVar()
+        self.__areaFormatVar.set(image_writer.DEFAULT_FORMAT)
+        self.__areaFormatMenu = tkinter.OptionMenu(
+            self.__mainWindow,
+            self.__areaFormatVar,
+            *image_writer.FORMATS.keys()
+        )
+        self.__areaFormatMenu.grid(row=7, column=cam_column+1)
+
+        # Wait after the stage moves until the camera image is still instead of a fixed time
+        self.__settleVar = tkinter.BooleanVar()
+        self.__settleVar.set(True)
+        self.__settleButton = tkinter.Checkbutton(
+            self.__mainWindow,
+            text="Settle detection",
+            variable=self.__settleVar
+        )
+        self.__settleButton.grid(row=7, column=cam_column+2)
+
         # Elements for camera settings
 
         for index, text in enumerate(cam_label_texts):
@@ -308,8 +339,6 @@ class DSM:
             entry = tkinter.Entry(self.__mainWindow, textvariable=self.__camVars[index])
             entry.grid(row=index, column=cam_column+2)
 
-        self.set_cam_settings()
-
         self.__camSetButton = tkinter.Button(self.__mainWindow, text="Set values", command=self.set_cam_settings)
         self.__camSetButton.grid(row=len(cam_label_texts), column=cam_column+2)
 
@@ -319,18 +348,120 @@ class DSM:
             label = tkinter.Label(self.__mainWindow, text=text)
             label.grid(row=index, column=cam_column+3)
 
+        # Named camera settings profiles, for example for different sample types
+        profile_label = tkinter.Label(self.__mainWindow, text="Profile")
+        profile_label.grid(row=9, column=cam_column+1)
+
+        self.__profileVar = tkinter.StringVar()
+        self.__profileVar.set("default")
+        self.__profileEntry = tkinter.Entry(self.__mainWindow, textvariable=self.__profileVar)
+        self.__profileEntry.grid(row=9, column=cam_column+2)
+
+        self.__profileLoadButton = tkinter.Button(self.__mainWindow, text="Load profile", command=self.load_cam_profile)
+        self.__profileLoadButton.grid(row=10, column=cam_column+1)
+
+        self.__profileSaveButton = tkinter.Button(self.__mainWindow, text="Save profile", command=self.save_cam_profile)
+        self.__profileSaveButton.grid(row=10, column=cam_column+2)
+
         # self.__creatorText = tkinter.Label(self.__mainWindow, text="Created by Mika Mäki, work in progress")
         # self.__creatorText.grid(row=3, columnspan=3)
 
         # Create a list of buttons that should be disabled when measuring
         self.__sensitiveButtons = [self.__upButton, self.__leftButton, self.__rightButton, self.__downButton,
                                    self.__corner1_Button, self.__corner2_Button, self.__resetCoords_Button,
+                                   self.__homeButton,
                                    self.__chipButton, self.__waferButton, self.__waferFullButton, self.__areaButton,
                                    self.__folderButton]
 
         logger.info("Program ready")
-        self.info_text("")
+        self.info_text("Opening the camera")
+        threading.Thread(target=self.open_camera, name="open_camera", daemon=True).start()
+        self.__mainWindow.after(METRICS_INTERVAL, self.update_metrics)
         self.__mainWindow.mainloop()
+        if self.__publisher is not None:
+            # The viewer closes its window when the publisher stops
+            self.__publisher.close()
+            if self.__viewer is not None:
+                try:
+                    self.__viewer.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.__viewer.terminate()
+        if self.__camera is not None:
+            self.__camera.stop_video()
+        self.__stitcher.shutdown()
+        self.__writer.close()
+        if self.__cameras is not None:
+            # The grabber threads and the captures of the cameras are released. The camera service keeps running.
+            self.__cameras.close(close_cameras=True)
+
+    def __wait_for_camera(self) -> None:
+        if not self.__cameraReady.wait(CAMERA_OPEN_TIMEOUT):
+            raise IOError(f"The camera did not open within {CAMERA_OPEN_TIMEOUT} s")
+        if self.__camera is None:
+            raise IOError(f"The camera could not be opened: {self.__cameraError}")
+
+    @property
+    def camera(self) -> tp.Union[camera_opencv.CameraCV, camera_service.CameraClient]:
+        """The primary camera, waits for it to open if necessary"""
+        self.__wait_for_camera()
+        return self.__camera
+
+    @property
+    def cameras(self) -> camera_group.CameraGroup:
+        """All the cameras, waits for them to open if necessary"""
+        self.__wait_for_camera()
+        return self.__cameras
+
+    def open_camera(self) -> None:
+        """Opens and configures the camera and starts the live view
+
+        The camera service keeps the camera open between the runs of the program, so usually only the first start is
+        slow. If the service cannot be used, the camera is opened directly.
+        :return: -
+        """
+        start_time = time.perf_counter()
+        try:
+            try:
+                cam = camera_service.CameraClient()
+            except IOError as e:
+                logger.warning(f"Could not use the camera service, opening the camera directly: {e}")
+                cam = camera_opencv.CameraCV()
+            try:
+                cam.set_prop(camera_opencv.Props.ISO_SPEED, 800)
+            except ValueError as e:
+                logger.warning(f"Could not set ISO speed for the camera: {e}")
+            try:
+                cam.set_resolution(width=1280, height=960)
+            except ValueError as e:
+                logger.warning(f"Could not set camera resolution: {e}")
+            # The live view and the measurements get their frames from a background thread
+            cam.start_grabbing()
+        except (IOError, ValueError) as e:
+            self.__cameraError = e
+            self.__cameraReady.set()
+            self.info_text(f"Opening the camera failed: {e}")
+            return
+        cameras = {PRIMARY_CAMERA: cam}
+        for name, address in EXTRA_CAMERAS.items():
+            try:
+                extra = camera_opencv.CameraCV(address)
+                extra.start_grabbing()
+            except IOError as e:
+                logger.warning(f"Could not open camera {name}, measuring without it: {e}")
+                continue
+            cameras[name] = extra
+        self.__cameras = camera_group.CameraGroup(cameras)
+        self.__camera = cam
+        self.__cameraReady.set()
+        self.set_cam_settings()
+
+        try:
+            self.__publisher = live_view.FramePublisher(cam)
+        except IOError as e:
+            self.info_text(f"Could not start the live view: {e}")
+        else:
+            self.qt_restart()
+        self.info_text(f"Camera ready in {time.perf_counter() - start_time:.1f} s")
 
     def abort(self):
         if not self.__aborting:
@@ -364,40 +495,183 @@ class DSM:
         self.__infoVar.set(text)
         logger.info(text)
 
+    @property
+    def metrics(self) -> tp.Optional[frame_metrics.FrameMetrics]:
+        """Focus and exposure metrics of the latest live view frame, None before the camera is ready"""
+        if self.__publisher is None:
+            return None
+        return self.__publisher.metrics
+
+    def update_metrics(self) -> None:
+        """Shows the metrics of the live view in the main window, called periodically in the Tk thread
+
+        :return: -
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            self.__metricsVar.set(
+                f"Focus {metrics.focus:.0f}, mean {metrics.mean:.0f}, saturated {metrics.saturation * 100:.2f} %")
+        self.__mainWindow.after(METRICS_INTERVAL, self.update_metrics)
+
+    def cam_settings(self) -> tp.Dict[camera_opencv.Props, int]:
+        """The camera settings entered in the GUI
+
+        :return: property -> value
+        """
+        return {prop: int(var.get()) for prop, var in zip(CAM_PROPS, self.__camVars)}
+
     def set_cam_settings(self) -> None:
-        props = [
-            camera_opencv.Props.AUTO_EXPOSURE,
-            camera_opencv.Props.BRIGHTNESS,
-            camera_opencv.Props.GAIN,
-            camera_opencv.Props.GAMMA,
-            camera_opencv.Props.SHARPNESS,
-            camera_opencv.Props.EXPOSURE
-        ]
+        # Only the changed values are sent to the camera
         try:
-            for i, var in enumerate(self.__camVars):
-                value = int(var.get())
-                self.camera.set_prop(props[i], value)
-            self.info_text("Camera configuration successful")
+            changed = self.camera.set_props(self.cam_settings())
+            self.info_text(f"Camera configuration successful, {changed} values changed")
         except (IOError, ValueError) as e:
             self.info_text(f"Camera configuration failed: {e}")
 
+    def save_cam_profile(self) -> None:
+        name = self.__profileVar.get()
+        try:
+            path = camera_opencv.save_profile(name, self.cam_settings())
+        except (IOError, ValueError) as e:
+            self.info_text(f"Saving the camera profile failed: {e}")
+            return
+        self.info_text(f"Camera profile saved to {path}")
+
+    def load_cam_profile(self) -> None:
+        name = self.__profileVar.get()
+        try:
+            values = camera_opencv.load_profile(name)
+        except (IOError, ValueError) as e:
+            self.info_text(f"Loading the camera profile failed: {e}")
+            return
+        for prop, var in zip(CAM_PROPS, self.__camVars):
+            if prop in values:
+                var.set(str(int(values[prop])))
+        self.set_cam_settings()
+
+    def wait_for_stage(self, wait_time: float) -> None:
+        """Waits until the stage has settled after a move
+
+        The drives are polled until they have reached their targets. If their status cannot be read or they do not
+        settle in time, the camera image is watched until it is still instead.
+        :param wait_time: fixed waiting time that is used when the settle detection is off
+        :return: -
+        """
+        if not self.__settleVar.get():
+            time.sleep(wait_time)
+            return
+        start_time = time.perf_counter()
+        try:
+            elapsed = self.stages.wait_until_settled(timeout=wait_time * SETTLE_TIMEOUT_FACTOR)
+        except TimeoutError as e:
+            logger.warning(f"The stage did not settle in time, waiting for the camera image instead: {e}")
+        except (IOError, ValueError, sm.SmException) as e:
+            logger.warning(f"Could not read the stage status, waiting for the camera image instead: {e}")
+        else:
+            logger.debug("Stage settled in %.3f s instead of %.2f s", elapsed, wait_time)
+            return
+        # The time spent polling the drives counts towards the limits, so the worst case stays the same
+        waited = time.perf_counter() - start_time
+        result = settle.wait_until_still(
+            self.camera,
+            timeout=max(wait_time * SETTLE_TIMEOUT_FACTOR - waited, 0),
+            min_time=max(wait_time * SETTLE_MIN_FRACTION - waited, 0),
+            unmoved_min_time=max(wait_time - waited, 0)
+        )
+        logger.debug(
+            "Stage settled: %s in %.2f s instead of %.2f s, %d frames", result.settled, result.elapsed, wait_time,
+            result.frames
+        )
+
+    def capture(self) -> tp.Dict[str, np.ndarray]:
+        """Takes a picture with every camera for a measurement, averaging the set number of frames
+
+        :return: camera name -> frame
+        """
+        try:
+            n = int(self.__averageVar.get())
+        except ValueError:
+            n = 1
+        if n < 1:
+            n = 1
+        start_time = time.perf_counter()
+        frames = self.cameras.grab(n, method=self.__average_method)
+        if n > 1:
+            logger.debug("Averaging %d frames took %.3f s", n, time.perf_counter() - start_time)
+        return {name: frame.frame for name, frame in frames.items()}
+
+    def write_tiles(self, path: str, frames: tp.Dict[str, np.ndarray], fmt: tp.Optional[str] = None) -> np.ndarray:
+        """Writes the pictures of a position in the background
+
+        :param path: path of the picture of the primary camera, the others are named after it
+        :param frames: camera name -> frame, from capture()
+        :param fmt: image format, see image_writer.FORMATS
+        :return: frame of the primary camera
+        """
+        primary = frames[self.cameras.primary]
+        if primary.dtype == np.uint8:
+            metrics = frame_metrics.measure(primary)
+            logger.debug(
+                "%s: focus %.0f, mean %.0f, saturated %.2f %%", os.path.basename(path), metrics.focus, metrics.mean,
+                metrics.saturation * 100
+            )
+            if metrics.saturation > frame_metrics.MAX_SATURATION:
+                logger.warning(
+                    "%.2f %% of %s is saturated, consider reducing the exposure", metrics.saturation * 100, path)
+        for name, frame in frames.items():
+            tile_path = self.cameras.tile_path(path, name)
+            if name != self.cameras.primary:
+                os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            self.__writer.write(tile_path, frame, fmt)
+        return primary
+
     def takepic(self) -> None:
-        self.camera.save_frame(os.path.join(self.__current_dir, self.__picVar.get(), ".png"))
+        try:
+            path = image_writer.save_image(
+                os.path.join(self.__current_dir, self.__picVar.get() + ".png"),
+                self.camera.get_frame()
+            )
+        except OSError as e:
+            self.info_text(f"Saving the picture failed: {e}")
+            return
+        self.info_text(f"Saved {path}")
+
+    def toggle_video(self) -> None:
+        """Starts or stops recording the camera into a video file in the current folder"""
+        try:
+            stats = self.camera.stop_video()
+            if stats is None:
+                path = os.path.join(
+                    self.__current_dir, f"{self.__picVar.get()}_{time.strftime('%Y-%m-%d_%H-%M-%S')}.avi")
+                self.camera.start_video(path)
+                self.__videoButton.config(text="Stop video")
+                self.info_text(f"Recording video to {path}")
+                return
+        except (IOError, ValueError) as e:
+            self.__videoButton.config(text="Record video")
+            self.info_text(f"Video recording failed: {e}")
+            return
+        self.__videoButton.config(text="Record video")
+        self.info_text(
+            f"Recorded {stats.frames} frames in {stats.duration:.1f} s at {stats.fps:.1f} fps, "
+            f"{stats.dropped} frames dropped"
+        )
 
     def takepic_chip(self, chip_name: str, chip_path: str, number: int) -> None:
-        filename = "{}_{}_{}".format(chip_name, self.__time_str, number)
-        self.camera.save_frame(os.path.join(chip_path, filename))
+        filename = "{}_{}_{}.png".format(chip_name, self.__time_str, number)
+        self.write_tiles(os.path.join(chip_path, filename), self.capture())
 
-    def takepic_area(self, name: str, path: str, number: int, total: int) -> None:
+    def takepic_area(self, name: str, path: str, number: int, total: int) -> np.ndarray:
         padded_number = str(number).zfill(int(math.ceil(math.log10(total + 1))))
         filename = "{}_{}_{}".format(name, self.__time_str, padded_number)
-        self.camera.save_frame(os.path.join(filename, path))
+        return self.write_tiles(os.path.join(path, filename), self.capture(), self.__areaFormatVar.get())
 
     def qt_restart(self) -> None:
-        if not self.qt_thread.is_alive():
-            autorange = self.__camRangeVar.get()
-            self.qt_thread = threading.Thread(target=QtDisp, args=(self.camera, autorange))
-            self.qt_thread.start()
+        if self.__publisher is None:
+            self.info_text("The camera is not ready")
+            return
+        if self.__viewer is None or self.__viewer.poll() is not None:
+            self.__viewer = live_view.start_viewer(self.__publisher.name, self.__camRangeVar.get(), WINDOW_TITLE)
 
     def choose_dir(self) -> None:
         new_dir = tkinter.filedialog.askdirectory()
@@ -501,93 +775,77 @@ class DSM:
             os.makedirs(chip_path)
 
             self.stages.step_left(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 1)
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 2)
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 3)
 
             self.stages.step_down(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 4)
 
             self.stages.step_left(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 5)
 
             self.stages.step_left(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 6)
 
             self.stages.step_down(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 7)
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 8)
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
+            self.wait_for_stage(sleep_time)
             self.takepic_chip(chip_name, chip_path, 9)
 
             # Return to the previous position
             self.stages.step_up(2*mstep)
             self.stages.step_left(mstep)
 
-            self.__stitch_lock.acquire()
-            # Stitch the images
-            cmdstr = "magick convert background_3x3.png "
-            cmdstr += chip_path + "/*1.png -gravity Northwest -geometry +0+0 -composite "
-            cmdstr += chip_path + "/*2.png -geometry +760+0 -composite "
-            cmdstr += chip_path + "/*3.png -geometry +1520+0 -composite "
-            cmdstr += chip_path + "/*6.png -geometry +0+760 -composite "
-            cmdstr += chip_path + "/*5.png -geometry +760+760 -composite "
-            cmdstr += chip_path + "/*4.png -geometry +1520+760 -composite "
-            cmdstr += chip_path + "/*7.png -geometry +0+1520 -composite "
-            cmdstr += chip_path + "/*8.png -geometry +760+1520 -composite "
-            cmdstr += chip_path + "/*9.png -geometry +1520+1520 -composite "
-            cmdstr += chip_path + "/" + chip_name + "_" + self.__time_str + "_stitch.png"
-            # TODO: Replace this with a subprocess call
-            os.system(cmdstr)
-            self.__stitch_lock.release()
-
-            """
-            # For non-rotated image
-            # Stitch the images
-            cmdstr = "magick convert background_3x3.png "
-            cmdstr += chip_path + "/*9.png -gravity Northwest -geometry +0+0 -composite "
-            cmdstr += chip_path + "/*8.png -geometry +760+0 -composite "
-            cmdstr += chip_path + "/*7.png -geometry +1520+0 -composite "
-            cmdstr += chip_path + "/*4.png -geometry +0+760 -composite "
-            cmdstr += chip_path + "/*5.png -geometry +760+760 -composite "
-            cmdstr += chip_path + "/*6.png -geometry +1520+760 -composite "
-            cmdstr += chip_path + "/*3.png -geometry +0+1520 -composite "
-            cmdstr += chip_path + "/*2.png -geometry +760+1520 -composite "
-            cmdstr += chip_path + "/*1.png -geometry +1520+1520 -composite "
-            cmdstr += chip_path + "/" + chip_name + "_" + self.__timestring + "_stitch.png"
-            # TODO: Replace this with a subprocess call
-            os.system(cmdstr)
-            """
+            # Stitch the images once they have been written
+            # For non-rotated images use stitching.NINE_LAYOUT_NON_ROTATED
+            self.__writer.flush()
+            stitch = self.__stitcher.submit(
+                stitch_scheduler.stitch_9_job,
+                chip_path,
+                os.path.join(chip_path, f"{chip_name}_{self.__time_str}_stitch.png"),
+                self.__register_tiles
+            )
+            try:
+                stitch.result()
+            except OSError as e:
+                self.info_text(f"Stitching failed: {e}")
+                self.set_measuring(False)
+                return
 
             self.info_text("Stitch ready")
             self.set_measuring(False)
         except dsm_exceptions.AbortException:
             self.info_text("Chip measurement aborted")
+        except image_writer.WriteError as e:
+            self.info_text(f"Saving the pictures failed: {e}")
+            self.set_measuring(False)
 
-    def measure_9(self, directory: str, basename: str, stitch_name: str) -> None:
+    def measure_9(self, directory: str, basename: str, stitch_name: str) -> concurrent.futures.Future:
         """Create a stitch of 9 pictures
 
         Begins and ends at the center
         :param directory: Directory for the stitch
         :param basename: Name of the measurement the stitch is part of
         :param stitch_name: Name of this particular stitch
-        :return: -
+        :return: future of the stitch
         """
 
         try:
@@ -603,79 +861,70 @@ class DSM:
 
             self.stages.step_left(mstep)
             self.stages.step_up(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "1")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "1.png", self.capture())
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "2")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "2.png", self.capture())
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "3")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "3.png", self.capture())
 
             self.stages.step_down(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "4")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "4.png", self.capture())
 
             self.stages.step_left(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "5")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "5.png", self.capture())
 
             self.stages.step_left(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "6")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "6.png", self.capture())
 
             self.stages.step_down(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "7")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "7.png", self.capture())
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "8")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "8.png", self.capture())
 
             self.stages.step_right(mstep)
-            time.sleep(sleep_time)
-            self.camera.save_frame(path_base + "9")
+            self.wait_for_stage(sleep_time)
+            self.write_tiles(path_base + "9.png", self.capture())
 
             self.stages.step_left(mstep)
             self.stages.step_up(mstep)
-            time.sleep(sleep_time)
+            self.__writer.flush()
+            self.wait_for_stage(sleep_time)
 
-            stitch_thread = threading.Thread(
-                target=self.stitch_9,
-                name="stitch",
-                args=(directory, basename, stitch_name)
-            )
-            stitch_thread.start()
+            return self.stitch_9(directory, basename, stitch_name)
         except dsm_exceptions.AbortException:
             raise dsm_exceptions.AbortException
 
-    def stitch_9(self, directory: str, basename: str, stitch_name: str) -> None:
-        """Stitches a set of 9 pictures using ImageMagick
+    def stitch_9(self, directory: str, basename: str, stitch_name: str) -> concurrent.futures.Future:
+        """Schedules the stitching of a set of 9 pictures
 
-        Actually it builds a terminal command and starts ImageMagick using a virtual terminal
         :param directory: directory in which the images are
         :param basename: name of the measurement
         :param stitch_name: name of this particular stitch
-        :return: -
+        :return: future of the stitch
         """
-        self.__stitch_lock.acquire()
-        cmdstr = "magick convert background_3x3.png "
-        cmdstr += directory + "/*1.png -gravity Northwest -geometry +0+0 -composite "
-        cmdstr += directory + "/*2.png -geometry +760+0 -composite "
-        cmdstr += directory + "/*3.png -geometry +1520+0 -composite "
-        cmdstr += directory + "/*6.png -geometry +0+760 -composite "
-        cmdstr += directory + "/*5.png -geometry +760+760 -composite "
-        cmdstr += directory + "/*4.png -geometry +1520+760 -composite "
-        cmdstr += directory + "/*7.png -geometry +0+1520 -composite "
-        cmdstr += directory + "/*8.png -geometry +760+1520 -composite "
-        cmdstr += directory + "/*9.png -geometry +1520+1520 -composite "
-        cmdstr += directory + "/" + basename + "_" + self.__time_str + "_" + stitch_name + "_stitch.png"
-        # TODO: Replace this with a subprocess call
-        os.system(cmdstr)
-        self.__stitch_lock.release()
-        logger.info("Stitch %s ready", stitch_name)
+        path = os.path.join(directory, f"{basename}_{self.__time_str}_{stitch_name}_stitch.png")
+        stitch = self.__stitcher.submit(stitch_scheduler.stitch_9_job, directory, path, self.__register_tiles)
+        logger.debug("Stitch queue depth: %d", self.__stitcher.queue_depth)
+
+        def log_result(future: concurrent.futures.Future) -> None:
+            if future.exception() is not None:
+                logger.error("Stitch %s failed: %s", stitch_name, future.exception())
+            else:
+                logger.info("Stitch %s ready", stitch_name)
+
+        stitch.add_done_callback(log_result)
+        return stitch
 
     def measure_wafer_threaded(self) -> None:
         """Threading support for wafer measurement
@@ -706,91 +955,89 @@ class DSM:
             self.set_measuring(True)
 
             os.makedirs(wafer_path)
+            site_stitches = []
 
             self.stages.mm_up(5)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/00x-20", wafer_name, "00x-20")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/00x-20", wafer_name, "00x-20"))
 
             self.stages.mm_up(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/00x-10", wafer_name, "00x-10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/00x-10", wafer_name, "00x-10"))
 
             self.stages.mm_right(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/10x-10", wafer_name, "10x-10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/10x-10", wafer_name, "10x-10"))
 
             self.stages.mm_up(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/10x00", wafer_name, "10x00")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/10x00", wafer_name, "10x00"))
 
             self.stages.mm_right(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/20x00", wafer_name, "20x00")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/20x00", wafer_name, "20x00"))
 
             self.stages.mm_left(10)
             self.stages.mm_up(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/10x10", wafer_name, "10x10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/10x10", wafer_name, "10x10"))
 
             self.stages.mm_left(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/00x10", wafer_name, "00x10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/00x10", wafer_name, "00x10"))
 
             self.stages.mm_up(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/00x20", wafer_name, "00x20")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/00x20", wafer_name, "00x20"))
 
             self.stages.mm_down(10)
             self.stages.mm_left(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/-10x10", wafer_name, "-10x10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/-10x10", wafer_name, "-10x10"))
 
             self.stages.mm_down(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/-10x00", wafer_name, "-10x00")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/-10x00", wafer_name, "-10x00"))
 
             self.stages.mm_left(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/-20x00", wafer_name, "-20x00")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/-20x00", wafer_name, "-20x00"))
 
             self.stages.mm_right(10)
             self.stages.mm_down(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/-10x-10", wafer_name, "-10x-10")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/-10x-10", wafer_name, "-10x-10"))
 
             self.stages.mm_up(10)
             self.stages.mm_right(10)
-            time.sleep(sleep_time)
-            self.measure_9(wafer_path + "/00x00", wafer_name, "00x00")
+            self.wait_for_stage(sleep_time)
+            site_stitches.append(self.measure_9(wafer_path + "/00x00", wafer_name, "00x00"))
 
             self.stages.mm_down(25)
 
-            self.__stitch_lock.acquire()
+            # The wafer stitch is started once all the site stitches have finished
+            wafer_stitch = self.__stitcher.submit(
+                stitch_scheduler.stitch_wafer_job,
+                wafer_path,
+                os.path.join(wafer_path, f"{wafer_name}_{self.__time_str}_stitch.png"),
+                depends_on=site_stitches
+            )
             self.info_text("Stitching wafer")
-            cmdstr = "magick convert background_wafer.png "
-            cmdstr += wafer_path + "/00x20/*stitch.png -gravity Northwest -geometry +5800+0 -composite "
-            cmdstr += wafer_path + "/00x10/*stitch.png -geometry +5800+2580 -composite "
-            cmdstr += wafer_path + "/-10x10/*stitch.png -geometry +2900+2580 -composite "
-            cmdstr += wafer_path + "/10x10/*stitch.png -geometry +8700+2580 -composite "
-            cmdstr += wafer_path + "/00x00/*stitch.png -geometry +5800+5160 -composite "
-            cmdstr += wafer_path + "/-20x00/*stitch.png -geometry +0+5160 -composite "
-            cmdstr += wafer_path + "/-10x00/*stitch.png -geometry +2900+5160 -composite "
-            cmdstr += wafer_path + "/10x00/*stitch.png -geometry +8700+5160 -composite "
-            cmdstr += wafer_path + "/20x00/*stitch.png -geometry +11600+5160 -composite "
-            cmdstr += wafer_path + "/00x-10/*stitch.png -geometry +5800+7740 -composite "
-            cmdstr += wafer_path + "/-10x-10/*stitch.png -geometry +2900+7740 -composite "
-            cmdstr += wafer_path + "/10x-10/*stitch.png -geometry +8700+7740 -composite "
-            cmdstr += wafer_path + "/00x-20/*stitch.png -geometry +5800+10320 -composite "
-            cmdstr += wafer_path + "/" + wafer_name + "_" + self.__time_str + "_stitch.png"
-            # TODO: Replace this with a subprocess call
-            os.system(cmdstr)
-            self.__stitch_lock.release()
+            try:
+                wafer_stitch.result()
+            except (OSError, stitch_scheduler.DependencyError) as e:
+                self.info_text(f"Stitching wafer failed: {e}")
+                self.set_measuring(False)
+                return
             logger.info("Stitch of %s ready", wafer_name)
 
             self.info_text("Wafer ready")
             self.set_measuring(False)
         except dsm_exceptions.AbortException:
             self.info_text("Wafer measurement aborted")
+        except image_writer.WriteError as e:
+            self.info_text(f"Saving the pictures failed: {e}")
+            self.set_measuring(False)
 
     def set_corner1(self) -> None:
         """Sets corner 1 to the current position
@@ -817,6 +1064,35 @@ class DSM:
         self.__corner1 = (0, 0)
         self.__corner2 = (0, 0)
 
+    def home_stage(self) -> None:
+        """Threading support for homing the stage
+
+        :return: -
+        """
+        if self.__measuring:
+            self.info_text("Measurement already running")
+        else:
+            thread = threading.Thread(target=self.home_stage_threaded, name="homing")
+            thread.start()
+
+    def home_stage_threaded(self) -> None:
+        """Home the x and y axes, which moves the stage and zeroes the coordinates
+
+        :return: -
+        """
+        self.set_measuring(True)
+        self.info_text("Homing the stage")
+        try:
+            self.stages.home()
+        except (IOError, ValueError, sm.SmException) as e:
+            self.info_text(f"Homing failed, the stage moves incrementally: {e}")
+        else:
+            self.__corner1 = (0, 0)
+            self.__corner2 = (0, 0)
+            self.info_text("Stage homed")
+        finally:
+            self.set_measuring(False)
+
     def measure_area_threaded(self) -> None:
         """Threading support for area measurements
 
@@ -828,9 +1104,10 @@ class DSM:
             thread = threading.Thread(target=self.measure_area, name="measurement")
             thread.start()
 
-    def measure_area(self) -> None:
+    def measure_area(self, write_mosaic: bool = True) -> None:
         """Measures a custom area defined by two corners
 
+        :param write_mosaic: whether to stitch the pictures into a BigTIFF mosaic during the measurement
         :return: -
         """
         try:
@@ -873,34 +1150,63 @@ class DSM:
 
             initial_move_time = self.stages.time(start_pos[0] - self.__corner1[0], start_pos[1] - self.__corner1[1])
             logger.info("Expected initial movement time: %f", initial_move_time)
-            time.sleep(initial_move_time)
 
-            for y in range(1, y_width+1):
-                for x in range(1, x_width+1):
-                    self.takepic_area(area_name, directory, i, total)
-                    i += 1
-
-                    if x < x_width:
-                        if y % 2 == 0:
-                            self.stages.step_left(mstep)
+            stream = None
+            if write_mosaic:
+                # The frames are pasted into the mosaic while the stage moves to the next position
+                frame_width, frame_height = (int(value) for value in self.camera.resolution)
+                stream = mosaic.StreamingMosaic(
+                    os.path.join(directory, f"{area_name}_{self.__time_str}_mosaic.tif"),
+                    canvas_size=(
+                        (x_width - 1) * stitching.PITCH + frame_width,
+                        (y_width - 1) * stitching.PITCH + frame_height
+                    ),
+                    origin=(dx, dy),
+                    steps_per_pixel=mstep / stitching.PITCH
+                )
+
+            self.wait_for_stage(initial_move_time)
+
+            try:
+                for y in range(1, y_width+1):
+                    for x in range(1, x_width+1):
+                        frame = self.takepic_area(area_name, directory, i, total)
+                        if stream is not None:
+                            stream.add(frame, self.stages.where())
+                        i += 1
+
+                        if x < x_width:
+                            if y % 2 == 0:
+                                self.stages.step_left(mstep)
+                            else:
+                                self.stages.step_right(mstep)
+                            self.wait_for_stage(sleeptime_x)
                         else:
-                            self.stages.step_right(mstep)
-                        time.sleep(sleeptime_x)
-                    else:
-                        if y < y_width:
-                            self.stages.step_down(mstep)
-                            time.sleep(sleeptime_y)
-
+                            if y < y_width:
+                                self.stages.step_down(mstep)
+                                self.wait_for_stage(sleeptime_y)
+            finally:
+                if stream is not None:
+                    try:
+                        stream.close(os.path.join(directory, f"{area_name}_{self.__time_str}_overview.png"))
+                    except Exception:  # pylint: disable=broad-except
+                        # The pictures have been written, and an exception of the measurement must not be hidden
+                        logger.exception("Mosaic of %s failed", area_name)
+
+            self.__writer.flush()
             self.info_text("Area measured")
 
             self.set_measuring(False)
         except dsm_exceptions.AbortException:
             self.info_text("Area measurement aborted")
+        except image_writer.WriteError as e:
+            self.info_text(f"Saving the pictures failed: {e}")
+            self.set_measuring(False)
 
     def measure_entire_wafer_threaded(self) -> None:
         """Measures an entire 50 mm wafer
 
-        The resulting folder is about 6 GB
+        The resulting folder is about 6 GB, and the pictures are stitched into a tiled BigTIFF on the fly
         :return: -
         """
         if self.__measuring:
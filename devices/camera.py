@@ -5,19 +5,350 @@ __maintainer__ = "Mika Mäki"
 __email__ = "mika.maki@tuni.fi"
 
 import abc
+import collections
+import contextlib
+import logging
+import queue
+import threading
+import time
 import typing as tp
 
 import cv2
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+# Frame rate of the recorded videos
+VIDEO_FPS = 30
+# Number of frames waiting for the encoder, beyond which the frames are dropped
+VIDEO_QUEUE_SIZE = 32
+
 # Enable OpenCL acceleration (just in case)
 # cv2.ocl.setUseOpenCL(True)
 
 
+class FramePool:
+    """Preallocated frames that are handed out and recycled instead of allocating a new array for each frame"""
+    def __init__(self, shape: tp.Tuple[int, ...], dtype=np.uint8, size: int = 4):
+        """
+        :param shape: shape of the frames
+        :param dtype: data type of the frames
+        :param size: number of free frames to keep
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.__free: tp.Deque[np.ndarray] = collections.deque(np.empty(self.shape, self.dtype) for _ in range(size))
+        self.__lock = threading.Lock()
+        # Number of frames allocated after the initial ones because the pool was empty
+        self.extra_allocations = 0
+
+    def acquire(self) -> np.ndarray:
+        """Get a frame, the contents of which are undefined
+
+        :return: frame
+        """
+        with self.__lock:
+            if self.__free:
+                return self.__free.pop()
+            self.extra_allocations += 1
+        logger.debug("Frame pool is empty, allocating a new frame")
+        return np.empty(self.shape, self.dtype)
+
+    def release(self, frame: np.ndarray) -> None:
+        """Return a frame to the pool
+
+        Frames of a different shape or type are discarded, so the pool can be reallocated simply by replacing it.
+        :param frame: frame from acquire() or any other array
+        :return: -
+        """
+        if frame.shape != self.shape or frame.dtype != self.dtype or not frame.flags.c_contiguous:
+            return
+        with self.__lock:
+            if len(self.__free) < self.size:
+                self.__free.append(frame)
+
+    @contextlib.contextmanager
+    def borrow(self) -> tp.Iterator[np.ndarray]:
+        frame = self.acquire()
+        try:
+            yield frame
+        finally:
+            self.release(frame)
+
+
+class FrameAverager:
+    """Combines frames into one to reduce noise
+
+    The frames are accumulated in place into preallocated buffers as they are added, so the work overlaps with the
+    acquisition of the next frame. The mean is accumulated into uint32 (float32 for float frames). Sigma clipping
+    and median need all the frames and therefore store them into a preallocated stack.
+    """
+    METHODS = ("mean", "sigma_clip", "median")
+
+    def __init__(
+            self,
+            shape: tp.Tuple[int, ...],
+            n: int,
+            method: str = "mean",
+            dtype=np.uint8,
+            sigma: float = 3.0):
+        """
+        :param shape: shape of the frames
+        :param n: number of frames to combine
+        :param method: mean, sigma_clip or median
+        :param dtype: data type of the frames
+        :param sigma: clipping limit in standard deviations for sigma_clip
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Invalid averaging method: {method}")
+        if n < 1:
+            raise ValueError(f"Invalid frame count: {n}")
+        self.shape = tuple(shape)
+        self.n = n
+        self.method = method
+        self.dtype = np.dtype(dtype)
+        self.sigma = sigma
+        if method == "mean":
+            acc_dtype = np.float32 if self.dtype.kind == "f" else np.uint32
+            self.__acc = np.zeros(self.shape, dtype=acc_dtype)
+        else:
+            self.__acc = np.empty((n,) + self.shape, dtype=self.dtype)
+        self.count = 0
+
+    def reset(self) -> None:
+        self.count = 0
+        if self.method == "mean":
+            self.__acc.fill(0)
+
+    def add(self, frame: np.ndarray) -> None:
+        if self.count >= self.n:
+            raise ValueError(f"Already got {self.n} frames")
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match {self.shape}")
+        if self.method == "mean":
+            np.add(self.__acc, frame, out=self.__acc, casting="unsafe")
+        else:
+            np.copyto(self.__acc[self.count], frame)
+        self.count += 1
+
+    def result(self, dtype=None) -> np.ndarray:
+        """Combine the added frames
+
+        :param dtype: data type of the result, by default that of the frames.
+            An integer type wider than that of the frames gets the result scaled to its range, so the extra precision
+            gained by averaging is kept, for example 255 in uint8 frames becomes 65535 in uint16.
+        :return: combined frame
+        """
+        if not self.count:
+            raise ValueError("No frames to combine")
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        if self.method == "mean":
+            mean = self.__acc.astype(np.float32)
+            mean *= 1 / self.count
+        elif self.method == "median":
+            mean = np.median(self.__acc[:self.count], axis=0).astype(np.float32)
+        else:
+            mean = self.__sigma_clipped_mean()
+
+        if dtype.kind in "ui" and self.dtype.kind in "ui" and dtype.itemsize > self.dtype.itemsize:
+            mean *= np.iinfo(dtype).max / np.iinfo(self.dtype).max
+        if dtype.kind in "ui":
+            info = np.iinfo(dtype)
+            np.clip(mean, info.min, info.max, out=mean)
+            np.rint(mean, out=mean)
+        return mean.astype(dtype)
+
+    def __sigma_clipped_mean(self) -> np.ndarray:
+        stack = self.__acc[:self.count].astype(np.float32)
+        mean = stack.mean(axis=0)
+        std = stack.std(axis=0)
+        # Pixels that deviate too much, for example because of a flicker or a cosmic ray, are left out
+        keep = np.abs(stack - mean) <= self.sigma * std
+        count = keep.sum(axis=0)
+        total = np.where(keep, stack, 0).sum(axis=0)
+        # With sigma >= 1 at least one frame is kept for every pixel
+        return np.divide(total, count, out=mean, where=count > 0)
+
+
+class VideoStats(tp.NamedTuple):
+    # Number of frames written into the video
+    frames: int
+    # Number of frames dropped because the encoder could not keep up
+    dropped: int
+    # Time between the first and the last frame in seconds
+    duration: float
+    # Frame rate that was actually recorded
+    fps: float
+
+
+class VideoRecorder:
+    """Writes frames into a video file in a background thread
+
+    The frames are offered from the acquisition, for example by FrameGrabber, and offer() never blocks: the frames
+    are copied into a bounded queue, and if the encoder falls behind, the new frames are dropped and counted instead.
+    Frames coming faster than the frame rate of the video are skipped, so the video plays at the real speed.
+    """
+    def __init__(self, path: str, fps: float = VIDEO_FPS, fourcc: str = "MJPG", queue_size: int = VIDEO_QUEUE_SIZE):
+        """
+        :param path: path of the video file
+        :param fps: frame rate of the video
+        :param fourcc: codec, see cv2.VideoWriter_fourcc()
+        :param queue_size: number of frames waiting for the encoder, beyond which the frames are dropped
+        """
+        if len(fourcc) != 4:
+            raise ValueError(f"Invalid fourcc: {fourcc}")
+        if fps <= 0:
+            raise ValueError(f"Invalid frame rate: {fps}")
+        self.path = path
+        self.fps = fps
+        self.__fourcc: int = cv2.VideoWriter_fourcc(*fourcc)
+        self.__queue: "queue.Queue[tp.Optional[np.ndarray]]" = queue.Queue(maxsize=queue_size)
+        self.__pool: tp.Optional[FramePool] = None
+        self.__pool_size = queue_size + 2
+        self.__writer: tp.Optional[cv2.VideoWriter] = None
+        self.__error: tp.Optional[Exception] = None
+        self.__lock = threading.Lock()
+        self.__next_time: tp.Optional[float] = None
+        self.__first_time: tp.Optional[float] = None
+        self.__last_time: tp.Optional[float] = None
+        self.__size: tp.Optional[tp.Tuple[int, int]] = None
+        # Frames accepted into the queue and frames written into the file
+        self.__queued = 0
+        self.__frames = 0
+        self.__dropped = 0
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__encode, name="video_encoder", daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    @property
+    def dropped(self) -> int:
+        return self.__dropped
+
+    def offer(self, frame: np.ndarray, timestamp: tp.Optional[float] = None) -> bool:
+        """Add a frame to the video if the encoder can take it
+
+        :param frame: frame, which is copied
+        :param timestamp: time of the frame from time.monotonic(), by default the current time
+        :return: whether the frame was queued
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.__lock:
+            if not self.__running:
+                return False
+            period = 1 / self.fps
+            # The tolerance keeps the jitter of a camera running at the frame rate of the video from skipping frames
+            if self.__next_time is not None and timestamp < self.__next_time - period / 4:
+                return False
+            if self.__next_time is None or timestamp - self.__next_time > period:
+                # After a gap the missed frames are not made up for
+                self.__next_time = timestamp + period
+            else:
+                self.__next_time += period
+            if self.__pool is None or self.__pool.shape != frame.shape or self.__pool.dtype != frame.dtype:
+                self.__pool = FramePool(frame.shape, frame.dtype, self.__pool_size)
+            pool = self.__pool
+        copy = pool.acquire()
+        np.copyto(copy, frame)
+        try:
+            self.__queue.put_nowait(copy)
+        except queue.Full:
+            pool.release(copy)
+            with self.__lock:
+                self.__dropped += 1
+            return False
+        with self.__lock:
+            if self.__first_time is None:
+                self.__first_time = timestamp
+            self.__last_time = timestamp
+            self.__queued += 1
+        return True
+
+    def __encode(self) -> None:
+        while True:
+            frame = self.__queue.get()
+            if frame is None:
+                break
+            if self.__error is None:
+                try:
+                    self.__write(frame)
+                except (IOError, cv2.error) as e:
+                    logger.error("Video recording failed: %s", e)
+                    self.__error = e
+            with self.__lock:
+                pool = self.__pool
+            if pool is not None:
+                pool.release(frame)
+        if self.__writer is not None:
+            self.__writer.release()
+            self.__writer = None
+
+    def __write(self, frame: np.ndarray) -> None:
+        if self.__writer is None:
+            # The frame size of the video is that of the first frame
+            self.__size = (frame.shape[1], frame.shape[0])
+            self.__writer = cv2.VideoWriter(self.path, self.__fourcc, self.fps, self.__size, frame.ndim == 3)
+            if not self.__writer.isOpened():
+                raise IOError(f"Could not open video file for writing: {self.path}")
+        if (frame.shape[1], frame.shape[0]) != self.__size:
+            frame = cv2.resize(frame, self.__size, interpolation=cv2.INTER_AREA)
+        if frame.dtype != np.uint8:
+            frame = cv2.convertScaleAbs(frame, alpha=255 / np.iinfo(frame.dtype).max)
+        self.__writer.write(frame)
+        self.__frames += 1
+
+    def stop(self) -> VideoStats:
+        """Write the queued frames and close the file
+
+        :return: statistics of the recording
+        """
+        with self.__lock:
+            was_running = self.__running
+            self.__running = False
+        if was_running:
+            self.__queue.put(None)
+        self.__thread.join()
+        stats = self.stats()
+        if was_running:
+            logger.info(
+                "Recorded %d frames at %.1f fps into %s, %d frames dropped",
+                stats.frames, stats.fps, self.path, stats.dropped
+            )
+        if self.__error is not None:
+            raise IOError(f"Video recording failed: {self.__error}")
+        return stats
+
+    def stats(self) -> VideoStats:
+        """Statistics of the recording so far"""
+        with self.__lock:
+            duration = self.__last_time - self.__first_time if self.__first_time is not None else 0.0
+            return VideoStats(
+                frames=self.__frames,
+                dropped=self.__dropped,
+                duration=duration,
+                fps=(self.__queued - 1) / duration if duration > 0 else 0.0
+            )
+
+
 class Camera(abc.ABC):
     def __init__(self, address):
         self.__address = address
-        self.__writer: tp.Optional[cv2.VideoWriter] = None
+        self.__recorder: tp.Optional[VideoRecorder] = None
+        self.__tap_thread: tp.Optional[threading.Thread] = None
+        self.__tap_stop = threading.Event()
+        self.__pool: tp.Optional[FramePool] = None
+        self.__averager: tp.Optional[FrameAverager] = None
 
     def __del__(self):
         self.stop_video()
@@ -26,23 +357,343 @@ class Camera(abc.ABC):
         return self.__address
 
     @abc.abstractmethod
-    def get_frame(self):
-        pass
+    def get_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        """Read a frame
+
+        :param output_array: array to read the frame into, if it has the right shape and type
+        :return: frame
+        """
 
-    def save_frame(self, path: str, frame: np.ndarray = None):
+    def frames(self, n: int) -> tp.Iterator[np.ndarray]:
+        """Read n frames one by one
+
+        The same array may be reused for each frame, so copy the frames that have to be kept.
+        :param n: number of frames
+        :return: iterator of the frames
+        """
+        frame = None
+        for _ in range(n):
+            frame = self.get_frame(output_array=frame)
+            yield frame
+
+    def average_frames(
+            self,
+            n: int,
+            method: str = "mean",
+            dtype=None,
+            sigma: float = 3.0) -> np.ndarray:
+        """Read n frames and combine them into one to reduce noise
+
+        :param n: number of frames
+        :param method: mean, sigma_clip or median
+        :param dtype: data type of the result, for example np.uint16 to keep the precision gained by averaging
+        :param sigma: clipping limit in standard deviations for sigma_clip
+        :return: combined frame
+        """
+        averager = None
+        for frame in self.frames(n):
+            if averager is None:
+                averager = self.__averager
+                if averager is None or (averager.shape, averager.n, averager.method, averager.dtype, averager.sigma) \
+                        != (frame.shape, n, method, frame.dtype, sigma):
+                    averager = FrameAverager(frame.shape, n, method, frame.dtype, sigma)
+                    self.__averager = averager
+                averager.reset()
+            averager.add(frame)
+        return averager.result(dtype)
+
+    def acquire_frame(self) -> np.ndarray:
+        """Read a frame into a preallocated array
+
+        Give the frame back with release_frame() when it is no longer needed, so it can be reused.
+        :return: frame
+        """
+        if self.__pool is None:
+            frame = self.get_frame()
+            self.__pool = FramePool(frame.shape, frame.dtype)
+            return frame
+        frame = self.__pool.acquire()
+        try:
+            read = self.get_frame(output_array=frame)
+        except Exception:
+            self.__pool.release(frame)
+            raise
+        if read is not frame:
+            # The frame size has changed
+            self.__pool = FramePool(read.shape, read.dtype)
+        return read
+
+    def release_frame(self, frame: np.ndarray) -> None:
+        """Give a frame from acquire_frame() back for reuse
+
+        :param frame: frame
+        :return: -
+        """
+        if self.__pool is not None:
+            self.__pool.release(frame)
+
+    def save_frame(self, path: str, frame: np.ndarray = None, params: tp.Sequence[int] = ()):
+        """Write a frame, the format is determined by the file extension
+
+        :param path: path of the file
+        :param frame: frame to be written, by default a new frame is read
+        :param params: OpenCV encoding parameters, see image_writer.FORMATS
+        :return: -
+        """
         if frame is None:
             frame = self.get_frame()
-        cv2.imwrite(filename=path, img=frame)
+        if not cv2.imwrite(path, frame, list(params)):
+            raise IOError(f"Could not write frame: {path}")
 
-    def start_video(self, path: str, fps: int = None, fourcc: str = "H264"):
-        if self.__writer is not None:
+    def start_video(
+            self,
+            path: str,
+            fps: float = VIDEO_FPS,
+            fourcc: str = "MJPG",
+            queue_size: int = VIDEO_QUEUE_SIZE) -> VideoRecorder:
+        """Start recording the frames of the camera into a video file
+
+        The recording runs in the background and does not slow down the other users of the camera.
+        :param path: path of the video file, for example an .avi file for MJPG
+        :param fps: frame rate of the video
+        :param fourcc: codec, see cv2.VideoWriter_fourcc()
+        :param queue_size: number of frames waiting for the encoder, beyond which the frames are dropped
+        :return: recorder, which gives the statistics of the recording
+        """
+        if self.__recorder is not None:
             raise RuntimeError("Video recording is already active")
-        if len(fourcc) != 4:
-            raise ValueError(f"Invalid fourcc: {fourcc}")
-        fourcc: int = cv2.VideoWriter_fourcc(fourcc[0], fourcc[1], fourcc[2], fourcc[3])
-        self.__writer = cv2.VideoWriter(path, fourcc, fps)
+        self.__recorder = VideoRecorder(path, fps, fourcc, queue_size)
+        self._start_tap(self.__recorder.offer)
+        return self.__recorder
 
-    def stop_video(self):
-        if self.__writer is None:
+    def stop_video(self) -> tp.Optional[VideoStats]:
+        """Stop recording and close the video file
+
+        :return: statistics of the recording, or None if there was no recording
+        """
+        recorder = self.__recorder
+        if recorder is None:
+            return None
+        self._stop_tap()
+        self.__recorder = None
+        return recorder.stop()
+
+    def _start_tap(self, tap: tp.Callable[[np.ndarray, float], tp.Any]) -> None:
+        """Start giving every new frame and its timestamp to the given function
+
+        By default the frames are read in a thread of their own. The cameras that read the frames in the background
+        anyway should give those frames instead.
+        :param tap: function that takes a frame and its time.monotonic() timestamp and does not keep the frame
+        :return: -
+        """
+        self.__tap_stop.clear()
+
+        def run() -> None:
+            frame = None
+            while not self.__tap_stop.is_set():
+                try:
+                    frame = self.get_frame(output_array=frame)
+                except IOError as e:
+                    logger.error("Reading frames for the video failed: %s", e)
+                    return
+                tap(frame, time.monotonic())
+
+        self.__tap_thread = threading.Thread(target=run, name="frame_tap", daemon=True)
+        self.__tap_thread.start()
+
+    def _stop_tap(self) -> None:
+        if self.__tap_thread is not None:
+            self.__tap_stop.set()
+            self.__tap_thread.join()
+            self.__tap_thread = None
+
+
+class FrameGrabber:
+    """Reads frames continuously in a background thread into a ring buffer of preallocated frames
+
+    The consumers get copies of the buffered frames and never touch the camera driver, so they don't block each
+    other or the acquisition. The timestamps are from time.monotonic() and are taken when a frame has been read.
+    """
+    def __init__(self, read: tp.Callable[[tp.Optional[np.ndarray]], np.ndarray], buffer_size: int = 8):
+        """
+        :param read: function that reads a frame into the given array, or into a new array if given None
+        :param buffer_size: number of frames in the ring buffer
+        """
+        if buffer_size < 2:
+            raise ValueError(f"The buffer must have at least 2 frames, got {buffer_size}")
+        self.__read = read
+        self.__buffer_size = buffer_size
+        self.__frames: tp.List[np.ndarray] = []
+        self.__timestamps = np.zeros(buffer_size)
+        # Number of frames read so far, the latest frame is number count - 1
+        self.__count = 0
+        self.__error: tp.Optional[Exception] = None
+        # Consecutive frames requested by the consumers as [frames, timestamps, number of the first frame]
+        self.__requests: tp.List[tp.List] = []
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__thread: tp.Optional[threading.Thread] = None
+        # Function that is given every frame and its timestamp in the grabber thread, for example for recording
+        self.tap: tp.Optional[tp.Callable[[np.ndarray, float], tp.Any]] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    @property
+    def buffer_size(self) -> int:
+        return self.__buffer_size
+
+    @property
+    def frame_shape(self) -> tp.Optional[tp.Tuple[int, ...]]:
+        return self.__frames[0].shape if self.__frames else None
+
+    @property
+    def count(self) -> int:
+        """Number of frames read since the start"""
+        with self.__condition:
+            return self.__count
+
+    def start(self) -> None:
+        if self.__running:
             return
-        self.__writer.release()
+        # The first frame determines the shape of the buffer
+        first = self.__read(None)
+        self.__frames = [first] + [np.empty_like(first) for _ in range(self.__buffer_size - 1)]
+        with self.__condition:
+            self.__timestamps[0] = time.monotonic()
+            self.__count = 1
+            self.__error = None
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="frame_grabber", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def __run(self) -> None:
+        fps_start_time = time.monotonic()
+        fps_count = self.__count
+        while self.__running:
+            # The slot being written is not accessible to the consumers, since it contains the oldest frame
+            index = self.__count % self.__buffer_size
+            try:
+                frame = self.__read(self.__frames[index])
+            except (IOError, cv2.error) as e:
+                logger.error("Frame grabbing failed: %s", e)
+                with self.__condition:
+                    self.__error = e
+                    self.__running = False
+                    self.__condition.notify_all()
+                return
+            if frame is not self.__frames[index]:
+                # The driver did not write into the given array, for example because the frame size changed
+                self.__frames[index] = frame
+            with self.__condition:
+                self.__timestamps[index] = time.monotonic()
+                # The requested frames are copied here, so slow consumers don't miss any
+                for frames, timestamps, first in self.__requests:
+                    if 0 <= self.__count - first < len(frames):
+                        frames[self.__count - first] = frame
+                        timestamps[self.__count - first] = self.__timestamps[index]
+                self.__count += 1
+                self.__condition.notify_all()
+            tap = self.tap
+            if tap is not None:
+                # The frame is not overwritten before this thread reads the next frame into its slot
+                tap(frame, self.__timestamps[index])
+
+            if self.__count - fps_count >= 100:
+                now = time.monotonic()
+                logger.debug("Grabbing at %.1f fps", (self.__count - fps_count) / (now - fps_start_time))
+                fps_start_time = now
+                fps_count = self.__count
+
+    def __wait_for(self, number: int, timeout: tp.Optional[float]) -> None:
+        """Wait until the given frame has been read, the condition must be held"""
+        if not self.__condition.wait_for(lambda: self.__count > number or not self.__running, timeout):
+            raise TimeoutError(f"No frame from the camera within {timeout} s")
+        if self.__count <= number:
+            if self.__error is not None:
+                raise IOError(f"Frame grabbing failed: {self.__error}")
+            raise IOError("Frame grabbing has been stopped")
+
+    def __copy(self, number: int, out: tp.Optional[np.ndarray] = None) -> tp.Tuple[np.ndarray, float]:
+        """Copy a frame from the buffer, the condition must be held"""
+        # The newest slot is being overwritten by the grabber thread
+        if number <= self.__count - self.__buffer_size:
+            raise IOError(f"Frame {number} has already been overwritten")
+        index = number % self.__buffer_size
+        if out is None:
+            out = self.__frames[index].copy()
+        else:
+            np.copyto(out, self.__frames[index])
+        return out, float(self.__timestamps[index])
+
+    def latest(self, out: tp.Optional[np.ndarray] = None) -> tp.Tuple[np.ndarray, float]:
+        """The most recent frame
+
+        :param out: array to copy the frame into
+        :return: frame and its timestamp
+        """
+        with self.__condition:
+            if not self.__count:
+                self.__wait_for(0, None)
+            return self.__copy(self.__count - 1, out)
+
+    def next_after(
+            self,
+            timestamp: float,
+            timeout: tp.Optional[float] = 5,
+            out: tp.Optional[np.ndarray] = None) -> tp.Tuple[np.ndarray, float]:
+        """The first frame that has been read after the given time
+
+        :param timestamp: time from time.monotonic()
+        :param timeout: maximum waiting time in seconds
+        :param out: array to copy the frame into
+        :return: frame and its timestamp
+        """
+        with self.__condition:
+            number = self.__count - 1
+            # Search the buffered frames backwards for the oldest one that is new enough
+            while number > self.__count - self.__buffer_size + 1 and number > 0 \
+                    and self.__timestamps[(number - 1) % self.__buffer_size] > timestamp:
+                number -= 1
+            if self.__timestamps[number % self.__buffer_size] <= timestamp:
+                number = self.__count
+                self.__wait_for(number, timeout)
+            return self.__copy(number, out)
+
+    def consecutive(self, n: int, timeout: tp.Optional[float] = 5) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """The next n frames without skipping any
+
+        :param n: number of frames
+        :param timeout: maximum waiting time for each frame in seconds
+        :return: array of the frames with the shape (n, height, width[, channels]) and their timestamps
+        """
+        with self.__condition:
+            if not self.__frames:
+                self.__wait_for(0, None)
+            first = self.__count
+            frames = np.empty((n,) + self.__frames[0].shape, dtype=self.__frames[0].dtype)
+            timestamps = np.empty(n)
+            request = [frames, timestamps, first]
+            self.__requests.append(request)
+            try:
+                for i in range(n):
+                    self.__wait_for(first + i, timeout)
+            finally:
+                self.__requests.remove(request)
+        return frames, timestamps
@@ -0,0 +1,127 @@
+"""This module provides synchronized acquisition from several cameras
+
+The cameras of a group are read in parallel threads, so capturing from all of them at a stage position takes about as
+long as capturing from the slowest one. The first camera is the primary one, the pictures of which are named as
+before, and the pictures of the other cameras are written into a subdirectory named after the camera.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import concurrent.futures
+import logging
+import os.path
+import time
+import typing as tp
+
+import numpy as np
+
+from devices import camera
+
+logger = logging.getLogger(__name__)
+
+
+class GroupFrame(tp.NamedTuple):
+    frame: np.ndarray
+    # time.monotonic() of the frame from the frame grabber of the camera, or when the read began
+    timestamp: float
+
+
+class CameraGroup:
+    """Cameras that are read together"""
+    def __init__(self, cameras: tp.Mapping[str, camera.Camera]):
+        """
+        :param cameras: name -> camera, the first one is the primary camera
+        """
+        if not cameras:
+            raise ValueError("A camera group needs at least one camera")
+        for name in cameras:
+            if not name or os.path.basename(name) != name:
+                raise ValueError(f"Invalid camera name: {name}")
+        self.__cameras = dict(cameras)
+        self.__primary = next(iter(self.__cameras))
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(self.__cameras), thread_name_prefix="camera_group")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.__cameras)
+
+    def __getitem__(self, name: str) -> camera.Camera:
+        return self.__cameras[name]
+
+    @property
+    def names(self) -> tp.List[str]:
+        return list(self.__cameras)
+
+    @property
+    def primary(self) -> str:
+        """Name of the primary camera"""
+        return self.__primary
+
+    def grab(self, n: int = 1, method: str = "mean") -> tp.Dict[str, GroupFrame]:
+        """Read a frame from every camera at the same time
+
+        :param n: number of frames to average for each camera
+        :param method: averaging method, see camera.Camera.average_frames()
+        :return: name -> frame and its timestamp
+        """
+        def read(cam: camera.Camera) -> GroupFrame:
+            start_time = time.monotonic()
+            if n <= 1 and getattr(cam, "grabbing", False):
+                # The grabber stamps the frame as soon as it has been read, not when this thread gets it
+                return GroupFrame(*cam.get_frame_after(start_time))
+            frame = cam.get_frame() if n <= 1 else cam.average_frames(n, method=method)
+            return GroupFrame(frame, start_time)
+
+        if len(self.__cameras) == 1:
+            return {self.__primary: read(self.__cameras[self.__primary])}
+        futures = {name: self.__executor.submit(read, cam) for name, cam in self.__cameras.items()}
+        # Wait for all the cameras before raising an error, so that no read is left running
+        concurrent.futures.wait(futures.values())
+        frames = {name: future.result() for name, future in futures.items()}
+        timestamps = [frame.timestamp for frame in frames.values()]
+        logger.debug("Read %d cameras within %.3f s of each other", len(frames), max(timestamps) - min(timestamps))
+        return frames
+
+    def tile_path(self, path: str, name: str) -> str:
+        """Path of the picture of a camera
+
+        The pictures of the primary camera keep their path, so the stitching works as with a single camera.
+        The others are put in a subdirectory, and the camera name is prefixed to the file name.
+        :param path: path of the picture of the primary camera
+        :param name: name of the camera
+        :return: path of the picture of the camera
+        """
+        if name not in self.__cameras:
+            raise KeyError(f"Unknown camera: {name}")
+        if name == self.__primary:
+            return path
+        directory, filename = os.path.split(path)
+        return os.path.join(directory, name, f"{name}_{filename}")
+
+    def close(self, close_cameras: bool = False) -> None:
+        """Stop the threads
+
+        :param close_cameras: whether to also close the cameras that have a close() method, otherwise they are left open
+        :return: -
+        """
+        self.__executor.shutdown(wait=True)
+        if not close_cameras:
+            return
+        for name, cam in self.__cameras.items():
+            close = getattr(cam, "close", None)
+            if close is None:
+                continue
+            try:
+                close()
+            except (IOError, ValueError) as e:
+                logger.warning("Could not close camera %s: %s", name, e)
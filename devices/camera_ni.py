@@ -1,4 +1,8 @@
-"""This module provides NI Vision / IMAQdx camera support for ORC Dark Spot Mapper"""
+"""This module provides NI Vision / IMAQdx camera support for ORC Dark Spot Mapper
+
+The frames are accessed directly in the buffer of the IMAQ image as a NumPy view, so no intermediate images or
+conversions are needed. The camera is mounted upside down, which is corrected by reversing both axes of the view.
+"""
 
 __author__ = "Mika Mäki"
 __copyright__ = "Copyright 2016-2020, Tampere University"
@@ -7,14 +11,16 @@ __maintainer__ = "Mika Mäki"
 __email__ = "mika.maki@tuni.fi"
 
 import atexit
+import ctypes
 import enum
 import logging
 import os.path
+import threading
 import time
+import typing as tp
 
-# import matplotlib.image
 import nivision
-import PIL.Image
+import numpy as np
 
 from . import camera
 
@@ -31,15 +37,39 @@ class CameraSettings(str, enum.Enum):
     SHUTTER = "Shutter"
 
 
-class NI_Camera:
+def image_info(image) -> nivision.ImageInfo:
+    info = nivision.ImageInfo()
+    nivision.imaqGetImageInfo(image, ctypes.byref(info))
+    return info
+
+
+def image_view(info: nivision.ImageInfo) -> np.ndarray:
+    """NumPy view of the pixels of an 8-bit IMAQ image
+
+    The view is valid until the image is resized or disposed.
+    :param info: information of an IMAQ_IMAGE_U8 image from image_info()
+    :return: array of shape (height, width)
+    """
+    if not info.imageStart:
+        raise IOError("The image has no pixels")
+    # The lines are padded to pixelsPerLine, and the image may have a border around it
+    size = info.pixelsPerLine * (info.yRes - 1) + info.xRes
+    buffer = (ctypes.c_uint8 * size).from_address(info.imageStart)
+    return np.ndarray((info.yRes, info.xRes), dtype=np.uint8, buffer=buffer, strides=(info.pixelsPerLine, 1))
+
+
+class NI_Camera(camera.Camera):
     """API for a NI Vision / IMAQdx FireWire camera"""
-    def __init__(self, cam_name: str, cam_quality: int):
-        # super().__init__(cam_name)
+    def __init__(self, cam_name: str, cam_quality: int = 10000):
+        """
+        :param cam_name: IMAQdx name of the camera, for example cam0
+        :param cam_quality: not used, the pictures are written with OpenCV as with the other cameras
+        """
+        super().__init__(cam_name)
         self.__cam_name = bytes(cam_name, encoding="ascii")
         self.__cam_quality = cam_quality
-
-        # Ensuring that the camera is closed after use
-        atexit.register(self.close_camera)
+        # IMAQdx sessions are not thread-safe, and the view of a frame is valid only until the next grab
+        self.__lock = threading.Lock()
 
         logger.info("Opening camera. This may take a while.")
         try:
@@ -54,14 +84,17 @@ class NI_Camera:
             logger.exception(e)
             raise IOError(f"Could not connect to camera {cam_name}: {e}")
 
-        # Initialise image objects
-        self.__img_frame = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
-        self.__img_frame_flipped = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
-        self.__img_frame_flipped2 = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
+        # Ensuring that the camera is closed after use
+        atexit.register(self.close_camera)
 
-        self.__img_pic = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
-        self.__img_pic_flipped = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
-        self.__img_pic_flipped2 = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
+        # The frames are grabbed into the same image, the buffer of which is reused by IMAQdx
+        self.__img_frame = nivision.imaqCreateImage(nivision.IMAQ_IMAGE_U8)
+        self.__view: tp.Optional[np.ndarray] = None
+        self.__view_key: tp.Optional[tp.Tuple[int, int, int, int]] = None
+        # The first frame gives the resolution
+        with self.__lock:
+            self.__grab()
+        logger.info("Camera resolution is %dx%d", *self.resolution)
 
     def close_camera(self) -> None:
         """
@@ -75,34 +108,70 @@ class NI_Camera:
             logger.exception(e)
             logger.error(f"Closing camera failed: {e}")
             raise e
+        finally:
+            atexit.unregister(self.close_camera)
 
     def set_cam_setting(self, name: CameraSettings, value: int) -> None:
         full_name = f"CameraAttributes::{name}::Value"
         try:
-            nivision.IMAQdxSetAttribute(self.__camid, bytes(full_name, encoding="ascii"), value)
+            with self.__lock:
+                nivision.IMAQdxSetAttribute(self.__camid, bytes(full_name, encoding="ascii"), value)
         except (nivision.ImaqError, nivision.ImaqDxError) as e:
             logger.exception(e)
             error_text = f"Setting value {value} for {name} resulted in error {e}"
             logger.error(error_text)
             raise IOError(error_text)
 
-    def take_pic(self):
+    @property
+    def resolution(self) -> tp.Tuple[int, int]:
+        """(width, height) of the frames"""
+        return self.__view.shape[1], self.__view.shape[0]
+
+    def __grab(self) -> np.ndarray:
+        """Grab a frame into the IMAQ image, the lock must be held
+
+        :return: view of the frame in the correct orientation, valid until the next grab
+        """
+        try:
+            nivision.IMAQdxGrab(self.__camid, self.__img_frame, 1)
+            info = image_info(self.__img_frame)
+        except (nivision.ImaqError, nivision.ImaqDxError) as e:
+            raise IOError(f"Could not grab a frame: {e}") from e
+        # The buffer is normally reused, and the view is recreated only if it has been reallocated
+        key = (info.imageStart, info.xRes, info.yRes, info.pixelsPerLine)
+        if key != self.__view_key:
+            self.__view = image_view(info)
+            self.__view_key = key
+        # Both axes are reversed without copying instead of flipping the image twice
+        return self.__view[::-1, ::-1]
+
+    def grab_view(self) -> np.ndarray:
+        """Grab a frame without copying it
+
+        The returned array is a read-only view of the IMAQ buffer, which the next grab overwrites, so it is suitable
+        only for consuming the frame immediately, for example for displaying it. Use get_frame() to keep the frame.
+        :return: frame
+        """
+        with self.__lock:
+            view = self.__grab()
+        view.flags.writeable = False
+        return view
+
+    def get_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        with self.__lock:
+            view = self.__grab()
+            if output_array is None or output_array.shape != view.shape or output_array.dtype != view.dtype:
+                output_array = np.empty(view.shape, dtype=view.dtype)
+            # The only copy of the frame
+            np.copyto(output_array, view)
+        return output_array
+
+    def latest_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        return self.get_frame(output_array)
+
+    def take_pic(self) -> np.ndarray:
         """Captures a single frame"""
-        nivision.IMAQdxGrab(self.__camid, self.__img_frame, 0)
-        nivision.imaqFlip(self.__img_frame_flipped, self.__img_frame, nivision.IMAQ_HORIZONTAL_AXIS)
-        nivision.imaqFlip(self.__img_frame_flipped2, self.__img_frame_flipped, nivision.IMAQ_VERTICAL_AXIS)
-
-        # This does not work due to a memory leak at nivision.imaqImageToArray()
-        imgdata = nivision.imaqImageToArray(self.__img_frame_flipped2)
-        imgbytes = imgdata[0]
-        pilimg = PIL.Image.frombytes("L", (1280, 960), imgbytes)
-        # matimg = matplotlib.image.pil_to_array(img)
-
-        # The image is saved on a RAM disk since the transfer of the image from NI Vision to Python as shown above
-        # would result in a memory leak
-        # The RAM disk is not provided by this program and thereby has to be set up separately
-        # nivision.imaqWritePNGFile(self.__img_frame_flipped2, b"R:\\nivisiontemp.png", self.__cam_quality)
-        return pilimg
+        return self.get_frame()
 
     def save_pic(self, directory: str, filename: str, log: bool = True) -> None:
         """Takes a picture to the hard drive"""
@@ -111,16 +180,16 @@ class NI_Camera:
         elif not filename:
             raise ValueError(f"Invalid filename: {filename}")
 
-        nivision.IMAQdxGrab(self.__camid, self.__img_pic, 1)
-        nivision.imaqFlip(self.__img_pic_flipped, self.__img_pic, nivision.IMAQ_HORIZONTAL_AXIS)
-        nivision.imaqFlip(self.__img_pic_flipped2, self.__img_pic_flipped, nivision.IMAQ_VERTICAL_AXIS)
-
         path = f"{os.path.join(directory, filename)}.png"
 
         if log:
             logger.info("Taking picture %s", path)
 
-        nivision.imaqWritePNGFile(self.__img_pic_flipped2, bytes(path, encoding="ascii"), self.__cam_quality)
+        frame = self.acquire_frame()
+        try:
+            self.save_frame(path, frame)
+        finally:
+            self.release_frame(frame)
 
 
 if __name__ == "__main__":
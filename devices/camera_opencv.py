@@ -4,12 +4,23 @@
 # https://support.microsoft.com/en-us/help/2977003/the-latest-supported-visual-c-downloads
 
 import enum
+import json
+import logging
+import os.path
+import threading
+import time
+import typing as tp
 
 import cv2
 import numpy as np
 
 from devices import camera
 
+logger = logging.getLogger(__name__)
+
+# Named settings profiles are stored here as NAME.json
+PROFILE_DIR = "camera_profiles"
+
 
 @enum.unique
 class VideoCaptureProperties(enum.IntEnum):
@@ -74,30 +85,118 @@ class CameraCV(camera.Camera):
         self._cam = cv2.VideoCapture(address)
         if not self._cam.isOpened():
             raise IOError(f"Could not open OpenCV camera with address {address}")
+        # VideoCapture is not thread-safe
+        self._cam_lock = threading.Lock()
+        self._grabber: tp.Optional[camera.FrameGrabber] = None
+        # Function that the grabbed frames are given to, see camera.Camera._start_tap()
+        self._tap: tp.Optional[tp.Callable[[np.ndarray, float], tp.Any]] = None
+        # Last known property values, since each query or setting is a round trip to the camera
+        self._props: tp.Dict[Props, float] = {}
 
     def __del__(self):
+        self.stop_grabbing()
         if hasattr(self, "_cam"):
             self._cam.release()
 
-    # Camera property control
+    def close(self) -> None:
+        """Stop grabbing and release the camera"""
+        self.stop_grabbing()
+        with self._cam_lock:
+            self._cam.release()
 
-    def get_prop(self, prop: Props) -> float:
-        return self._cam.get(prop)
+    # Camera property control
 
-    def set_prop(self, prop: Props, value) -> None:
-        ret: bool = self._cam.set(prop, value)
+    def get_prop(self, prop: Props, refresh: bool = False) -> float:
+        """Get the value of a property
+
+        :param prop: property
+        :param refresh: query the camera even if the value is known, for example for properties that the camera
+            adjusts by itself
+        :return: value
+        """
+        if not refresh and prop in self._props:
+            return self._props[prop]
+        with self._cam_lock:
+            value = self._cam.get(prop)
+        self._props[prop] = value
+        return value
+
+    def set_prop(self, prop: Props, value, force: bool = False) -> bool:
+        """Set the value of a property if it has changed
+
+        :param prop: property
+        :param value: new value
+        :param force: send the value even if it is the same as the last known value
+        :return: whether the value was sent to the camera
+        """
+        if not force and self._props.get(prop) == value:
+            return False
+        with self._cam_lock:
+            ret: bool = self._cam.set(prop, value)
         if not ret:
-            raise ValueError("The property is not supported")
+            # The actual value is unknown
+            self._props.pop(prop, None)
+            raise ValueError(f"The property {prop.name} is not supported")
+        self._props[prop] = value
+        return True
+
+    def set_props(self, values: tp.Mapping[Props, float], force: bool = False) -> int:
+        """Set several properties at once, sending only the changed values
+
+        :param values: property -> value
+        :param force: send all the values
+        :return: number of values sent to the camera
+        """
+        start_time = time.perf_counter()
+        sent = 0
+        errors = []
+        for prop, value in values.items():
+            try:
+                sent += self.set_prop(prop, value, force)
+            except ValueError as e:
+                errors.append(str(e))
+        logger.info(
+            "Set %d of %d camera properties in %.1f ms", sent, len(values), (time.perf_counter() - start_time) * 1e3)
+        if errors:
+            raise ValueError(", ".join(errors))
+        return sent
+
+    def refresh_props(self) -> None:
+        """Forget the known property values, so they are queried from the camera again"""
+        self._props.clear()
 
     def set_prop_print(self, prop: Props, value) -> None:
-        old = self.get_prop(prop)
-        self.set_prop(prop, value)
-        new = self.get_prop(prop)
+        old = self.get_prop(prop, refresh=True)
+        self.set_prop(prop, value, force=True)
+        new = self.get_prop(prop, refresh=True)
         print(f"Property {prop.name} - old {old}, set {value}, new {new}")
 
-    def print_props(self):
+    def print_props(self, refresh: bool = False):
         for prop in Props:
-            print(f"{prop.name}: {self.get_prop(prop)}")
+            print(f"{prop.name}: {self.get_prop(prop, refresh)}")
+
+    # Settings profiles
+
+    def save_profile(self, name: str, props: tp.Iterable[Props], directory: str = PROFILE_DIR) -> str:
+        """Save the current values of the given properties as a named profile
+
+        :param name: name of the profile
+        :param props: properties to be saved
+        :param directory: directory of the profiles
+        :return: path of the profile
+        """
+        return save_profile(name, {prop: self.get_prop(prop) for prop in props}, directory)
+
+    def apply_profile(self, name: str, directory: str = PROFILE_DIR) -> tp.Dict[Props, float]:
+        """Set the properties of a named profile
+
+        :param name: name of the profile
+        :param directory: directory of the profiles
+        :return: the values of the profile
+        """
+        values = load_profile(name, directory)
+        self.set_props(values)
+        return values
 
     # Properties
 
@@ -109,25 +208,187 @@ class CameraCV(camera.Camera):
     def resolution(self):
         return self.get_prop(Props.FRAME_WIDTH), self.get_prop(Props.FRAME_HEIGHT)
 
-    # Public methods
+    @property
+    def grabbing(self) -> bool:
+        return self._grabber is not None and self._grabber.running
 
-    def get_frame(self, output_array=None) -> np.ndarray:
-        if output_array:
-            ret, frame = self._cam.read(output_array)
-        else:
-            ret, frame = self._cam.read()
+    @property
+    def frame_count(self) -> tp.Optional[int]:
+        """Number of frames grabbed so far, None if not grabbing"""
+        return self._grabber.count if self.grabbing else None
+
+    # Background acquisition
+
+    def _read(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        with self._cam_lock:
+            if output_array is not None:
+                ret, frame = self._cam.read(output_array)
+            else:
+                ret, frame = self._cam.read()
         if not ret:
             raise IOError("Could not read frame from the camera")
         return frame
 
-    def save_frame(self, path: str, frame: np.ndarray = None):
+    def start_grabbing(self, buffer_size: int = 8) -> None:
+        """Start reading frames continuously in a background thread
+
+        While grabbing, the frame methods return frames from a ring buffer instead of reading the camera directly,
+        so the live view and the measurements don't block each other.
+        :param buffer_size: number of frames in the ring buffer
+        :return: -
+        """
+        if self.grabbing:
+            return
+        self._grabber = camera.FrameGrabber(self._read, buffer_size)
+        self._grabber.tap = self._tap
+        self._grabber.start()
+
+    def stop_grabbing(self) -> None:
+        grabber = getattr(self, "_grabber", None)
+        if grabber is not None:
+            grabber.stop()
+            self._grabber = None
+
+    def _start_tap(self, tap: tp.Callable[[np.ndarray, float], tp.Any]) -> None:
+        # The frames are taken from the grabber thread, so recording does not read the camera
+        if self.grabbing:
+            self._tap = tap
+            self._grabber.tap = tap
+        else:
+            super()._start_tap(tap)
+
+    def _stop_tap(self) -> None:
+        self._tap = None
+        if self._grabber is not None:
+            self._grabber.tap = None
+        super()._stop_tap()
+
+    def latest_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        """The most recent frame, without waiting for a new one when grabbing
+
+        :param output_array: array to copy the frame into
+        :return: frame
+        """
+        if self.grabbing:
+            if output_array is not None and output_array.shape != self._grabber.frame_shape:
+                output_array = None
+            return self._grabber.latest(out=output_array)[0]
+        return self.get_frame(output_array)
+
+    def get_frame_after(self, timestamp: float, timeout: float = 5) -> tp.Tuple[np.ndarray, float]:
+        """The first frame read after the given time, requires grabbing
+
+        :param timestamp: time from time.monotonic()
+        :param timeout: maximum waiting time in seconds
+        :return: frame and its timestamp
+        """
+        if not self.grabbing:
+            raise RuntimeError("Frame grabbing is not active")
+        return self._grabber.next_after(timestamp, timeout)
+
+    def frames(self, n: int) -> tp.Iterator[np.ndarray]:
+        if not self.grabbing:
+            yield from super().frames(n)
+            return
+        # The grabber reads the next frame while the previous one is being processed
+        frame = None
+        timestamp = time.monotonic()
+        for _ in range(n):
+            frame, timestamp = self._grabber.next_after(timestamp, out=frame)
+            yield frame
+
+    def get_frames(self, n: int, timeout: float = 5) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """The next n consecutive frames
+
+        :param n: number of frames
+        :param timeout: maximum waiting time for each frame in seconds, used only when grabbing
+        :return: array of the frames and their timestamps
+        """
+        if self.grabbing:
+            return self._grabber.consecutive(n, timeout)
+        frames = None
+        timestamps = np.empty(n)
+        for i in range(n):
+            frame = self._read()
+            timestamps[i] = time.monotonic()
+            if frames is None:
+                frames = np.empty((n,) + frame.shape, dtype=frame.dtype)
+            frames[i] = frame
+        return frames, timestamps
+
+    # Public methods
+
+    def get_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        if self.grabbing:
+            if output_array is not None and output_array.shape != self._grabber.frame_shape:
+                output_array = None
+            # A frame that has been read after the call, as when reading the camera directly
+            return self._grabber.next_after(time.monotonic(), out=output_array)[0]
+        return self._read(output_array)
+
+    def save_frame(self, path: str, frame: np.ndarray = None, params: tp.Sequence[int] = ()):
+        """Write a frame, the format is determined by the file extension
+
+        :param path: path of the file
+        :param frame: frame to be written, by default a new frame is read
+        :param params: OpenCV encoding parameters, see image_writer.FORMATS
+        :return: -
+        """
         if frame is None:
             frame = self.get_frame()
-        cv2.imwrite(filename=path, img=frame)
+        if not cv2.imwrite(path, frame, list(params)):
+            raise IOError(f"Could not write frame: {path}")
 
     def set_resolution(self, width: int, height: int):
+        # The ring buffer has to be reallocated for the new frame size
+        buffer_size = self._grabber.buffer_size if self.grabbing else None
+        self.stop_grabbing()
         self.set_prop(Props.FRAME_WIDTH, width)
         self.set_prop(Props.FRAME_HEIGHT, height)
+        if buffer_size is not None:
+            self.start_grabbing(buffer_size)
+
+
+def profile_path(name: str, directory: str = PROFILE_DIR) -> str:
+    if not name or os.path.basename(name) != name:
+        raise ValueError(f"Invalid profile name: {name}")
+    return os.path.join(directory, f"{name}.json")
+
+
+def save_profile(name: str, values: tp.Mapping[Props, float], directory: str = PROFILE_DIR) -> str:
+    """Save property values as a named profile
+
+    :param name: name of the profile
+    :param values: property -> value
+    :param directory: directory of the profiles
+    :return: path of the profile
+    """
+    path = profile_path(name, directory)
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({prop.name: value for prop, value in values.items()}, file, indent=4)
+    return path
+
+
+def load_profile(name: str, directory: str = PROFILE_DIR) -> tp.Dict[Props, float]:
+    """Load the property values of a named profile
+
+    :param name: name of the profile
+    :param directory: directory of the profiles
+    :return: property -> value
+    """
+    with open(profile_path(name, directory)) as file:
+        data = json.load(file)
+    try:
+        return {Props[prop]: value for prop, value in data.items()}
+    except KeyError as e:
+        raise ValueError(f"Unknown property in profile {name}: {e}") from e
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> tp.List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.splitext(file)[0] for file in os.listdir(directory) if file.endswith(".json"))
 
 
 def __test():
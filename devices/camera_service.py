@@ -0,0 +1,387 @@
+"""This module provides a camera service process for ORC Dark Spot Mapper
+
+Opening a FireWire camera takes several seconds. The service keeps the camera open across restarts of the GUI:
+it reads the frames continuously into shared memory, and the clients control the camera through a local socket.
+A client starts the service if it is not already running, and the service keeps running after the client exits.
+
+The service can also be started by hand:
+    python -m devices.camera_service
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import argparse
+import builtins
+import logging
+import os
+import os.path
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import typing as tp
+from multiprocessing import connection
+
+import numpy as np
+
+from devices import camera
+from devices import camera_opencv
+from devices import shared_frames
+
+logger = logging.getLogger(__name__)
+
+ADDRESS = ("localhost", 6001)
+# The clients authenticate with a random key that only the user can read, since the service unpickles the requests
+AUTHKEY_PATH = os.path.join(os.path.expanduser("~"), ".dark_spot_mapper_camera.key")
+AUTHKEY_BYTES = 32
+# Maximum time for the service to start, including opening the camera
+START_TIMEOUT = 60
+
+# Methods of CameraCV that the clients may call
+_COMMANDS = {
+    "get_prop", "set_prop", "set_props", "refresh_props", "set_resolution", "save_profile", "apply_profile",
+}
+
+
+def load_authkey(path: tp.Optional[str] = None) -> bytes:
+    """Read the key of the camera service, creating it if it does not exist
+
+    :param path: path of the key file, by default AUTHKEY_PATH
+    :return: key
+    """
+    if path is None:
+        path = AUTHKEY_PATH
+    try:
+        # The file is created readable by the user only, and an existing file is never replaced
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as file:
+            file.write(secrets.token_bytes(AUTHKEY_BYTES))
+    if sys.platform != "win32" and os.stat(path).st_mode & 0o077:
+        raise PermissionError(f"The key of the camera service can be read by other users: {path}")
+    # Another process may have created the file just before and not written the key yet
+    for _ in range(10):
+        with open(path, "rb") as file:
+            key = file.read()
+        if len(key) == AUTHKEY_BYTES:
+            return key
+        time.sleep(0.05)
+    raise IOError(f"Invalid key of the camera service: {path}")
+
+
+def _error_from(type_name: str, message: str) -> Exception:
+    """Error of the service to be raised in the client
+
+    :param type_name: name of the type of the error in the service
+    :param message: message of the error
+    :return: a built-in error of the same type, or an IOError if the type is not built in
+    """
+    error_type = getattr(builtins, type_name, None)
+    if isinstance(error_type, type) and issubclass(error_type, Exception):
+        return error_type(message)
+    return IOError(f"{type_name}: {message}")
+
+
+class CameraService:
+    """Owns the camera and publishes its frames in shared memory"""
+    def __init__(self, cam: camera_opencv.CameraCV, address=ADDRESS, authkey: tp.Optional[bytes] = None):
+        """
+        :param cam: opened camera
+        :param address: address for the clients
+        :param authkey: key that the clients have to know, by default the key from load_authkey()
+        """
+        if authkey is None:
+            authkey = load_authkey()
+        self.__cam = cam
+        self.__authkey = authkey
+        self.__listener = connection.Listener(address, authkey=authkey)
+        self.__buffer: tp.Optional[shared_frames.SharedFrameBuffer] = None
+        self.__buffer_lock = threading.Lock()
+        self.__running = True
+        self.__error: tp.Optional[str] = None
+
+    def serve_forever(self) -> None:
+        publisher = threading.Thread(target=self.__publish, name="publisher", daemon=True)
+        publisher.start()
+        logger.info("Camera service listening on %s", self.__listener.address)
+        while self.__running:
+            try:
+                conn = self.__listener.accept()
+            except (OSError, EOFError, connection.AuthenticationError) as e:
+                if self.__running:
+                    logger.warning("Rejected a client: %s", e)
+                continue
+            threading.Thread(target=self.__handle, args=(conn,), name="client", daemon=True).start()
+        publisher.join()
+        self.__listener.close()
+        with self.__buffer_lock:
+            if self.__buffer is not None:
+                self.__buffer.close()
+                self.__buffer = None
+
+    def __publish(self) -> None:
+        """Read the frames directly into the shared memory"""
+        while self.__running:
+            with self.__buffer_lock:
+                if self.__buffer is None:
+                    try:
+                        frame = self.__cam.get_frame()
+                    except IOError as e:
+                        self.__error = str(e)
+                        logger.error("Reading the camera failed: %s", e)
+                        time.sleep(1)
+                        continue
+                    self.__buffer = shared_frames.SharedFrameBuffer(shape=frame.shape, dtype=frame.dtype)
+                    self.__buffer.write(frame)
+                    logger.info("Publishing %s frames in %s", frame.shape, self.__buffer.name)
+                    continue
+                buffer = self.__buffer
+            slot = buffer.begin_write()
+            try:
+                frame = self.__cam.get_frame(output_array=slot)
+            except IOError as e:
+                self.__error = str(e)
+                logger.error("Reading the camera failed: %s", e)
+                time.sleep(1)
+                continue
+            self.__error = None
+            if frame.shape == slot.shape and frame.dtype == slot.dtype:
+                if frame is not slot:
+                    np.copyto(slot, frame)
+                buffer.end_write()
+            else:
+                # The frame size has changed, so the clients are given a new buffer
+                with self.__buffer_lock:
+                    buffer.close()
+                    self.__buffer = None
+
+    def __buffer_name(self) -> str:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with self.__buffer_lock:
+                if self.__buffer is not None:
+                    return self.__buffer.name
+            time.sleep(0.01)
+        raise IOError(f"The camera does not give frames: {self.__error}")
+
+    def __wake(self) -> None:
+        try:
+            connection.Client(self.__listener.address, authkey=self.__authkey).close()
+        except OSError:
+            pass
+
+    def __handle(self, conn: connection.Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    command, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if command == "buffer":
+                        result = self.__buffer_name()
+                    elif command == "resolution":
+                        result = self.__cam.resolution
+                    elif command == "backend_name":
+                        result = self.__cam.backend_name
+                    elif command == "ping":
+                        result = True
+                    elif command == "shutdown":
+                        self.__running = False
+                        # Wake up the accept() call
+                        threading.Thread(target=self.__wake, daemon=True).start()
+                        result = True
+                    elif command in _COMMANDS:
+                        result = getattr(self.__cam, command)(*args, **kwargs)
+                    else:
+                        raise ValueError(f"Unknown command: {command}")
+                except Exception as e:  # pylint: disable=broad-except
+                    # The error is raised in the client. Not all errors can be pickled, so only the type and the
+                    # message are sent.
+                    conn.send((False, (type(e).__name__, str(e))))
+                    continue
+                conn.send((True, result))
+
+
+class CameraClient(camera.Camera):
+    """Camera served by the camera service process
+
+    The frames are read from shared memory, and the other methods are forwarded to the CameraCV of the service.
+    """
+    def __init__(
+            self,
+            address=ADDRESS,
+            authkey: tp.Optional[bytes] = None,
+            start: bool = True,
+            camera_address: int = 0,
+            timeout: float = START_TIMEOUT):
+        """
+        :param address: address of the service
+        :param authkey: key of the service, by default the key from load_authkey()
+        :param start: start the service if it is not running
+        :param camera_address: OpenCV address of the camera, used when starting the service
+        :param timeout: maximum time for the service to start in seconds
+        """
+        super().__init__(address)
+        if authkey is None:
+            authkey = load_authkey()
+        self.__lock = threading.Lock()
+        try:
+            self.__conn = connection.Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if not start:
+                raise IOError(f"The camera service is not running at {address}")
+            self.__conn = self.__start_service(address, authkey, camera_address, timeout)
+        self.__buffer: tp.Optional[shared_frames.SharedFrameBuffer] = None
+        self.__attach()
+
+    @staticmethod
+    def __start_service(address, authkey: bytes, camera_address: int, timeout: float) -> connection.Connection:
+        logger.info("Starting the camera service")
+        args = [sys.executable, "-m", "devices.camera_service", "--camera", str(camera_address),
+                "--port", str(address[1])]
+        # The package is found from the directory of the program regardless of the working directory of the client
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # The service is detached, so it keeps running when the GUI exits or crashes
+        if sys.platform == "win32":
+            subprocess.Popen(
+                args, cwd=cwd, creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
+                close_fds=True)
+        else:
+            subprocess.Popen(args, cwd=cwd, start_new_session=True, close_fds=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return connection.Client(address, authkey=authkey)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise IOError(f"The camera service did not start within {timeout} s")
+                time.sleep(0.2)
+
+    def __call(self, command: str, *args, **kwargs):
+        with self.__lock:
+            try:
+                self.__conn.send((command, args, kwargs))
+                ok, result = self.__conn.recv()
+            except (EOFError, OSError) as e:
+                raise IOError(f"Lost the connection to the camera service: {e}") from e
+        if not ok:
+            raise _error_from(*result)
+        return result
+
+    def __attach(self) -> None:
+        if self.__buffer is not None:
+            self.__buffer.close()
+        self.__buffer = shared_frames.SharedFrameBuffer(self.__call("buffer"))
+
+    def close(self) -> None:
+        """Disconnect from the service, which keeps running"""
+        if self.__buffer is not None:
+            self.__buffer.close()
+            self.__buffer = None
+        self.__conn.close()
+
+    def shutdown_service(self) -> None:
+        """Stop the service, which closes the camera"""
+        self.__call("shutdown")
+        self.close()
+
+    # Frames
+
+    def __read(self, after: int, timeout: float, output_array: tp.Optional[np.ndarray]):
+        for _ in range(2):
+            if output_array is not None and output_array.shape != self.__buffer.shape:
+                output_array = None
+            try:
+                return self.__buffer.read(after, timeout, out=output_array)
+            except IOError:
+                if not self.__buffer.closed:
+                    raise
+                # The frame size has changed
+                self.__attach()
+                after = 0
+        raise IOError("The camera service keeps changing the frame buffer")
+
+    def get_frame(self, output_array: tp.Optional[np.ndarray] = None, timeout: float = 5) -> np.ndarray:
+        # A frame that has been read after the call
+        return self.__read(self.__buffer.latest, timeout, output_array)[0]
+
+    def latest_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        return self.__read(0, 5, output_array)[0]
+
+    def frames(self, n: int) -> tp.Iterator[np.ndarray]:
+        frame = None
+        number = self.__buffer.latest
+        for _ in range(n):
+            frame, number, _ = self.__read(number, 5, frame)
+            yield frame
+
+    # The service always grabs in the background
+    grabbing = True
+
+    @property
+    def frame_count(self) -> int:
+        """Number of frames published so far"""
+        return self.__buffer.latest
+
+    def start_grabbing(self, buffer_size: int = 8) -> None:
+        pass
+
+    def stop_grabbing(self) -> None:
+        pass
+
+    # Camera control
+
+    @property
+    def resolution(self):
+        return self.__call("resolution")
+
+    @property
+    def backend_name(self) -> str:
+        return self.__call("backend_name")
+
+    def get_prop(self, prop: camera_opencv.Props, refresh: bool = False) -> float:
+        return self.__call("get_prop", prop, refresh)
+
+    def set_prop(self, prop: camera_opencv.Props, value, force: bool = False) -> bool:
+        return self.__call("set_prop", prop, value, force)
+
+    def set_props(self, values: tp.Mapping[camera_opencv.Props, float], force: bool = False) -> int:
+        return self.__call("set_props", dict(values), force)
+
+    def refresh_props(self) -> None:
+        self.__call("refresh_props")
+
+    def set_resolution(self, width: int, height: int) -> None:
+        self.__call("set_resolution", width, height)
+        self.__attach()
+
+    def save_profile(self, name: str, props: tp.Iterable[camera_opencv.Props], **kwargs) -> str:
+        return self.__call("save_profile", name, list(props), **kwargs)
+
+    def apply_profile(self, name: str, **kwargs) -> tp.Dict[camera_opencv.Props, float]:
+        return self.__call("apply_profile", name, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a camera open and serve its frames")
+    parser.add_argument("--camera", type=int, default=0, help="OpenCV address of the camera")
+    parser.add_argument("--port", type=int, default=ADDRESS[1], help="port for the clients")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(module)-16s %(message)s')
+    start_time = time.perf_counter()
+    cam = camera_opencv.CameraCV(args.camera)
+    logger.info("Opening the camera took %.2f s", time.perf_counter() - start_time)
+    CameraService(cam, (ADDRESS[0], args.port)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
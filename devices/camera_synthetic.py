@@ -0,0 +1,262 @@
+"""This module provides a synthetic camera for testing without hardware
+
+The frames are cut from a large procedurally generated wafer image at the position of a simulated stage, so the
+whole measurement and stitching pipeline can be run and benchmarked on any computer. The frame rate, the noise and
+the latency of the camera can be adjusted to mimic a real camera.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import logging
+import threading
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+from devices import camera
+
+logger = logging.getLogger(__name__)
+
+# Stage steps per pixel, as in the measurements of DSM, where a 36000-step move is 760 pixels
+STEPS_PER_PIXEL = 36000 / 760
+# Number of precomputed noise frames, from which one is picked for each frame
+NOISE_FRAMES = 8
+# The noise frames are larger than the camera frames by this many pixels, and a randomly shifted part is used,
+# so that consecutive frames do not repeat the same noise
+NOISE_MARGIN = 64
+# Velocities of the simulated stage in steps/s, from stagecontrol
+VX = 255610.2362204725
+VY = 97375.3280839895
+
+
+def synthetic_wafer(
+        size: int = 8192,
+        spots: int = 3000,
+        chip_pitch: int = 500,
+        seed: int = 0) -> np.ndarray:
+    """Generate a grayscale image of a wafer with chips and dark spots
+
+    :param size: width and height of the image in pixels
+    :param spots: number of dark spots
+    :param chip_pitch: distance between the chips in pixels
+    :param seed: seed of the random generator, the same seed gives the same wafer
+    :return: image
+    """
+    rng = np.random.default_rng(seed)
+    center = size // 2
+    y, x = np.ogrid[:size, :size]
+    radius = np.sqrt((x - center) ** 2 + (y - center) ** 2, dtype=np.float32)
+    # A slightly uneven illumination
+    wafer = (200 - 30 * (radius / center) ** 2).astype(np.float32)
+    # Streets between the chips
+    streets = (x % chip_pitch < 12) | (y % chip_pitch < 12)
+    wafer[np.broadcast_to(streets, wafer.shape)] = 120
+    # Texture, so that the registration has something to match also inside the chips
+    texture = rng.normal(0, 6, (size // 8, size // 8)).astype(np.float32)
+    wafer += cv2.resize(texture, (size, size), interpolation=cv2.INTER_CUBIC)
+    for _ in range(spots):
+        cv2.circle(
+            wafer,
+            (int(rng.integers(size)), int(rng.integers(size))),
+            int(rng.integers(2, 12)),
+            float(rng.uniform(10, 60)),
+            thickness=-1,
+            lineType=cv2.LINE_AA
+        )
+    wafer[radius > center - 16] = 15
+    return np.clip(wafer, 0, 255).astype(np.uint8)
+
+
+class SimulatedStage:
+    """Stage that moves at a constant velocity without hardware
+
+    Has the movement methods of stagecontrol.StageControl that the measurements use.
+    """
+    def __init__(self, vx: float = VX, vy: float = VY, move_time: bool = True):
+        """
+        :param vx: velocity of the x axis in steps/s
+        :param vy: velocity of the y axis in steps/s
+        :param move_time: whether the moves take time, otherwise the stage jumps to the target
+        """
+        self.__vx = vx
+        self.__vy = vy
+        self.__move_time = move_time
+        self.__lock = threading.Lock()
+        self.__start = (0.0, 0.0)
+        self.__target = (0, 0)
+        self.__start_time = 0.0
+        self.__duration = 0.0
+
+    def where(self) -> tp.Tuple[int, int]:
+        """Target position of the current move, as with stagecontrol.StageControl"""
+        return self.__target
+
+    def position(self) -> tp.Tuple[float, float]:
+        """Actual position, which is between the start and the target during a move"""
+        with self.__lock:
+            if self.__duration <= 0:
+                return float(self.__target[0]), float(self.__target[1])
+            fraction = min((time.monotonic() - self.__start_time) / self.__duration, 1.0)
+            return tuple(
+                start + (target - start) * fraction for start, target in zip(self.__start, self.__target))
+
+    def time(self, x: float, y: float) -> float:
+        return max(abs(x) / self.__vx, abs(y) / self.__vy)
+
+    def goto(self, x: int, y: int) -> None:
+        start = self.position()
+        with self.__lock:
+            self.__start = start
+            self.__target = (x, y)
+            self.__start_time = time.monotonic()
+            self.__duration = self.time(x - start[0], y - start[1]) if self.__move_time else 0.0
+
+    def wait_until_settled(self) -> float:
+        """Wait until the stage has reached the target, as with stagecontrol.StageControl
+
+        :return: waiting time in seconds, zero if the moves take no time
+        """
+        with self.__lock:
+            remaining = self.__start_time + self.__duration - time.monotonic()
+        if remaining <= 0:
+            return 0.0
+        time.sleep(remaining)
+        return remaining
+
+    def reset_coords(self) -> None:
+        with self.__lock:
+            self.__start = (0.0, 0.0)
+            self.__target = (0, 0)
+            self.__duration = 0.0
+
+    def step_up(self, steps: int) -> bool:
+        self.goto(self.__target[0], self.__target[1] + steps)
+        return True
+
+    def step_down(self, steps: int) -> bool:
+        return self.step_up(-steps)
+
+    def step_right(self, steps: int) -> bool:
+        self.goto(self.__target[0] + steps, self.__target[1])
+        return True
+
+    def step_left(self, steps: int) -> bool:
+        return self.step_right(-steps)
+
+
+class SyntheticCamera(camera.Camera):
+    """Camera that gives the part of a synthetic wafer under the simulated stage"""
+    def __init__(
+            self,
+            wafer: tp.Optional[np.ndarray] = None,
+            position: tp.Optional[tp.Callable[[], tp.Tuple[float, float]]] = None,
+            resolution: tp.Tuple[int, int] = (1280, 960),
+            fps: tp.Optional[float] = 30,
+            noise: float = 2.0,
+            latency: float = 0.0,
+            channels: int = 3,
+            steps_per_pixel: float = STEPS_PER_PIXEL,
+            seed: int = 0):
+        """
+        :param wafer: grayscale image, by default synthetic_wafer()
+        :param position: function that gives the stage position in steps, for example SimulatedStage.position
+            The stage position (0, 0) is at the center of the wafer. By default the position is constant.
+        :param resolution: (width, height) of the frames
+        :param fps: maximum frame rate, None for unlimited
+        :param noise: standard deviation of the noise in gray levels
+        :param latency: delay of each frame in seconds, for example the transfer time of a real camera
+        :param channels: 1 for grayscale or 3 for BGR frames like those of an OpenCV camera
+        :param steps_per_pixel: stage steps per pixel
+        :param seed: seed of the noise
+        """
+        super().__init__("synthetic")
+        if channels not in (1, 3):
+            raise ValueError(f"Invalid channel count: {channels}")
+        self.wafer = synthetic_wafer() if wafer is None else wafer
+        self.__position = position if position is not None else lambda: (0, 0)
+        self.fps = fps
+        self.noise = noise
+        self.latency = latency
+        self.channels = channels
+        self.steps_per_pixel = steps_per_pixel
+        self.__rng = np.random.default_rng(seed)
+        self.__lock = threading.Lock()
+        self.__next_time = 0.0
+        self.__resolution = (0, 0)
+        self.__gray: tp.Optional[np.ndarray] = None
+        self.__noise: tp.List[np.ndarray] = []
+        self.set_resolution(*resolution)
+
+    @property
+    def resolution(self) -> tp.Tuple[int, int]:
+        return self.__resolution
+
+    def set_resolution(self, width: int, height: int) -> None:
+        with self.__lock:
+            self.__resolution = (width, height)
+            self.__gray = np.empty((height, width), dtype=np.uint8)
+            # Generating the noise is slower than reading a frame, so it is done in advance
+            self.__noise = [
+                self.__rng.normal(0, self.noise, (height + NOISE_MARGIN, width + NOISE_MARGIN)).astype(np.int16)
+                for _ in range(NOISE_FRAMES)
+            ] if self.noise > 0 else []
+
+    def pixel_position(self) -> tp.Tuple[int, int]:
+        """Top left corner of the current frame on the wafer image
+
+        :return: (x, y) in pixels
+        """
+        x, y = self.__position()
+        width, height = self.__resolution
+        return (
+            int(round(self.wafer.shape[1] / 2 + x / self.steps_per_pixel - width / 2)),
+            # The y axis of the stage points up
+            int(round(self.wafer.shape[0] / 2 - y / self.steps_per_pixel - height / 2))
+        )
+
+    def __crop(self, out: np.ndarray) -> None:
+        """Copy the wafer under the camera, the parts beyond the image are black"""
+        x, y = self.pixel_position()
+        height, width = out.shape
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.wafer.shape[1]), min(y + height, self.wafer.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            out.fill(0)
+            return
+        if (x0, y0, x1, y1) != (x, y, x + width, y + height):
+            out.fill(0)
+        out[y0 - y:y1 - y, x0 - x:x1 - x] = self.wafer[y0:y1, x0:x1]
+
+    def get_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        with self.__lock:
+            if self.fps:
+                # Wait for the next frame period
+                now = time.monotonic()
+                if self.__next_time > now:
+                    time.sleep(self.__next_time - now)
+                self.__next_time = max(self.__next_time, now) + 1 / self.fps
+            if self.latency:
+                time.sleep(self.latency)
+
+            width, height = self.__resolution
+            shape = (height, width) if self.channels == 1 else (height, width, 3)
+            if output_array is None or output_array.shape != shape or output_array.dtype != np.uint8:
+                output_array = np.empty(shape, dtype=np.uint8)
+            gray = output_array if self.channels == 1 else self.__gray
+            self.__crop(gray)
+            if self.__noise:
+                index, dx, dy = self.__rng.integers((len(self.__noise), NOISE_MARGIN, NOISE_MARGIN))
+                noise = self.__noise[index][dy:dy + height, dx:dx + width]
+                cv2.add(gray, noise, dst=gray, dtype=cv2.CV_8U)
+            if self.channels == 3:
+                cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=output_array)
+            return output_array
+
+    def latest_frame(self, output_array: tp.Optional[np.ndarray] = None) -> np.ndarray:
+        return self.get_frame(output_array)
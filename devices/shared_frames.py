@@ -0,0 +1,274 @@
+"""This module provides passing camera frames between processes in shared memory
+
+The buffer has a header and a number of frame slots. The writer fills the slots in turn and publishes each frame by
+increasing the frame counter in the header. Every slot also has the number of the frame it contains, which is set
+to -1 while the slot is being written, so a reader can detect a frame that was overwritten during copying and retry.
+A reader that only displays the frames can also use them in place without copying, see SharedFrameBuffer.peek().
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import sys
+import time
+import typing as tp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Changed whenever the layout changes, so that a process of an older version is not misread
+MAGIC = 0x44534D32  # "DSM2"
+# Header fields as int64
+_MAGIC = 0
+_CLOSED = 1
+_LATEST = 2
+_HEIGHT = 3
+_WIDTH = 4
+_CHANNELS = 5
+_SLOTS = 6
+_DTYPE = 7
+_INFO = 8
+_HEADER_WORDS = 9
+# The frames are aligned to cache lines
+_ALIGNMENT = 64
+# Interval of polling for new frames in seconds
+POLL_INTERVAL = 0.0005
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing shared memory block without taking ownership of it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    # Before Python 3.13 the resource tracker would remove the block when this process exits
+    if sys.platform != "win32":
+        resource_tracker.unregister(shm._name, "shared_memory")  # pylint: disable=protected-access
+    return shm
+
+
+class SharedFrameBuffer:
+    """Frames in shared memory, written by one process and read by any number of processes"""
+    def __init__(
+            self,
+            name: tp.Optional[str] = None,
+            shape: tp.Optional[tp.Tuple[int, ...]] = None,
+            dtype=np.uint8,
+            slots: int = 2,
+            info_size: int = 0):
+        """Create a new buffer by giving the shape, or attach to an existing one by giving only the name
+
+        :param name: name of the shared memory block
+        :param shape: shape of the frames
+        :param dtype: data type of the frames
+        :param slots: number of frames in the buffer, two is enough for a single reader
+        :param info_size: number of float64 values of information that accompany each frame, for example metrics
+        """
+        self.__owner = shape is not None
+        if self.__owner:
+            if slots < 2:
+                raise ValueError(f"The buffer must have at least 2 slots, got {slots}")
+            dtype = np.dtype(dtype)
+            frame_bytes = int(np.prod(shape)) * dtype.itemsize
+            self.__shm = shared_memory.SharedMemory(
+                name=name, create=True,
+                size=self.__data_offset(slots, info_size) + slots * self.__slot_size(frame_bytes))
+            header = self.__header_view(slots)
+            header[_MAGIC] = MAGIC
+            header[_CLOSED] = 0
+            header[_LATEST] = 0
+            header[_HEIGHT] = shape[0]
+            header[_WIDTH] = shape[1]
+            header[_CHANNELS] = shape[2] if len(shape) > 2 else 0
+            header[_SLOTS] = slots
+            header[_DTYPE] = ord(dtype.char)
+            header[_INFO] = info_size
+            header[_HEADER_WORDS:_HEADER_WORDS + slots] = 0
+        else:
+            self.__shm = _attach(name)
+            header = np.ndarray((_HEADER_WORDS,), dtype=np.int64, buffer=self.__shm.buf)
+            if header[_MAGIC] != MAGIC:
+                self.__shm.close()
+                raise ValueError(f"{name} is not a frame buffer")
+            slots = int(header[_SLOTS])
+            shape = (int(header[_HEIGHT]), int(header[_WIDTH])) + \
+                ((int(header[_CHANNELS]),) if header[_CHANNELS] else ())
+            dtype = np.dtype(chr(header[_DTYPE]))
+            info_size = int(header[_INFO])
+            del header
+
+        self.shape: tp.Tuple[int, ...] = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.info_size = info_size
+        self.__header = self.__header_view(slots)
+        self.__slot_numbers = self.__header[_HEADER_WORDS:_HEADER_WORDS + slots]
+        self.__timestamps = np.ndarray(
+            (slots,), dtype=np.float64, buffer=self.__shm.buf, offset=(_HEADER_WORDS + slots) * 8)
+        self.__info = np.ndarray(
+            (slots, info_size), dtype=np.float64, buffer=self.__shm.buf, offset=(_HEADER_WORDS + 2 * slots) * 8)
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        offset = self.__data_offset(slots, info_size)
+        self.__frames = [
+            np.ndarray(self.shape, dtype=self.dtype, buffer=self.__shm.buf,
+                       offset=offset + i * self.__slot_size(frame_bytes))
+            for i in range(slots)
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def __data_offset(slots: int, info_size: int) -> int:
+        header_bytes = (_HEADER_WORDS + (2 + info_size) * slots) * 8
+        return -(-header_bytes // _ALIGNMENT) * _ALIGNMENT
+
+    @staticmethod
+    def __slot_size(frame_bytes: int) -> int:
+        return -(-frame_bytes // _ALIGNMENT) * _ALIGNMENT
+
+    def __header_view(self, slots: int) -> np.ndarray:
+        return np.ndarray((_HEADER_WORDS + slots,), dtype=np.int64, buffer=self.__shm.buf)
+
+    @property
+    def name(self) -> str:
+        return self.__shm.name
+
+    @property
+    def latest(self) -> int:
+        """Number of the latest frame, 0 if there are no frames yet"""
+        return int(self.__header[_LATEST])
+
+    @property
+    def closed(self) -> bool:
+        """Whether the writer has abandoned the buffer, for example because the frame size changed,
+        or this handle has been closed
+        """
+        return self.__header is None or bool(self.__header[_CLOSED])
+
+    # Writing
+
+    def begin_write(self) -> np.ndarray:
+        """Get the slot for the next frame, so the frame can be read directly into the shared memory
+
+        :return: slot to be filled, publish it with end_write()
+        """
+        index = (self.latest + 1) % self.slots
+        self.__slot_numbers[index] = -1
+        return self.__frames[index]
+
+    def end_write(self, timestamp: tp.Optional[float] = None, info: tp.Optional[np.ndarray] = None) -> int:
+        """Publish the frame written into the slot from begin_write()
+
+        :param timestamp: time of the frame, by default the current time.monotonic()
+        :param info: info_size values for the frame, by default NaN
+        :return: number of the frame
+        """
+        number = self.latest + 1
+        index = number % self.slots
+        self.__timestamps[index] = time.monotonic() if timestamp is None else timestamp
+        if self.info_size:
+            self.__info[index] = np.nan if info is None else info
+        self.__slot_numbers[index] = number
+        self.__header[_LATEST] = number
+        return number
+
+    def write(
+            self,
+            frame: np.ndarray,
+            timestamp: tp.Optional[float] = None,
+            info: tp.Optional[np.ndarray] = None) -> int:
+        """Copy a frame into the buffer
+
+        :param frame: frame with the shape and type of the buffer
+        :param timestamp: time of the frame, by default the current time.monotonic()
+        :param info: info_size values for the frame, by default NaN
+        :return: number of the frame
+        """
+        np.copyto(self.begin_write(), frame)
+        return self.end_write(timestamp, info)
+
+    # Reading
+
+    def read(
+            self,
+            after: int = 0,
+            timeout: tp.Optional[float] = 5,
+            out: tp.Optional[np.ndarray] = None) -> tp.Tuple[np.ndarray, int, float]:
+        """Copy the latest frame, waiting for one newer than the given number
+
+        :param after: number of a frame, for example that of the previously read frame
+        :param timeout: maximum waiting time in seconds
+        :param out: array to copy the frame into
+        :return: frame, its number and its timestamp
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        while True:
+            number = self.latest
+            if number > after:
+                index = number % self.slots
+                if self.__slot_numbers[index] == number:
+                    timestamp = float(self.__timestamps[index])
+                    np.copyto(out, self.__frames[index])
+                    # The frame is valid only if the slot was not overwritten during the copy
+                    if self.__slot_numbers[index] == number:
+                        return out, number, timestamp
+                continue
+            if self.closed:
+                raise IOError("The frame buffer has been closed")
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"No frame within {timeout} s")
+            time.sleep(POLL_INTERVAL)
+
+    def peek(self, after: int = 0) -> tp.Optional[tp.Tuple[np.ndarray, int, float]]:
+        """Get the latest frame without copying it, if it is newer than the given number
+
+        The frame is a read-only view of its slot, which the writer overwrites after writing the other slots.
+        Check with is_current() after using the frame that it was not overwritten in the meantime.
+        :param after: number of a frame, for example that of the previously read frame
+        :return: frame, its number and its timestamp, or None if there is no newer complete frame
+        """
+        number = self.latest
+        if number <= after:
+            return None
+        index = number % self.slots
+        timestamp = float(self.__timestamps[index])
+        if self.__slot_numbers[index] != number:
+            return None
+        frame = self.__frames[index].view()
+        frame.flags.writeable = False
+        return frame, number, timestamp
+
+    def is_current(self, number: int) -> bool:
+        """Whether the slot of the given frame still contains it"""
+        return bool(self.__slot_numbers[number % self.slots] == number)
+
+    def info(self, number: int) -> tp.Optional[np.ndarray]:
+        """Copy the information of a frame
+
+        :param number: number of the frame
+        :return: info_size values, or None if the frame has already been overwritten
+        """
+        info = self.__info[number % self.slots].copy()
+        return info if self.is_current(number) else None
+
+    def close(self) -> None:
+        """Detach from the buffer, the owner also removes it"""
+        if self.__owner:
+            self.__header[_CLOSED] = 1
+        # The views have to be released before the memory can be closed
+        self.__frames = []
+        self.__slot_numbers = None
+        self.__timestamps = None
+        self.__info = None
+        self.__header = None
+        self.__shm.close()
+        if self.__owner:
+            self.__shm.unlink()
@@ -15,6 +15,7 @@ import logging
 import os.path
 import platform
 import sys
+import time
 import typing as tp
 
 logger = logging.getLogger(__name__)
@@ -28,6 +29,13 @@ __LIMIT_MIN = 1
 __LIMIT_MAX = 32767
 __WATCHDOG_MAX = 32767
 
+# Interval of polling the drive status in seconds, the bus round trip is about a millisecond
+POLL_INTERVAL = 0.002
+# Default size of the chunks of the incremental moves, within the range of INCTARGET
+MAX_INC_STEPS_PER_COMMAND = 32760
+# Maximum time for homing in seconds
+HOMING_TIMEOUT = 120.0
+
 
 @enum.unique
 class ControlMode(enum.IntEnum):
@@ -95,6 +103,23 @@ class SmParam(bytes, enum.Enum):
     ACTUAL_TORQUE = b"ActualTorque"
 
 
+class StatusBits(enum.IntFlag):
+    """Bits of SmParam.STATUS_BITS"""
+    TARGET_REACHED = 1 << 1
+    FERROR_RECOVERY = 1 << 2
+    RUN = 1 << 3
+    ENABLED = 1 << 4
+    FAULTSTOP = 1 << 5
+    FERROR_WARNING = 1 << 6
+    STO_ACTIVE = 1 << 7
+    SERVO_READY = 1 << 8
+    BRAKING = 1 << 10
+    HOMING = 1 << 11
+    INITIALIZED = 1 << 12
+    VOLTAGE_LIMITING = 1 << 13
+    PERMANENT_STOP = 1 << 15
+
+
 @enum.unique
 class SmStatus(enum.IntEnum):
     SM_OK = 0
@@ -232,8 +257,12 @@ def homing(axis: str, abort: bool = False):
     __smcommand(axis, SmCommand.HOMING, int(not abort))
 
 
+def abs_target_valid(steps: int) -> bool:
+    return __ABS_TARGET_MIN <= steps <= __ABS_TARGET_MAX
+
+
 def move_abs(axis: str, steps: int):
-    if steps < __ABS_TARGET_MIN or steps > __ABS_TARGET_MAX:
+    if not abs_target_valid(steps):
         raise ValueError(f"Invalid absolute step count: {steps}")
     __smcommand(axis, SmCommand.ABSTARGET, steps)
 
@@ -244,6 +273,173 @@ def move_inc(axis: str, steps: int):
     __smcommand(axis, SmCommand.INCTARGET, steps)
 
 
+def wait_until_settled(
+        axes: tp.Iterable[str],
+        tolerance: int,
+        timeout: float,
+        min_times: tp.Optional[tp.Dict[str, float]] = None,
+        poll_interval: float = POLL_INTERVAL) -> tp.Dict[str, float]:
+    """Wait until the axes have reached their targets
+
+    An axis has settled when its trajectory has reached the target and its following error is within the tolerance.
+    The target reached bit may still be set from the previous move when the drive has not started the new one yet,
+    and the setpoint of the drive cannot be read to tell the moves apart. The bit is therefore accepted only after the
+    axis has been seen moving, or after the minimum time of the axis, which should be the estimated duration of the
+    remaining move. Without a minimum time the wait times out if the axis does not move.
+    :param axes: axes to wait for
+    :param tolerance: maximum following error in steps
+    :param timeout: maximum waiting time in seconds
+    :param min_times: axis -> time in seconds after which the bit is accepted even if the axis has not been seen moving
+    :param poll_interval: interval of polling the drives in seconds
+    :return: axis -> time from the call until the axis settled in seconds
+    """
+    if min_times is None:
+        min_times = {}
+    start_time = time.monotonic()
+    waiting = list(axes)
+    moved: tp.Set[str] = set()
+    settled: tp.Dict[str, float] = {}
+    while True:
+        for axis in list(waiting):
+            status = StatusBits(get_param(axis, SmParam.STATUS_BITS))
+            if status & (StatusBits.FAULTSTOP | StatusBits.PERMANENT_STOP):
+                raise SmException(
+                    f"Axis {axis} stopped with a fault: status {status!r}, "
+                    f"simple status {get_param(axis, SmParam.SIMPLE_STATUS)}"
+                )
+            if not status & StatusBits.TARGET_REACHED:
+                moved.add(axis)
+                continue
+            if axis not in moved and not (axis in min_times and time.monotonic() - start_time >= min_times[axis]):
+                continue
+            if abs(get_param(axis, SmParam.FOLLOWING_ERROR)) <= tolerance:
+                settled[axis] = time.monotonic() - start_time
+                waiting.remove(axis)
+        if not waiting:
+            return settled
+        if time.monotonic() - start_time > timeout:
+            states = ", ".join(
+                f"{axis}: status {get_param(axis, SmParam.STATUS_BITS):#06x}, "
+                f"simple status {get_param(axis, SmParam.SIMPLE_STATUS)}, "
+                f"following error {get_param(axis, SmParam.FOLLOWING_ERROR)}"
+                for axis in waiting
+            )
+            raise TimeoutError(f"The axes did not settle within {timeout} s: {states}")
+        time.sleep(poll_interval)
+
+
+def wait_until_homed(axes: tp.Iterable[str], timeout: float, poll_interval: float = POLL_INTERVAL) -> None:
+    """Wait until the axes have finished homing
+
+    The homing bit is not set until the drive has started homing, so an axis has finished only when the bit has been
+    seen set and then cleared.
+    :param axes: axes to wait for
+    :param timeout: maximum waiting time in seconds
+    :param poll_interval: interval of polling the drives in seconds
+    """
+    start_time = time.monotonic()
+    waiting = list(axes)
+    homing_seen: tp.Set[str] = set()
+    while True:
+        for axis in list(waiting):
+            status = StatusBits(get_param(axis, SmParam.STATUS_BITS))
+            if status & (StatusBits.FAULTSTOP | StatusBits.PERMANENT_STOP):
+                raise SmException(
+                    f"Axis {axis} stopped with a fault while homing: status {status!r}, "
+                    f"simple status {get_param(axis, SmParam.SIMPLE_STATUS)}"
+                )
+            if status & StatusBits.HOMING:
+                homing_seen.add(axis)
+            elif axis in homing_seen:
+                waiting.remove(axis)
+        if not waiting:
+            return
+        if time.monotonic() - start_time > timeout:
+            raise TimeoutError(f"Homing of {', '.join(waiting)} did not finish within {timeout} s")
+        time.sleep(poll_interval)
+
+
+def home(axes: tp.Iterable["Axis"], timeout: float = HOMING_TIMEOUT) -> None:
+    """Run the homing of the drives simultaneously and zero their targets
+
+    :param axes: drives to home
+    :param timeout: maximum time for homing in seconds
+    """
+    axes = list(axes)
+    for axis in axes:
+        axis.target = None
+        homing(axis.name)
+    wait_until_homed([axis.name for axis in axes], timeout)
+    for axis in axes:
+        axis.target = 0
+
+
+class Axis:
+    """A drive with its absolute target tracked in software
+
+    The drives cannot report their targets, so the target is known only once homing has zeroed the position of the
+    drive, and it is then updated with each move. A move with a known target is a single ABSTARGET command, so the
+    drive makes one smooth move instead of queuing many short ones. Before homing, and after an abort or a failed
+    command, which may leave the drive anywhere, the moves are split into INCTARGET commands.
+    """
+    def __init__(self, name: str, max_inc_steps_per_command: int = MAX_INC_STEPS_PER_COMMAND, absolute: bool = True):
+        """
+        :param name: device name of the drive
+        :param max_inc_steps_per_command: maximum steps of a single INCTARGET command
+        :param absolute: whether to use ABSTARGET when the target is known
+        """
+        self.name = name
+        self.max_inc_steps_per_command = max_inc_steps_per_command
+        self.absolute = absolute
+        # Absolute target in steps from the homed zero, None if not known
+        self.target: tp.Optional[int] = None
+
+    def home(self, timeout: float = HOMING_TIMEOUT) -> None:
+        """Run the homing of the drive and zero the target
+
+        :param timeout: maximum time for homing in seconds
+        """
+        home([self], timeout)
+
+    def forget_target(self) -> None:
+        """Move incrementally until the next homing, for when the drive may have stopped anywhere"""
+        self.target = None
+
+    def move(self, steps: int, aborted: tp.Callable[[], bool] = lambda: False) -> bool:
+        """Move relative to the current target
+
+        :param steps: steps to move
+        :param aborted: checked before each of the incremental commands, which stop when it returns True
+        :return: False if the move was aborted
+        """
+        try:
+            if self.target is not None and not abs_target_valid(self.target + steps):
+                logger.warning(f"The target of {self.name} is out of range, moving it incrementally until homing")
+                self.target = None
+            if self.absolute and self.target is not None:
+                move_abs(self.name, self.target + steps)
+                self.target += steps
+                return True
+
+            max_steps = ((steps > 0) - (steps < 0)) * self.max_inc_steps_per_command
+            while abs(steps) > self.max_inc_steps_per_command:
+                if aborted():
+                    self.target = None
+                    return False
+                move_inc(self.name, max_steps)
+                steps -= max_steps
+                if self.target is not None:
+                    self.target += max_steps
+            move_inc(self.name, steps)
+            if self.target is not None:
+                self.target += steps
+            return True
+        except SmException:
+            # The command may or may not have been executed
+            self.target = None
+            raise
+
+
 # Getters and setters
 
 def set_velocity_limit(axis: str, limit: int):
@@ -285,7 +481,7 @@ def test_multi(axes: tp.List[str]) -> None:
 def validate_status(status: SmStatus) -> None:
     if status == SmStatus.SM_OK:
         return
-    elif status == SmStatus.SmErrNodevice:
+    elif status == SmStatus.SM_ERR_NODEVICE:
         raise SmErrNodevice()
     elif status == SmStatus.SM_ERR_BUS:
         raise SmErrBus()
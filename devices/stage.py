@@ -42,11 +42,11 @@ class Stage(abc.ABC):
         with self.move_lock:
             if self.abort_lock.locked():
                 return False
-            ret = self.__move_inc_steps(self.__sign*steps)
+            ret = self._move_inc_steps(self.__sign*steps)
             if ret:
                 self.pos += steps
             return ret
 
     @abc.abstractmethod
-    def __move_inc_steps(self, steps: int):
+    def _move_inc_steps(self, steps: int) -> bool:
         pass
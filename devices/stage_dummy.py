@@ -2,5 +2,5 @@ from .stage import Stage
 
 
 class StageDummy(Stage):
-    def __move_inc_steps(self, steps: int):
-        pass
+    def _move_inc_steps(self, steps: int) -> bool:
+        return True
@@ -2,6 +2,8 @@ from . import simplemotion as sm
 from . import stage
 
 import logging
+import time
+import typing as tp
 
 logger = logging.getLogger(__name__)
 
@@ -14,32 +16,61 @@ class StageSimplemotion(stage.Stage):
             velocity: float,
             starting_pos: int = 0,
             max_inc_steps: int = 40000000,
-            max_inc_steps_per_command: int = 32760):
+            max_inc_steps_per_command: int = sm.MAX_INC_STEPS_PER_COMMAND,
+            absolute: bool = True):
+        """
+        :param absolute: whether to move with absolute targets once the drive has been homed,
+            otherwise the moves are split into incremental ones
+        """
         super().__init__(address, mm_to_steps, velocity, starting_pos)
         if max_inc_steps_per_command > max_inc_steps:
             raise ValueError
         self.max_inc_steps = max_inc_steps
         self.max_inc_steps_per_command = max_inc_steps_per_command
+        self.__drive = sm.Axis(address, max_inc_steps_per_command, absolute)
+        # Estimated end of the moves since the drive last settled as time.monotonic(), None if it has not moved
+        self.__move_end: tp.Optional[float] = None
 
     # Movement
 
-    def __move_inc_steps(self, steps: int) -> bool:
+    def home(self, timeout: float = sm.HOMING_TIMEOUT) -> None:
+        """Run the homing of the drive, after which it moves with absolute targets
+
+        :param timeout: maximum time for homing in seconds
+        """
+        with self.move_lock:
+            self.__drive.home(timeout)
+            self.__move_end = None
+            self.pos = 0
+
+    def _move_inc_steps(self, steps: int) -> bool:
         if abs(steps) > self.max_inc_steps:
             logger.error(f"Error: too many steps: {steps}")
             return False
 
-        max_steps = ((steps > 0) - (steps < 0)) * self.max_inc_steps_per_command
-        while abs(steps) > self.max_inc_steps_per_command:
-            if self.abort_lock.locked():
-                self.reset_pos()
-                return False
-
-            sm.move_inc(self.address, max_steps)
-            steps -= max_steps
-
-        sm.move_inc(self.address, steps)
+        if steps:
+            self.__move_end = max(self.__move_end or 0.0, time.monotonic() + self.time(steps))
+        if not self.__drive.move(steps, self.abort_lock.locked):
+            # The move lock is already held, so reset_pos() would deadlock
+            self.pos = 0
+            return False
         return True
 
+    def wait_until_settled(self, tolerance: int, timeout: float) -> float:
+        """Wait until the drive has reached the target
+
+        :param tolerance: maximum following error in steps
+        :param timeout: maximum waiting time in seconds
+        :return: waiting time in seconds
+        """
+        if self.__move_end is None:
+            return 0.0
+        # A target reached bit is accepted without seeing the drive move once the estimated move time has passed
+        min_times = {self.address: max(0.0, self.__move_end - time.monotonic())}
+        elapsed = sm.wait_until_settled([self.address], tolerance, timeout, min_times)[self.address]
+        self.__move_end = None
+        return elapsed
+
     # Getters and setters
 
     def set_velocity_limit(self, limit: int):
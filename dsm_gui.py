@@ -1,3 +1,5 @@
+import typing as tp
+
 import numpy as np
 from PySide2.QtWidgets import \
     QDockWidget, QMainWindow, QLabel, QLineEdit, QPushButton, QRadioButton, QWidget, \
@@ -7,6 +9,7 @@ from PySide2 import QtCore
 import pyqtgraph as pg
 
 import devices.camera_opencv as cv
+import live_view
 
 pg.setConfigOptions(antialias=True)
 
@@ -101,6 +104,7 @@ class CameraParamsWidget(QWidget):
             ("Sharpness", 4, "0-7", cv.Props.SHARPNESS),
             ("Shutter", 230, "3-1150", cv.Props.EXPOSURE)
         ]
+        self.props = [label[3] for label in labels]
         self.boxes = [QLineEdit() for _ in labels]
         for i, label in enumerate(labels):
             layout.addWidget(QLabel(label[0]), i, 0)
@@ -110,6 +114,10 @@ class CameraParamsWidget(QWidget):
         layout.addWidget(self.set_button, len(labels), 1)
         self.setLayout(layout)
 
+    def values(self) -> tp.Dict[cv.Props, int]:
+        """The entered values, to be given to CameraCV.set_props() which sends only the changed ones"""
+        return {prop: int(box.text()) for prop, box in zip(self.props, self.boxes)}
+
 
 class Controls(QWidget):
     def __init__(self, *args, **kwargs):
@@ -129,17 +137,24 @@ class Controls(QWidget):
 
 
 class CameraView(pg.ImageView):
-    # Todo: https://www.pyimagesearch.com/2015/12/21/increasing-webcam-fps-with-python-and-opencv/
+    """Displays frames given to it, use CameraCV.start_grabbing() to decouple the display from the camera"""
     def __init__(self, auto_levels: bool = False, **kwargs):
         super().__init__(**kwargs)
-        self.auto_levels = auto_levels
+        # The frames are displayed in row-major order as they come from the camera, so they are not transposed
+        self.getImageItem().setOpts(axisOrder="row-major")
+        self.renderer = live_view.LiveRenderer(auto_levels=auto_levels)
+
+    @property
+    def auto_levels(self) -> bool:
+        return self.renderer.auto_levels
+
+    @auto_levels.setter
+    def auto_levels(self, value: bool) -> None:
+        self.renderer.auto_levels = value
 
     def show(self, img: np.ndarray):
-        transposed = np.transpose(img) / 255
-        if self.auto_levels:
-            self.__imv.setImage(transposed, autoLevels=True)
-        else:
-            self.__imv.setImage(transposed, levels=(0, 1))
+        # The levels are applied by the renderer, and the full range keeps the lookup table of PyQtGraph unchanged
+        self.setImage(self.renderer.render(img), levels=(0, 255), autoRange=False, autoHistogramRange=False)
 
 
 class MainWindow(QMainWindow):
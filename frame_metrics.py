@@ -0,0 +1,120 @@
+"""This module provides focus and exposure metrics of camera frames for ORC Dark Spot Mapper
+
+The metrics are computed for every frame of the live view, so they have to fit in a small part of the frame period.
+They are computed from a strided subsample of the frame, which takes about 2 ms for a 1280x960 BGR frame.
+- The histogram of the grey levels and the fraction of saturated pixels help setting the exposure.
+- The focus score is the Tenengrad measure, the mean squared Sobel gradient, or optionally the variance of the
+  Laplacian. Both are larger for sharper images, so the focus is found by maximizing the score.
+  The scores depend on the image content and are comparable only between frames of the same area.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import typing as tp
+
+import cv2
+import numpy as np
+
+# Only every STEP-th pixel of every STEP-th row is used
+STEP = 2
+# Number of histogram bins over the grey levels 0-255
+HISTOGRAM_BINS = 64
+# Pixels that have any channel at or above this level are saturated
+SATURATION_LEVEL = 255
+FOCUS_METHODS = ("tenengrad", "laplacian")
+# The saturated fraction above which the scans warn about the exposure
+MAX_SATURATION = 0.01
+
+
+class FrameMetrics(tp.NamedTuple):
+    # Mean grey level
+    mean: float
+    # Fraction of saturated pixels
+    saturation: float
+    # Focus score, larger is sharper
+    focus: float
+    # Fractions of the pixels in the histogram bins
+    histogram: np.ndarray
+
+    def to_array(self) -> np.ndarray:
+        """Pack the metrics into a float64 array, for example for shared memory"""
+        return np.concatenate(([self.mean, self.saturation, self.focus], self.histogram)).astype(np.float64)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> "FrameMetrics":
+        """Unpack metrics packed with to_array()"""
+        return cls(float(array[0]), float(array[1]), float(array[2]), np.array(array[3:]))
+
+    @staticmethod
+    def array_size(bins: int = HISTOGRAM_BINS) -> int:
+        """Size of the array from to_array()"""
+        return 3 + bins
+
+
+def subsample(frame: np.ndarray, step: int = STEP) -> np.ndarray:
+    """Every step-th pixel of every step-th row of a frame as a contiguous array
+
+    The last rows and columns that do not fill a whole step are left out.
+    :param frame: frame
+    :param step: stride
+    :return: subsample
+    """
+    if step == 1:
+        return frame
+    height, width = frame.shape[0] // step, frame.shape[1] // step
+    # With an integer factor the nearest neighbour interpolation picks exactly every step-th pixel,
+    # and it is faster than copying a strided view with NumPy
+    return cv2.resize(frame[:height * step, :width * step], (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def focus_score(gray: np.ndarray, method: str = "tenengrad") -> float:
+    """Sharpness of a grayscale uint8 image
+
+    :param gray: image
+    :param method: tenengrad or laplacian, see FOCUS_METHODS
+    :return: focus score
+    """
+    if method == "tenengrad":
+        # The gradients of uint8 images fit in int16
+        gx = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3)
+        gy = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3)
+        return (cv2.norm(gx, cv2.NORM_L2SQR) + cv2.norm(gy, cv2.NORM_L2SQR)) / gray.size
+    if method == "laplacian":
+        return float(cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_16S, ksize=1))[1][0, 0] ** 2)
+    raise ValueError(f"Unknown focus method: {method}")
+
+
+def measure(
+        frame: np.ndarray,
+        step: int = STEP,
+        bins: int = HISTOGRAM_BINS,
+        focus_method: str = "tenengrad") -> FrameMetrics:
+    """Compute the metrics of a frame
+
+    :param frame: uint8 BGR or grayscale frame
+    :param step: stride of the subsample
+    :param bins: number of histogram bins
+    :param focus_method: see focus_score()
+    :return: metrics
+    """
+    if frame.dtype != np.uint8:
+        raise ValueError(f"The metrics need uint8 frames, got {frame.dtype}")
+    sub = subsample(frame, step)
+    if sub.ndim == 3:
+        gray = cv2.cvtColor(sub, cv2.COLOR_BGR2GRAY)
+        below = cv2.inRange(sub, (0, 0, 0), (SATURATION_LEVEL - 1,) * 3)
+    else:
+        gray = sub
+        below = cv2.inRange(sub, 0, SATURATION_LEVEL - 1)
+    size = gray.size
+    histogram = cv2.calcHist([gray], [0], None, [bins], [0, 256]).ravel() / size
+    return FrameMetrics(
+        mean=cv2.mean(gray)[0],
+        saturation=1 - cv2.countNonZero(below) / size,
+        focus=focus_score(gray, focus_method),
+        histogram=histogram
+    )
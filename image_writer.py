@@ -0,0 +1,250 @@
+"""This module provides asynchronous writing of measurement pictures for ORC Dark Spot Mapper
+
+Encoding a PNG takes a large part of the time between two stage moves. The pictures are therefore given to a
+pool of writer threads, and the measurement can move the stage while the previous pictures are being written.
+OpenCV releases the GIL while encoding, so the threads also run in parallel.
+
+The storage format can be chosen to favour speed or size, see FORMATS. Run this module to benchmark the formats
+on existing pictures:
+    python image_writer.py "measurements/sample/*.png"
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import argparse
+import concurrent.futures
+import glob
+import logging
+import os.path
+import tempfile
+import threading
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+import stitching
+
+logger = logging.getLogger(__name__)
+
+
+class ImageFormat(tp.NamedTuple):
+    extension: str
+    # OpenCV encoding parameters
+    params: tp.Tuple[int, ...] = ()
+    description: str = ""
+
+
+# Stored without compression or filtering, so writing is mostly copying. On 1280x960 synthetic frames with noise
+# and OpenCV 5 this writes 620 MB/s instead of the 60-70 MB/s of the default settings, but the files are 2.25 times
+# as large. Faster zlib settings did not help, since the default of OpenCV 5 is already level 1 with RLE, and the
+# Huffman-only strategy ran at 58 MB/s. Of the TIFF compressions, PackBits ran at 130 MB/s without reducing the
+# size, and LZW at 45 MB/s. The pictures are still readable by any PNG reader and can be recompressed later.
+_PNG_FAST_PARAMS: tp.Tuple[int, ...] = (cv2.IMWRITE_PNG_COMPRESSION, 0)
+if hasattr(cv2, "IMWRITE_PNG_FILTER"):
+    _PNG_FAST_PARAMS += (cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE)
+
+FORMATS: tp.Dict[str, ImageFormat] = {
+    "png": ImageFormat(".png", (), "PNG with the default settings of OpenCV"),
+    "png_fast": ImageFormat(".png", _PNG_FAST_PARAMS, "uncompressed PNG, about ten times faster to write"),
+    "png_small": ImageFormat(".png", (cv2.IMWRITE_PNG_COMPRESSION, 9), "PNG with the maximum compression"),
+    "tiff": ImageFormat(".tif", (cv2.IMWRITE_TIFF_COMPRESSION, 1), "uncompressed TIFF"),
+    "npy": ImageFormat(".npy", (), "raw NumPy array with a header of the shape and type"),
+}
+DEFAULT_FORMAT = "png"
+# Extensions that format_path() accepts as given, the rest of the path may contain dots such as in "x1.5mm"
+_KNOWN_EXTENSIONS = {image_format.extension for image_format in FORMATS.values()} | {".tiff", ".jpg", ".bmp"}
+
+
+class WriteError(IOError):
+    """Raised when pictures could not be written"""
+
+
+def format_path(path: str, fmt: str = DEFAULT_FORMAT) -> str:
+    """Add the extension of a format to a path that has no known image extension
+
+    :param path: path with or without an extension
+    :param fmt: name of the format in FORMATS
+    :return: path with an extension
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown image format: {fmt}")
+    if os.path.splitext(path)[1].lower() in _KNOWN_EXTENSIONS:
+        return path
+    return path + FORMATS[fmt].extension
+
+
+def save_image(path: str, img: np.ndarray, fmt: str = DEFAULT_FORMAT) -> str:
+    """Write a picture in the given format
+
+    :param path: path of the file, the extension of the format is added if the path has none
+    :param img: picture
+    :param fmt: name of the format in FORMATS
+    :return: path of the written file
+    """
+    path = format_path(path, fmt)
+    image_format = FORMATS[fmt]
+    # The parameters are for the encoder of the format, and another extension may have been given explicitly
+    params = image_format.params if path.lower().endswith(image_format.extension) else ()
+    stitching.write_image(path, img, params)
+    return path
+
+
+class ImageWriter:
+    """Bounded queue of pictures to be written by a thread pool
+
+    When the queue is full, write() blocks until there is room, so the memory use stays bounded even if the disk
+    cannot keep up. Errors of the writer threads are raised by the next call to write() or flush().
+    """
+    def __init__(
+            self,
+            max_workers: int = 2,
+            max_pending: int = 16,
+            fmt: str = DEFAULT_FORMAT,
+            write: tp.Callable[[str, np.ndarray, str], str] = save_image):
+        """
+        :param max_workers: number of writer threads
+        :param max_pending: number of pictures that can be queued or being written at a time
+        :param fmt: default format of the pictures, see FORMATS
+        :param write: function that writes a picture to the given path in the given format
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown image format: {fmt}")
+        self.fmt = fmt
+        self.__write = write
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="image_writer")
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__lock = threading.Lock()
+        self.__pending: tp.Set[concurrent.futures.Future] = set()
+        self.__errors: tp.List[tp.Tuple[str, Exception]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of pictures that have not been written yet"""
+        with self.__lock:
+            return len(self.__pending)
+
+    def write(self, path: str, img: np.ndarray, fmt: tp.Optional[str] = None) -> str:
+        """Queue a picture to be written
+
+        The picture must not be modified afterwards, since it is written later.
+        :param path: path of the file, the extension of the format is added if the path has none
+        :param img: picture
+        :param fmt: format of the picture, by default that of the writer
+        :return: path of the file
+        """
+        fmt = self.fmt if fmt is None else fmt
+        path = format_path(path, fmt)
+        self.raise_errors()
+        if not self.__slots.acquire(blocking=False):
+            start_time = time.perf_counter()
+            self.__slots.acquire()
+            logger.debug("Waited %.3f s for the image writer", time.perf_counter() - start_time)
+        try:
+            future = self.__executor.submit(self.__write, path, img, fmt)
+        except RuntimeError:
+            self.__slots.release()
+            raise
+        with self.__lock:
+            self.__pending.add(future)
+        future.add_done_callback(lambda done: self.__done(path, done))
+        return path
+
+    def __done(self, path: str, future: concurrent.futures.Future) -> None:
+        with self.__lock:
+            self.__pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                logger.error("Writing %s failed: %s", path, future.exception())
+                self.__errors.append((path, future.exception()))
+        self.__slots.release()
+
+    def raise_errors(self) -> None:
+        """Raise the errors that have occurred since the previous call
+
+        :return: -
+        """
+        with self.__lock:
+            errors = self.__errors
+            self.__errors = []
+        if errors:
+            path, error = errors[0]
+            raise WriteError(f"{len(errors)} pictures could not be written, the first was {path}: {error}") from error
+
+    def flush(self, timeout: tp.Optional[float] = None) -> None:
+        """Wait until the queued pictures have been written
+
+        :param timeout: maximum waiting time in seconds
+        :return: -
+        """
+        with self.__lock:
+            pending = list(self.__pending)
+        _, not_done = concurrent.futures.wait(pending, timeout)
+        if not_done:
+            raise TimeoutError(f"{len(not_done)} pictures were not written within {timeout} s")
+        self.raise_errors()
+
+    def close(self) -> None:
+        self.__executor.shutdown(wait=True)
+        self.raise_errors()
+
+
+def benchmark(
+        images: tp.Sequence[np.ndarray],
+        formats: tp.Iterable[str] = None,
+        directory: str = None) -> tp.Dict[str, tp.Tuple[float, float]]:
+    """Measure the writing speed and the file size of the formats
+
+    :param images: pictures to be written
+    :param formats: names of the formats, by default all of FORMATS
+    :param directory: directory for the test files, by default a temporary directory, which should be on the same
+        disk as the measurements to include the disk speed
+    :return: format -> (throughput in MB/s of uncompressed data, average bytes per picture)
+    """
+    if formats is None:
+        formats = FORMATS.keys()
+    raw_bytes = sum(img.nbytes for img in images)
+    results = {}
+    with tempfile.TemporaryDirectory(dir=directory) as temp_dir:
+        for fmt in formats:
+            start_time = time.perf_counter()
+            paths = [save_image(os.path.join(temp_dir, f"{fmt}_{i}"), img, fmt) for i, img in enumerate(images)]
+            duration = time.perf_counter() - start_time
+            size = sum(os.path.getsize(path) for path in paths)
+            for path in paths:
+                os.remove(path)
+            results[fmt] = (raw_bytes / duration / 1e6, size / len(images))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage formats of the measurement pictures")
+    parser.add_argument("pictures", nargs="+", help="glob patterns of pictures to be used as test data")
+    parser.add_argument("-n", "--count", type=int, default=20, help="maximum number of pictures to use")
+    parser.add_argument("-d", "--directory", help="directory for the test files, by default a temporary one")
+    parser.add_argument("-f", "--formats", nargs="+", choices=list(FORMATS), help="formats to test")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.pictures for path in glob.glob(pattern)})[:args.count]
+    if not paths:
+        parser.error("No pictures found")
+    images = [stitching.read_image(path) for path in paths]
+    raw_size = sum(img.nbytes for img in images) / len(images)
+    print(f"{len(images)} pictures, {raw_size / 1e6:.2f} MB each uncompressed")
+    print(f"{'format':<12}{'MB/s':>10}{'bytes/tile':>14}{'ratio':>8}  description")
+    for fmt, (speed, size) in benchmark(images, args.formats, args.directory).items():
+        print(f"{fmt:<12}{speed:>10.1f}{size:>14.0f}{raw_size / size:>8.2f}  {FORMATS[fmt].description}")
+
+
+if __name__ == "__main__":
+    main()
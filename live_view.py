@@ -0,0 +1,378 @@
+"""This module provides the frame processing of the live view of ORC Dark Spot Mapper
+
+The display gets uint8 frames in row-major order, so PyQtGraph does no conversions or transposes of its own.
+The display levels are applied with a lookup table that is computed only when the levels change, and the automatic
+levels are estimated from a subsample of every few frames instead of scanning every frame.
+
+The live view window runs in a process of its own, so the display does not compete with the acquisition, the stage
+control and the measurements for the GIL. The acquisition process publishes the latest frame in shared memory with
+FramePublisher, and the viewer process started with start_viewer() displays the frames in place without copying or
+pickling them. The published frames are a preview that is decimated to a half or a quarter of the camera resolution,
+which the window of the viewer does not exceed anyway, while the measurements save the full frames of the camera.
+The window itself is in live_viewer.py, and dsm_gui.CameraView uses the same renderer within the GUI.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import functools
+import logging
+import os.path
+import subprocess
+import sys
+import threading
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+import frame_metrics
+from devices import camera
+from devices import shared_frames
+
+logger = logging.getLogger(__name__)
+
+# Interval of the display updates in milliseconds
+DISPLAY_INTERVAL = 33
+# The automatic levels are updated every this many frames
+AUTO_LEVELS_INTERVAL = 10
+# Stride of the subsample from which the automatic levels are estimated
+AUTO_LEVELS_STEP = 8
+# Percentiles of the subsample that are mapped to black and white
+AUTO_LEVELS_PERCENTILES = (0.5, 99.5)
+# The width and height of the preview are those of the camera frames divided by this, for example 2 or 4
+PREVIEW_DECIMATION = 2
+# Interval of updating the rate label in seconds
+LABEL_INTERVAL = 1.0
+
+Levels = tp.Tuple[int, int]
+
+
+@functools.lru_cache(maxsize=32)
+def levels_lut(low: int, high: int) -> np.ndarray:
+    """Lookup table that maps the gray level low to black and high to white
+
+    :param low: gray level shown as black
+    :param high: gray level shown as white
+    :return: uint8 table of 256 values, which must not be modified since it is shared
+    """
+    if high <= low:
+        high = low + 1
+    lut = np.clip((np.arange(256, dtype=np.float32) - low) * (255 / (high - low)), 0, 255).round().astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def preview_shape(shape: tp.Tuple[int, ...], decimation: int) -> tp.Tuple[int, ...]:
+    """Shape of the preview of frames of the given shape
+
+    :param shape: shape of the frames
+    :param decimation: decimation factor
+    :return: shape of the preview
+    """
+    return (max(shape[0] // decimation, 1), max(shape[1] // decimation, 1)) + tuple(shape[2:])
+
+
+def auto_levels(
+        frame: np.ndarray,
+        step: int = AUTO_LEVELS_STEP,
+        percentiles: tp.Tuple[float, float] = AUTO_LEVELS_PERCENTILES) -> Levels:
+    """Estimate display levels that stretch the contrast of a frame
+
+    :param frame: uint8 frame
+    :param step: stride of the subsample
+    :param percentiles: percentiles that are mapped to black and white
+    :return: levels
+    """
+    low, high = np.percentile(frame[::step, ::step], percentiles)
+    low = int(low)
+    return low, max(int(np.ceil(high)), low + 1)
+
+
+class RateMeter:
+    """Measures the rate of events over intervals of a fixed length"""
+    def __init__(self, interval: float = 1.0):
+        """
+        :param interval: length of the measuring interval in seconds
+        """
+        self.interval = interval
+        self.rate = 0.0
+        self.__count = 0
+        self.__start: tp.Optional[float] = None
+
+    def tick(self, n: int = 1, now: tp.Optional[float] = None) -> bool:
+        """Count events
+
+        :param n: number of events
+        :param now: time from time.perf_counter()
+        :return: whether the rate was updated
+        """
+        if now is None:
+            now = time.perf_counter()
+        if self.__start is None:
+            self.__start = now
+            return False
+        self.__count += n
+        elapsed = now - self.__start
+        if elapsed < self.interval:
+            return False
+        self.rate = self.__count / elapsed
+        self.__count = 0
+        self.__start = now
+        return True
+
+
+class LiveRenderer:
+    """Converts camera frames for the display"""
+    def __init__(self, levels: Levels = (0, 255), auto_levels: bool = False, grayscale: bool = True):
+        """
+        :param levels: gray levels shown as black and white when the automatic levels are off
+        :param auto_levels: whether to stretch the contrast automatically
+        :param grayscale: whether to display colour frames in grayscale, which is a third of the data to display
+        """
+        self.levels = levels
+        self.auto_levels = auto_levels
+        self.grayscale = grayscale
+        self.fps = RateMeter()
+        self.__auto_levels: tp.Optional[Levels] = None
+        self.__count = 0
+        self.__gray: tp.Optional[np.ndarray] = None
+        self.__display: tp.Optional[np.ndarray] = None
+
+    @property
+    def current_levels(self) -> Levels:
+        """The levels used for the latest frame"""
+        if self.auto_levels and self.__auto_levels is not None:
+            return self.__auto_levels
+        return self.levels
+
+    @staticmethod
+    def __buffer(buffer: tp.Optional[np.ndarray], shape: tp.Tuple[int, ...]) -> np.ndarray:
+        if buffer is None or buffer.shape != shape:
+            return np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def render(self, frame: np.ndarray) -> np.ndarray:
+        """Convert a frame for the display
+
+        The result may be the frame itself or a buffer that is reused for the next frame.
+        :param frame: BGR or grayscale frame
+        :return: uint8 frame in row-major order, RGB or grayscale
+        """
+        if frame.dtype != np.uint8:
+            frame = cv2.convertScaleAbs(frame, alpha=255 / np.iinfo(frame.dtype).max)
+        if frame.ndim == 3 and self.grayscale:
+            self.__gray = self.__buffer(self.__gray, frame.shape[:2])
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.__gray)
+
+        if self.auto_levels and (self.__auto_levels is None or self.__count % AUTO_LEVELS_INTERVAL == 0):
+            self.__auto_levels = auto_levels(frame)
+        self.__count += 1
+        self.fps.tick()
+
+        self.__display = self.__buffer(self.__display, frame.shape)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.__display)
+        levels = self.current_levels
+        if tuple(levels) == (0, 255):
+            return frame
+        return cv2.LUT(frame, levels_lut(*levels), dst=self.__display)
+
+
+class FramePublisher:
+    """Publishes the latest frames of a camera in shared memory for a viewer in another process
+
+    The frames are copied at the display rate in a background thread into a double buffer, from which the viewer
+    always takes the newest frame. The viewer never blocks the camera, and a slow viewer only skips frames.
+    The published frames are a preview, which can be decimated from the full-resolution frames of the camera.
+    The decimation is done once per frame for all the viewers, and the camera still gives full frames for saving.
+    The focus and exposure metrics of the full frames are published with the preview, see frame_metrics.
+    """
+    def __init__(
+            self,
+            cam: camera.Camera,
+            interval: float = DISPLAY_INTERVAL / 1000,
+            decimation: int = PREVIEW_DECIMATION,
+            metrics: bool = True):
+        """
+        :param cam: camera, preferably grabbing in the background, see camera_opencv.CameraCV.start_grabbing()
+        :param interval: minimum interval of the published frames in seconds
+        :param decimation: the width and height of the preview are those of the frames divided by this
+        :param metrics: whether to compute the metrics of the frames
+        """
+        if decimation < 1:
+            raise ValueError(f"Invalid decimation: {decimation}")
+        self.__cam = cam
+        self.__interval = interval
+        self.decimation = decimation
+        self.__measure = metrics
+        # Metrics of the latest published frame
+        self.metrics: tp.Optional[frame_metrics.FrameMetrics] = None
+        first = cam.latest_frame()
+        self.__frame_shape = first.shape
+        # The full frames are read here before decimating them into the shared memory
+        self.__frame = first if decimation > 1 else None
+        self.__halves: tp.Dict[tp.Tuple[int, ...], np.ndarray] = {}
+        # The viewer reads the latest slot while the publisher writes the other one
+        self.buffer = shared_frames.SharedFrameBuffer(
+            shape=preview_shape(first.shape, decimation), dtype=first.dtype, slots=2,
+            info_size=frame_metrics.FrameMetrics.array_size() if metrics else 0)
+        self.__publish(first, self.buffer.begin_write())
+        self.buffer.end_write(info=self.__metrics(first))
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name="frame_publisher", daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def name(self) -> str:
+        """Name of the shared memory for the viewer"""
+        return self.buffer.name
+
+    def __run(self) -> None:
+        frame_count = None
+        next_time = time.monotonic()
+        while self.__running:
+            now = time.monotonic()
+            next_time = max(next_time + self.__interval, now)
+            time.sleep(next_time - now)
+            new_count = getattr(self.__cam, "frame_count", None)
+            if new_count is not None:
+                if new_count == frame_count:
+                    continue
+                frame_count = new_count
+
+            slot = self.buffer.begin_write()
+            try:
+                # Without decimation the frame is read directly into the shared memory
+                frame = self.__cam.latest_frame(output_array=slot if self.__frame is None else self.__frame)
+            except IOError as e:
+                logger.error("Reading frames for the live view failed: %s", e)
+                time.sleep(1)
+                continue
+            if self.__frame is not None:
+                self.__frame = frame
+            if frame.shape != self.__frame_shape:
+                self.__frame_shape = frame.shape
+                logger.warning(
+                    "The frame size changed to %s, the live view is scaled to %s", frame.shape, self.buffer.shape)
+            if self.__publish(frame, slot):
+                self.buffer.end_write(info=self.__metrics(frame))
+
+    def __metrics(self, frame: np.ndarray) -> tp.Optional[np.ndarray]:
+        """Compute the metrics of a frame
+
+        :return: metrics for the shared memory, or None if they are not computed
+        """
+        if not self.__measure or frame.dtype != np.uint8:
+            return None
+        self.metrics = frame_metrics.measure(frame)
+        return self.metrics.to_array()
+
+    def __publish(self, frame: np.ndarray, slot: np.ndarray) -> bool:
+        """Copy or decimate a frame into a slot
+
+        :return: whether the slot was written
+        """
+        if frame is slot:
+            return True
+        if frame.dtype != slot.dtype or frame.ndim != slot.ndim:
+            return False
+        if frame.shape == slot.shape:
+            np.copyto(slot, frame)
+            return True
+        # Halving repeatedly is about twice as fast as a single area interpolation with a factor of 4
+        while frame.shape[0] >= 4 * slot.shape[0] and frame.shape[1] >= 4 * slot.shape[1]:
+            shape = preview_shape(frame.shape, 2)
+            if shape not in self.__halves:
+                self.__halves[shape] = np.empty(shape, dtype=frame.dtype)
+            frame = cv2.resize(frame, (shape[1], shape[0]), dst=self.__halves[shape], interpolation=cv2.INTER_AREA)
+        # With an integer factor the area interpolation averages each block of pixels
+        cv2.resize(frame, (slot.shape[1], slot.shape[0]), dst=slot, interpolation=cv2.INTER_AREA)
+        return True
+
+    def close(self) -> None:
+        """Stop publishing, which also closes the viewer"""
+        self.__running = False
+        self.__thread.join()
+        self.buffer.close()
+
+
+class LiveViewer:
+    """Takes the frames for display from the shared memory"""
+    def __init__(self, buffer: shared_frames.SharedFrameBuffer, renderer: LiveRenderer):
+        """
+        :param buffer: buffer of a FramePublisher
+        :param renderer: renderer for the frames
+        """
+        self.buffer = buffer
+        self.renderer = renderer
+        # Published frames that were not displayed
+        self.skipped = RateMeter()
+        # Metrics of the latest displayed frame, if the publisher computes them
+        self.metrics: tp.Optional[frame_metrics.FrameMetrics] = None
+        # The label has a meter of its own, since the frame rate meter is ticked by the renderer
+        self.__label = RateMeter(LABEL_INTERVAL)
+        self.__number = 0
+        self.__copy: tp.Optional[np.ndarray] = None
+
+    def rate_label(self, now: tp.Optional[float] = None) -> tp.Optional[str]:
+        """Text of the rate label, once per LABEL_INTERVAL
+
+        :param now: time from time.perf_counter()
+        :return: the display rate and the skipped frame rate, or None if the label is not due
+        """
+        if not self.__label.tick(0, now):
+            return None
+        return f"{self.renderer.fps.rate:.1f} fps, {self.skipped.rate:.1f} frames/s skipped"
+
+    def next_frame(self) -> tp.Optional[np.ndarray]:
+        """Render the latest frame
+
+        :return: frame for display, which is valid until the next call, or None if there is no new frame
+        """
+        peeked = self.buffer.peek(self.__number)
+        if peeked is None:
+            return None
+        frame, number, _ = peeked
+        display = self.renderer.render(frame)
+        if display is frame:
+            # The display keeps the frame, so it cannot stay in the slot that the publisher will overwrite
+            if self.__copy is None or self.__copy.shape != frame.shape:
+                self.__copy = np.empty_like(frame)
+            np.copyto(self.__copy, frame)
+            display = self.__copy
+        info = self.buffer.info(number) if self.buffer.info_size else None
+        if not self.buffer.is_current(number):
+            # The frame was overwritten during rendering, and the next one is already available
+            return None
+        if info is not None and not np.isnan(info[0]):
+            self.metrics = frame_metrics.FrameMetrics.from_array(info)
+        if self.__number:
+            self.skipped.tick(number - self.__number - 1)
+        self.__number = number
+        return display
+
+
+def start_viewer(buffer_name: str, auto_levels: bool = False, title: str = "Live view") -> subprocess.Popen:
+    """Start the live view window in a new process, see live_viewer.py
+
+    :param buffer_name: name of the shared memory from FramePublisher.name
+    :param auto_levels: whether to stretch the contrast automatically
+    :param title: title of the window
+    :return: viewer process, which ends when the window is closed or the publisher stops
+    """
+    args = [sys.executable, "-m", "live_viewer", "--buffer", buffer_name, "--title", title]
+    if auto_levels:
+        args.append("--auto-levels")
+    # The module is found from the directory of the program regardless of the working directory of the caller
+    return subprocess.Popen(args, cwd=os.path.dirname(os.path.abspath(__file__)), close_fds=True)
@@ -0,0 +1,108 @@
+"""This module provides the live view window of ORC Dark Spot Mapper
+
+The window runs in a process of its own and displays the frames that the acquisition process publishes in shared
+memory, see live_view.FramePublisher. It is started by live_view.start_viewer(), or by hand:
+    python -m live_viewer --buffer <name of the shared memory>
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+# PyQt[Graph] has to be loaded before OpenCV to ensure that the correct Qt libraries are loaded
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore, QtGui
+
+import argparse
+import logging
+
+import numpy as np
+
+import frame_metrics
+import live_view
+from devices import shared_frames
+
+logger = logging.getLogger(__name__)
+
+# Interval of updating the metrics in seconds, short enough for following the focus while moving the z axis
+METRICS_INTERVAL = 0.2
+
+
+def run(buffer_name: str, auto_levels: bool = False, title: str = "Live view") -> None:
+    """Display the frames until the window is closed or the publisher stops
+
+    :param buffer_name: name of the shared memory from live_view.FramePublisher.name
+    :param auto_levels: whether to stretch the contrast automatically
+    :param title: title of the window
+    :return: -
+    """
+    buffer = shared_frames.SharedFrameBuffer(buffer_name)
+    viewer = live_view.LiveViewer(buffer, live_view.LiveRenderer(auto_levels=auto_levels))
+    app = pg.mkQApp()
+
+    win = QtGui.QMainWindow()
+    win.resize(1200, 700)
+    view = pg.GraphicsLayoutWidget()
+    fps_label = view.addLabel("", row=0, col=0, justify="left")
+    metrics_label = view.addLabel("", row=0, col=1, justify="right")
+    view_box = view.addViewBox(row=1, col=0, colspan=2, lockAspect=True, invertY=True)
+    # The frames are given in row-major order as they come from the camera, so they are not transposed
+    image = pg.ImageItem(axisOrder="row-major")
+    view_box.addItem(image)
+    # Histogram of the grey levels for setting the exposure
+    histogram_plot = view.addPlot(row=2, col=0, colspan=2)
+    histogram_plot.setMaximumHeight(120)
+    histogram_plot.setXRange(0, 255, padding=0)
+    histogram_plot.hideAxis("left")
+    histogram_curve = histogram_plot.plot(stepMode=True, fillLevel=0, brush=(100, 100, 255, 150))
+    win.setCentralWidget(view)
+    win.setWindowTitle(title)
+    win.show()
+
+    metrics_meter = live_view.RateMeter(METRICS_INTERVAL)
+
+    def update() -> None:
+        if buffer.closed:
+            logger.info("The frame publisher has stopped")
+            app.quit()
+            return
+        display = viewer.next_frame()
+        if display is not None:
+            # The existing image item is updated, and the levels have already been applied
+            image.setImage(display, autoLevels=False)
+        rate_label = viewer.rate_label()
+        if rate_label is not None:
+            fps_label.setText(rate_label)
+        metrics = viewer.metrics
+        if metrics is not None and metrics_meter.tick(0):
+            metrics_label.setText(
+                f"focus {metrics.focus:.0f}, mean {metrics.mean:.0f}, saturated {metrics.saturation * 100:.2f} %",
+                color="r" if metrics.saturation > frame_metrics.MAX_SATURATION else None
+            )
+            edges = np.linspace(0, 256, len(metrics.histogram) + 1)
+            histogram_curve.setData(edges, metrics.histogram)
+
+    # The timer events don't pile up, so the frames that arrive while the UI is busy are skipped
+    timer = QtCore.QTimer()
+    timer.timeout.connect(update)
+    timer.start(live_view.DISPLAY_INTERVAL)
+    app.exec_()
+    timer.stop()
+    buffer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Display the live view of a camera from shared memory")
+    parser.add_argument("--buffer", required=True, help="name of the shared memory")
+    parser.add_argument("--title", default="Live view", help="title of the window")
+    parser.add_argument("--auto-levels", action="store_true", help="stretch the contrast automatically")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(module)-16s %(message)s')
+    run(args.buffer, args.auto_levels, args.title)
+
+
+if __name__ == "__main__":
+    main()
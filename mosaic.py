@@ -0,0 +1,479 @@
+"""This module provides out-of-core mosaic writing for ORC Dark Spot Mapper
+
+The mosaic is written as an uncompressed tiled BigTIFF. The pixel data of the file is memory-mapped,
+so the tiles are pasted directly into the file and the mosaic never has to fit in RAM.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import argparse
+import glob
+import logging
+import os.path
+import queue
+import struct
+import threading
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+import image_writer
+import registration
+import stitching
+
+logger = logging.getLogger(__name__)
+
+# TIFF field types
+_SHORT = 3
+_LONG = 4
+_LONG8 = 16
+
+# TIFF tags
+_IMAGE_WIDTH = 256
+_IMAGE_LENGTH = 257
+_BITS_PER_SAMPLE = 258
+_COMPRESSION = 259
+_PHOTOMETRIC = 262
+_SAMPLES_PER_PIXEL = 277
+_PLANAR_CONFIGURATION = 284
+_TILE_WIDTH = 322
+_TILE_LENGTH = 323
+_TILE_OFFSETS = 324
+_TILE_BYTE_COUNTS = 325
+_SAMPLE_FORMAT = 339
+
+_BIGTIFF_HEADER_SIZE = 16
+_IFD_ENTRY_SIZE = 20
+# Pixel data begins at a page boundary
+_DATA_ALIGNMENT = 4096
+
+DEFAULT_TILE_SIZE = 512
+
+
+def _ifd_entry(tag: int, field_type: int, values: tp.Sequence[int], external_offset: int = 0) -> bytes:
+    """Pack a BigTIFF IFD entry
+
+    Values that do not fit in the 8-byte value field are stored at external_offset.
+    """
+    fmt = {_SHORT: "H", _LONG: "I", _LONG8: "Q"}[field_type]
+    data = struct.pack(f"<{len(values)}{fmt}", *values)
+    if len(data) <= 8:
+        return struct.pack("<HHQ", tag, field_type, len(values)) + data.ljust(8, b"\0")
+    return struct.pack("<HHQQ", tag, field_type, len(values), external_offset)
+
+
+class MosaicWriter:
+    """Writes a mosaic tile by tile into a memory-mapped tiled BigTIFF
+
+    Only the parts of the file touched by the current tile are paged in, and they are flushed regularly,
+    so the peak memory usage does not depend on the size of the mosaic. The file is created as a sparse file,
+    so the untouched parts of the canvas are black and take no disk space on most file systems.
+    """
+    def __init__(
+            self,
+            path: str,
+            canvas_size: tp.Tuple[int, int],
+            channels: int = 1,
+            dtype: np.dtype = np.uint8,
+            tile_size: int = DEFAULT_TILE_SIZE,
+            flush_interval: int = 64):
+        """
+        :param path: path of the output file
+        :param canvas_size: (width, height) of the mosaic
+        :param channels: 1 for grayscale or 3 for colour
+        :param dtype: np.uint8 or np.uint16
+        :param tile_size: width and height of the TIFF tiles, must be a multiple of 16
+        :param flush_interval: number of pasted images after which the written data is flushed to disk
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype(np.uint8), np.dtype(np.uint16)):
+            raise ValueError(f"Unsupported data type: {dtype}")
+        if channels not in (1, 3):
+            raise ValueError(f"Invalid channel count: {channels}")
+        if tile_size <= 0 or tile_size % 16:
+            raise ValueError(f"Tile size must be a positive multiple of 16: {tile_size}")
+
+        self.path = path
+        self.width, self.height = canvas_size
+        self.channels = channels
+        self.dtype = dtype
+        self.tile_size = tile_size
+        self.__flush_interval = flush_interval
+        self.__pasted = 0
+
+        self.tiles_across = -(-self.width // tile_size)
+        self.tiles_down = -(-self.height // tile_size)
+        data_offset = self.__write_header()
+
+        # The tiles are stored one after another in row-major order, so the pixel data can be viewed as a
+        # 5-dimensional array of tile rows, tile columns, and the rows, columns and channels of a tile
+        self.__data: tp.Optional[np.memmap] = np.memmap(
+            path,
+            dtype=dtype,
+            mode="r+",
+            offset=data_offset,
+            shape=(self.tiles_down, self.tiles_across, tile_size, tile_size, channels)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __write_header(self) -> int:
+        """Write the BigTIFF header and the image file directory
+
+        :return: offset of the pixel data
+        """
+        tile_count = self.tiles_across * self.tiles_down
+        tile_bytes = self.tile_size * self.tile_size * self.channels * self.dtype.itemsize
+        bits = 8 * self.dtype.itemsize
+
+        entry_count = 12
+        ifd_offset = _BIGTIFF_HEADER_SIZE
+        ifd_size = 8 + entry_count * _IFD_ENTRY_SIZE + 8
+        offsets_offset = ifd_offset + ifd_size
+        counts_offset = offsets_offset + 8 * tile_count
+        data_offset = -(-(counts_offset + 8 * tile_count) // _DATA_ALIGNMENT) * _DATA_ALIGNMENT
+
+        tile_offsets = [data_offset + i * tile_bytes for i in range(tile_count)]
+        entries = [
+            _ifd_entry(_IMAGE_WIDTH, _LONG, [self.width]),
+            _ifd_entry(_IMAGE_LENGTH, _LONG, [self.height]),
+            _ifd_entry(_BITS_PER_SAMPLE, _SHORT, [bits] * self.channels),
+            _ifd_entry(_COMPRESSION, _SHORT, [1]),
+            # 1 = black is zero, 2 = RGB
+            _ifd_entry(_PHOTOMETRIC, _SHORT, [1 if self.channels == 1 else 2]),
+            _ifd_entry(_SAMPLES_PER_PIXEL, _SHORT, [self.channels]),
+            # 1 = chunky
+            _ifd_entry(_PLANAR_CONFIGURATION, _SHORT, [1]),
+            _ifd_entry(_TILE_WIDTH, _LONG, [self.tile_size]),
+            _ifd_entry(_TILE_LENGTH, _LONG, [self.tile_size]),
+            _ifd_entry(_TILE_OFFSETS, _LONG8, tile_offsets, offsets_offset),
+            _ifd_entry(_TILE_BYTE_COUNTS, _LONG8, [tile_bytes] * tile_count, counts_offset),
+            # 1 = unsigned integer
+            _ifd_entry(_SAMPLE_FORMAT, _SHORT, [1] * self.channels),
+        ]
+        assert len(entries) == entry_count
+
+        with open(self.path, "wb") as file:
+            # Byte order, BigTIFF version, offset size, reserved, offset of the first IFD
+            file.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, ifd_offset))
+            file.write(struct.pack("<Q", entry_count))
+            file.write(b"".join(entries))
+            # No further IFDs
+            file.write(struct.pack("<Q", 0))
+            file.write(struct.pack(f"<{tile_count}Q", *tile_offsets))
+            file.write(struct.pack(f"<{tile_count}Q", *([tile_bytes] * tile_count)))
+            file.truncate(data_offset + tile_count * tile_bytes)
+        return data_offset
+
+    @property
+    def canvas_size(self) -> tp.Tuple[int, int]:
+        return self.width, self.height
+
+    def paste(self, img: np.ndarray, offset: stitching.Offset) -> None:
+        """Copy an image onto the mosaic
+
+        Parts of the image that fall outside the mosaic are cropped.
+        :param img: grayscale or BGR image
+        :param offset: (x, y) of the top left corner of the image on the mosaic
+        :return: -
+        """
+        if self.__data is None:
+            raise ValueError("The mosaic has already been closed")
+        img = stitching.convert_channels(img, self.channels)
+        if img.ndim == 2:
+            img = img[..., np.newaxis]
+        else:
+            # OpenCV uses BGR but TIFF uses RGB
+            img = img[..., ::-1]
+
+        x, y = offset
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + img.shape[1], self.width)
+        y1 = min(y + img.shape[0], self.height)
+        if x0 >= x1 or y0 >= y1:
+            logger.warning("Tile at %s is outside of the mosaic", offset)
+            return
+
+        size = self.tile_size
+        for tile_row in range(y0 // size, (y1 - 1) // size + 1):
+            top = tile_row * size
+            ty0 = max(y0, top)
+            ty1 = min(y1, top + size)
+            for tile_col in range(x0 // size, (x1 - 1) // size + 1):
+                left = tile_col * size
+                tx0 = max(x0, left)
+                tx1 = min(x1, left + size)
+                self.__data[tile_row, tile_col, ty0 - top:ty1 - top, tx0 - left:tx1 - left] = \
+                    img[ty0 - y:ty1 - y, tx0 - x:tx1 - x]
+
+        self.__pasted += 1
+        if self.__pasted % self.__flush_interval == 0:
+            self.__data.flush()
+
+    def close(self) -> None:
+        if self.__data is None:
+            return
+        self.__data.flush()
+        # Deleting the last reference to the memmap unmaps the file
+        self.__data = None
+
+
+class StreamingMosaic:
+    """Builds a mosaic and a low-resolution overview while a measurement is still running
+
+    The frames are placed according to the commanded stage positions and pasted in a background thread,
+    so the mosaic is ready soon after the last frame has been taken.
+    """
+    def __init__(
+            self,
+            path: str,
+            canvas_size: tp.Tuple[int, int],
+            origin: tp.Tuple[int, int],
+            steps_per_pixel: float,
+            overview_scale: int = 8,
+            channels: tp.Optional[int] = None,
+            dtype: tp.Optional[np.dtype] = None,
+            queue_size: int = 16):
+        """
+        :param path: path of the output BigTIFF
+        :param canvas_size: (width, height) of the mosaic
+        :param origin: stage position (x, y) in steps corresponding to the top left corner of the mosaic
+        :param steps_per_pixel: stage steps per pixel
+        :param overview_scale: downscaling factor of the overview
+        :param channels: 1 for grayscale or 3 for colour, by default that of the first frame
+        :param dtype: np.uint8 or np.uint16, by default that of the first frame
+        :param queue_size: number of frames that can wait for pasting before add() blocks
+        """
+        self.__path = path
+        self.__canvas_size = canvas_size
+        self.__origin = origin
+        self.__steps_per_pixel = steps_per_pixel
+        self.__overview_scale = overview_scale
+        self.__channels = channels
+        self.__dtype = dtype
+        # The mosaic is created once its channels and data type are known
+        self.__writer: tp.Optional[MosaicWriter] = None
+        self.__overview: tp.Optional[np.ndarray] = None
+        self.__overview_lock = threading.Lock()
+        if channels is not None and dtype is not None:
+            self.__open(channels, np.dtype(dtype))
+        self.__error: tp.Optional[Exception] = None
+        self.__queue: "queue.Queue[tp.Optional[tp.Tuple[np.ndarray, tp.Tuple[int, int]]]]" = \
+            queue.Queue(maxsize=queue_size)
+        self.__thread = threading.Thread(target=self.__run, name="mosaic", daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def offset(self, position: tp.Tuple[int, int]) -> stitching.Offset:
+        """Pixel offset of a frame taken at the given stage position
+
+        The stage y axis points up, whereas the image y axis points down.
+        :param position: stage position (x, y) in steps
+        :return: (x, y) offset on the mosaic
+        """
+        x = (position[0] - self.__origin[0]) / self.__steps_per_pixel
+        y = (self.__origin[1] - position[1]) / self.__steps_per_pixel
+        return int(round(x)), int(round(y))
+
+    def add(self, frame: np.ndarray, position: tp.Tuple[int, int]) -> None:
+        """Queue a frame for pasting
+
+        The frame must not be modified afterwards.
+        :param frame: image
+        :param position: commanded stage position (x, y) in steps at which the frame was taken
+        :return: -
+        """
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put((frame, position))
+
+    @property
+    def overview(self) -> tp.Optional[np.ndarray]:
+        """A copy of the current overview, None if the mosaic has not been created yet"""
+        with self.__overview_lock:
+            return None if self.__overview is None else self.__overview.copy()
+
+    def __open(self, channels: int, dtype: np.dtype) -> None:
+        """Create the mosaic and the overview
+
+        :param channels: 1 for grayscale or 3 for colour
+        :param dtype: np.uint8 or np.uint16
+        :return: -
+        """
+        self.__writer = MosaicWriter(self.__path, self.__canvas_size, channels=channels, dtype=dtype)
+        self.__channels = channels
+        self.__dtype = dtype
+        width, height = self.__canvas_size
+        scale = self.__overview_scale
+        overview_shape = (-(-height // scale), -(-width // scale))
+        if channels != 1:
+            overview_shape += (channels,)
+        with self.__overview_lock:
+            self.__overview = np.zeros(overview_shape, dtype=dtype)
+
+    def __run(self) -> None:
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if self.__error is not None:
+                continue
+            frame, position = item
+            try:
+                self.__paste(frame, self.offset(position))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Pasting frame at %s failed", position)
+                self.__error = e
+
+    def __paste(self, frame: np.ndarray, offset: stitching.Offset) -> None:
+        if self.__writer is None:
+            channels = self.__channels
+            if channels is None:
+                # BGRA frames are stored as BGR
+                channels = 1 if frame.ndim == 2 else min(frame.shape[2], 3)
+            self.__open(channels, np.dtype(frame.dtype if self.__dtype is None else self.__dtype))
+        if frame.dtype != self.__dtype:
+            raise ValueError(f"The frame is {frame.dtype}, but the mosaic is {self.__dtype}")
+        frame = stitching.convert_channels(frame, self.__channels)
+        self.__writer.paste(frame, offset)
+
+        scale = self.__overview_scale
+        small = cv2.resize(
+            frame,
+            (max(frame.shape[1] // scale, 1), max(frame.shape[0] // scale, 1)),
+            interpolation=cv2.INTER_AREA
+        )
+        with self.__overview_lock:
+            stitching.paste(self.__overview, small, (offset[0] // scale, offset[1] // scale))
+
+    def close(self, overview_path: tp.Optional[str] = None) -> None:
+        """Wait for the queued frames to be pasted and close the mosaic
+
+        :param overview_path: path for saving the overview image
+        :return: -
+        """
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+            if self.__writer is not None:
+                self.__writer.close()
+                if overview_path is not None:
+                    stitching.write_image(overview_path, self.overview)
+        if self.__error is not None:
+            raise self.__error
+
+
+def area_tiles(directory: str, pattern: str = "*.png") -> tp.List[str]:
+    """Find the pictures of an area measurement in the order they were taken
+
+    The picture numbers are zero-padded, so the alphabetical order is the measurement order.
+    :param directory: directory of the area measurement
+    :param pattern: glob pattern of the pictures
+    :return: list of paths
+    """
+    # The stitches, mosaics and overviews of the measurement are in the same directory
+    paths = sorted(
+        path for path in glob.glob(os.path.join(directory, pattern))
+        if not any(part in os.path.basename(path) for part in ("stitch", "mosaic", "overview"))
+    )
+    if not paths:
+        raise stitching.StitchError(f"No images found in {directory}")
+    return paths
+
+
+def write_mosaic(
+        tiles: tp.Iterable[tp.Tuple[stitching.Tile, stitching.Offset]],
+        canvas_size: tp.Tuple[int, int],
+        path: str,
+        channels: int = 1,
+        tile_size: int = DEFAULT_TILE_SIZE) -> None:
+    """Stitch tiles into a tiled BigTIFF one tile at a time
+
+    :param tiles: (tile, offset) pairs, where a tile is an image or a path to an image file
+    :param canvas_size: (width, height) of the mosaic
+    :param path: path of the output file
+    :param channels: 1 for grayscale or 3 for colour
+    :param tile_size: width and height of the TIFF tiles
+    :return: -
+    """
+    start_time = time.perf_counter()
+    count = 0
+    with MosaicWriter(path, canvas_size, channels=channels, tile_size=tile_size) as writer:
+        for tile, offset in tiles:
+            img = stitching.read_image(tile, channels) if isinstance(tile, str) else tile
+            writer.paste(img, offset)
+            count += 1
+    logger.info("Wrote mosaic %s of %d tiles in %.1f s", path, count, time.perf_counter() - start_time)
+
+
+def stitch_area(
+        directory: str,
+        path: str,
+        columns: int,
+        pitch: int = stitching.PITCH,
+        tile_shape: tp.Tuple[int, int] = (1280, 960),
+        channels: int = 1,
+        register: bool = True,
+        fmt: str = image_writer.DEFAULT_FORMAT,
+        pattern: tp.Optional[str] = None) -> None:
+    """Stitch the pictures of an area measurement into a tiled BigTIFF
+
+    :param directory: directory of the area measurement
+    :param path: path of the output file
+    :param columns: number of pictures per row in the measurement
+    :param pitch: distance between neighbouring pictures in pixels
+    :param tile_shape: (width, height) of a picture
+    :param channels: 1 for grayscale or 3 for colour
+    :param register: whether to refine the positions by registering the overlapping pictures
+    :param fmt: format in which the pictures were written, see image_writer.FORMATS
+    :param pattern: glob pattern of the pictures, by default all the pictures of the format
+    :return: -
+    """
+    if pattern is None:
+        pattern = "*" + image_writer.FORMATS[fmt].extension
+    paths = area_tiles(directory, pattern)
+    rows = -(-len(paths) // columns)
+    if len(paths) != rows * columns:
+        logger.warning("The area measurement has %d pictures, which is not a multiple of %d", len(paths), columns)
+    canvas_size = ((columns - 1) * pitch + tile_shape[0], (rows - 1) * pitch + tile_shape[1])
+    tiles = list(zip(paths, stitching.grid_layout(columns, rows, pitch)))
+    if register:
+        tiles = registration.register(tiles, tile_shape)
+    write_mosaic(tiles, canvas_size, path, channels=channels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stitch an area measurement into a tiled BigTIFF")
+    parser.add_argument("directory", help="directory of the area measurement")
+    parser.add_argument("columns", type=int, help="number of pictures per row")
+    parser.add_argument("-o", "--output", help="output file, by default DIRECTORY/mosaic.tif")
+    parser.add_argument("--no-register", action="store_true", help="place the pictures on the nominal grid")
+    parser.add_argument("-f", "--format", default=image_writer.DEFAULT_FORMAT, choices=list(image_writer.FORMATS),
+                        help="format of the pictures")
+    parser.add_argument("-p", "--pattern", help="glob pattern of the pictures, by default all of the format")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    output = args.output if args.output else os.path.join(args.directory, "mosaic.tif")
+    stitch_area(
+        args.directory, output, args.columns, register=not args.no_register, fmt=args.format, pattern=args.pattern)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""This module benchmarks the measurement pipeline of ORC Dark Spot Mapper without hardware
+
+An area measurement is run with the synthetic camera and the simulated stage, the pictures are written with the
+image writer and stitched into a mosaic as in an actual measurement, and the time of each phase is reported.
+    python pipeline_benchmark.py --columns 5 --rows 4
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import argparse
+import logging
+import math
+import os.path
+import tempfile
+import time
+import typing as tp
+
+import image_writer
+import mosaic
+from devices import camera_synthetic
+
+logger = logging.getLogger(__name__)
+
+# Stage steps between the pictures, as in DSM.measure_area()
+MSTEP = 36000
+
+
+def area_scan(
+        cam: camera_synthetic.SyntheticCamera,
+        stage: camera_synthetic.SimulatedStage,
+        directory: str,
+        columns: int,
+        rows: int,
+        fmt: str = image_writer.DEFAULT_FORMAT,
+        mstep: int = MSTEP) -> tp.Dict[str, float]:
+    """Take the pictures of an area in the serpentine order of DSM.measure_area()
+
+    :param cam: camera
+    :param stage: stage, the scan begins at its current position
+    :param directory: directory for the pictures
+    :param columns: number of pictures per row
+    :param rows: number of rows
+    :param fmt: image format, see image_writer.FORMATS
+    :param mstep: stage steps between the pictures
+    :return: phase -> duration in seconds
+    """
+    total = columns * rows
+    digits = int(math.ceil(math.log10(total + 1)))
+    timings = {"moving": 0.0, "capture": 0.0}
+    start_time = time.perf_counter()
+    with image_writer.ImageWriter(fmt=fmt) as writer:
+        i = 1
+        for y in range(1, rows + 1):
+            for x in range(1, columns + 1):
+                capture_start = time.perf_counter()
+                frame = cam.get_frame()
+                timings["capture"] += time.perf_counter() - capture_start
+                writer.write(os.path.join(directory, f"area_{str(i).zfill(digits)}"), frame)
+                i += 1
+
+                move_start = time.perf_counter()
+                if x < columns:
+                    if y % 2 == 0:
+                        stage.step_left(mstep)
+                    else:
+                        stage.step_right(mstep)
+                elif y < rows:
+                    stage.step_down(mstep)
+                stage.wait_until_settled()
+                timings["moving"] += time.perf_counter() - move_start
+        write_start = time.perf_counter()
+        writer.flush()
+        timings["writing after the scan"] = time.perf_counter() - write_start
+    timings["scan"] = time.perf_counter() - start_time
+    return timings
+
+
+def run(
+        directory: str,
+        columns: int,
+        rows: int,
+        fmt: str = image_writer.DEFAULT_FORMAT,
+        register: bool = True,
+        move_time: bool = True,
+        **camera_kwargs) -> tp.Dict[str, float]:
+    """Measure and stitch an area
+
+    :param directory: directory for the pictures and the mosaic
+    :param columns: number of pictures per row
+    :param rows: number of rows
+    :param fmt: image format, see image_writer.FORMATS
+    :param register: whether to refine the positions by registering the overlapping pictures
+    :param move_time: whether the stage moves take time as with the actual stage
+    :param camera_kwargs: arguments for the camera, see camera_synthetic.SyntheticCamera
+    :return: phase -> duration in seconds
+    """
+    stage = camera_synthetic.SimulatedStage(move_time=move_time)
+    cam = camera_synthetic.SyntheticCamera(position=stage.position, **camera_kwargs)
+    # Start from the upper left corner of the area, centered on the wafer
+    stage.goto(-(columns - 1) * MSTEP // 2, (rows - 1) * MSTEP // 2)
+    stage.wait_until_settled()
+
+    timings = area_scan(cam, stage, directory, columns, rows, fmt)
+    start_time = time.perf_counter()
+    mosaic.stitch_area(
+        directory,
+        os.path.join(directory, "area_mosaic.tif"),
+        columns,
+        tile_shape=cam.resolution,
+        channels=cam.channels,
+        register=register,
+        fmt=fmt
+    )
+    timings["stitching"] = time.perf_counter() - start_time
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark an area measurement with a synthetic camera")
+    parser.add_argument("--columns", type=int, default=4, help="number of pictures per row")
+    parser.add_argument("--rows", type=int, default=3, help="number of rows")
+    parser.add_argument("-f", "--format", default=image_writer.DEFAULT_FORMAT, choices=list(image_writer.FORMATS))
+    parser.add_argument("--fps", type=float, default=30, help="frame rate of the camera, 0 for unlimited")
+    parser.add_argument("--noise", type=float, default=2.0, help="noise of the camera in gray levels")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of the camera in seconds")
+    parser.add_argument("--instant", action="store_true", help="move the stage without delay")
+    parser.add_argument("--no-register", action="store_true", help="stitch at the nominal positions")
+    parser.add_argument("-d", "--directory", help="directory for the pictures, by default a temporary one")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(module)-16s %(message)s')
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        timings = run(
+            directory,
+            args.columns,
+            args.rows,
+            fmt=args.format,
+            register=not args.no_register,
+            move_time=not args.instant,
+            fps=args.fps or None,
+            noise=args.noise,
+            latency=args.latency
+        )
+    total = args.columns * args.rows
+    for phase, duration in timings.items():
+        print(f"{phase:<24}{duration:>8.2f} s{duration / total * 1000:>10.1f} ms/picture")
+
+
+if __name__ == "__main__":
+    main()
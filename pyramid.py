@@ -0,0 +1,212 @@
+"""This module provides multi-resolution image pyramids for ORC Dark Spot Mapper
+
+The pyramids are written in the Deep Zoom format: a NAME.dzi descriptor and a NAME_files folder with a
+subfolder for each level, containing the tiles as COLUMN_ROW.png. Level 0 is a single pixel and each
+level doubles the resolution until the last level has the full resolution. The format can also be opened
+with OpenSeadragon and other Deep Zoom viewers.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import functools
+import logging
+import math
+import os.path
+import time
+import typing as tp
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+import stitching
+
+logger = logging.getLogger(__name__)
+
+DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+DEFAULT_TILE_SIZE = 256
+# Number of rows processed at a time when downsampling, must be even
+STRIP_HEIGHT = 1024
+
+# (x, y, width, height) in full-resolution pixels
+Viewport = tp.Tuple[int, int, int, int]
+
+
+def max_level(width: int, height: int) -> int:
+    """The level with the full resolution
+
+    :param width: width of the full-resolution image
+    :param height: height of the full-resolution image
+    :return: level number
+    """
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def level_size(width: int, height: int, level: int) -> tp.Tuple[int, int]:
+    """Size of a pyramid level
+
+    :param width: width of the full-resolution image
+    :param height: height of the full-resolution image
+    :param level: level number
+    :return: (width, height) of the level
+    """
+    scale = 2 ** (max_level(width, height) - level)
+    return int(math.ceil(width / scale)), int(math.ceil(height / scale))
+
+
+def files_dir(dzi_path: str) -> str:
+    return f"{os.path.splitext(dzi_path)[0]}_files"
+
+
+def halve(img: np.ndarray) -> np.ndarray:
+    """Downsample an image by a factor of two using area averaging
+
+    The image is processed in strips, so it can also be a memory-mapped array that does not fit in RAM.
+    :param img: image
+    :return: downsampled image
+    """
+    height, width = img.shape[:2]
+    out_width = int(math.ceil(width / 2))
+    out = np.empty((int(math.ceil(height / 2)), out_width) + img.shape[2:], dtype=img.dtype)
+    for top in range(0, height, STRIP_HEIGHT):
+        strip = np.ascontiguousarray(img[top:top + STRIP_HEIGHT])
+        out_rows = int(math.ceil(strip.shape[0] / 2))
+        out[top // 2:top // 2 + out_rows] = cv2.resize(
+            strip, (out_width, out_rows), interpolation=cv2.INTER_AREA).reshape((out_rows, out_width) + img.shape[2:])
+    return out
+
+
+def write_pyramid(
+        img: np.ndarray,
+        dzi_path: str,
+        tile_size: int = DEFAULT_TILE_SIZE,
+        tile_format: str = "png") -> None:
+    """Write a Deep Zoom pyramid of an image
+
+    :param img: full-resolution image, for example a stitch or a memory-mapped mosaic
+    :param dzi_path: path of the .dzi descriptor, the tiles are written next to it
+    :param tile_size: width and height of the tiles
+    :param tile_format: file extension of the tiles, such as png or jpg
+    :return: -
+    """
+    start_time = time.perf_counter()
+    height, width = img.shape[:2]
+    tiles_path = files_dir(dzi_path)
+    top_level = max_level(width, height)
+    count = 0
+
+    level_img = img
+    for level in range(top_level, -1, -1):
+        if level != top_level:
+            level_img = halve(level_img)
+        level_dir = os.path.join(tiles_path, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        level_height, level_width = level_img.shape[:2]
+        for row in range(int(math.ceil(level_height / tile_size))):
+            for col in range(int(math.ceil(level_width / tile_size))):
+                tile = level_img[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+                stitching.write_image(os.path.join(level_dir, f"{col}_{row}.{tile_format}"), tile)
+                count += 1
+
+    root = ET.Element(
+        "Image",
+        {"xmlns": DZI_NAMESPACE, "Format": tile_format, "Overlap": "0", "TileSize": str(tile_size)}
+    )
+    ET.SubElement(root, "Size", {"Width": str(width), "Height": str(height)})
+    ET.ElementTree(root).write(dzi_path, encoding="UTF-8", xml_declaration=True)
+    logger.info("Wrote pyramid %s with %d tiles in %.1f s", dzi_path, count, time.perf_counter() - start_time)
+
+
+class PyramidReader:
+    """Reads the parts of a Deep Zoom pyramid needed for a viewport
+
+    Recently used tiles are cached, so panning only reads the tiles that come into view.
+    """
+    def __init__(self, dzi_path: str, cache_size: int = 512):
+        """
+        :param dzi_path: path of the .dzi descriptor
+        :param cache_size: number of tiles to keep in memory
+        """
+        root = ET.parse(dzi_path).getroot()
+        size = root.find(f"{{{DZI_NAMESPACE}}}Size")
+        if size is None:
+            size = root.find("Size")
+        if size is None:
+            raise ValueError(f"Invalid Deep Zoom descriptor: {dzi_path}")
+        self.width = int(size.get("Width"))
+        self.height = int(size.get("Height"))
+        self.tile_size = int(root.get("TileSize"))
+        self.overlap = int(root.get("Overlap", "0"))
+        if self.overlap:
+            raise ValueError("Pyramids with overlapping tiles are not supported")
+        self.tile_format = root.get("Format")
+        self.max_level = max_level(self.width, self.height)
+        self.__files_dir = files_dir(dzi_path)
+        self.read_tile = functools.lru_cache(maxsize=cache_size)(self.__read_tile)
+
+    def level_size(self, level: int) -> tp.Tuple[int, int]:
+        return level_size(self.width, self.height, level)
+
+    def level_for_scale(self, scale: float) -> int:
+        """The smallest level that has at least the given resolution
+
+        :param scale: displayed pixels per full-resolution pixel, 1 for the full resolution
+        :return: level number
+        """
+        if scale <= 0:
+            raise ValueError(f"Invalid scale: {scale}")
+        level = self.max_level + int(math.ceil(math.log2(min(scale, 1))))
+        return max(level, 0)
+
+    def tiles_in_viewport(self, viewport: Viewport, level: int) -> tp.List[tp.Tuple[int, int]]:
+        """Tiles of a level that cover a viewport
+
+        :param viewport: (x, y, width, height) in full-resolution pixels
+        :param level: level number
+        :return: list of (column, row)
+        """
+        x0, y0, x1, y1 = self.__level_bounds(viewport, level)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        size = self.tile_size
+        return [
+            (col, row)
+            for row in range(y0 // size, (y1 - 1) // size + 1)
+            for col in range(x0 // size, (x1 - 1) // size + 1)
+        ]
+
+    def __level_bounds(self, viewport: Viewport, level: int) -> tp.Tuple[int, int, int, int]:
+        """Viewport clipped to the image and converted to the pixel coordinates of a level"""
+        if not 0 <= level <= self.max_level:
+            raise ValueError(f"Invalid level: {level}")
+        x, y, width, height = viewport
+        scale = 2 ** (self.max_level - level)
+        level_width, level_height = self.level_size(level)
+        x0 = min(max(x // scale, 0), level_width)
+        y0 = min(max(y // scale, 0), level_height)
+        x1 = min(max(int(math.ceil((x + width) / scale)), 0), level_width)
+        y1 = min(max(int(math.ceil((y + height) / scale)), 0), level_height)
+        return x0, y0, x1, y1
+
+    def __read_tile(self, level: int, col: int, row: int) -> np.ndarray:
+        return stitching.read_image(os.path.join(self.__files_dir, str(level), f"{col}_{row}.{self.tile_format}"))
+
+    def read_viewport(self, viewport: Viewport, scale: float = 1) -> tp.Tuple[np.ndarray, int]:
+        """Compose the part of the image within a viewport from the tiles of the suitable level
+
+        :param viewport: (x, y, width, height) in full-resolution pixels
+        :param scale: displayed pixels per full-resolution pixel
+        :return: image and its level number
+        """
+        level = self.level_for_scale(scale)
+        x0, y0, x1, y1 = self.__level_bounds(viewport, level)
+        tiles = self.tiles_in_viewport(viewport, level)
+        size = self.tile_size
+        parts = [(self.read_tile(level, col, row), (col * size - x0, row * size - y0)) for col, row in tiles]
+        if not parts:
+            return np.zeros((0, 0), dtype=np.uint8), level
+        return stitching.stitch(parts, (x1 - x0, y1 - y0)), level
@@ -0,0 +1,279 @@
+"""This module provides registration-based tile placement for ORC Dark Spot Mapper
+
+The offsets between overlapping neighbours are estimated with FFT phase correlation, and the tile positions
+are then solved as a global least-squares problem. The nominal positions given by the stage act as a weak
+prior, so tiles whose overlaps have no features to correlate stay where the stage put them.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import collections
+import logging
+import time
+import typing as tp
+
+import numpy as np
+
+import stitching
+
+logger = logging.getLogger(__name__)
+
+# Overlaps are cropped to at most this size along each axis to save time
+MAX_WINDOW = 512
+# Overlaps smaller than this along either axis are not correlated
+MIN_OVERLAP = 32
+# Correlation peaks lower than this are considered unreliable
+MIN_PEAK = 0.03
+# Measured offsets differing more than this from the nominal ones are rejected, in pixels
+MAX_SHIFT = 100
+# Weight of the nominal positions relative to the pairwise measurements
+PRIOR_WEIGHT = 1e-3
+# Number of pairs correlated at a time
+BATCH_SIZE = 32
+
+
+def _hann(length: int) -> np.ndarray:
+    return np.hanning(length + 2)[1:-1].astype(np.float32)
+
+
+def phase_correlate(a: np.ndarray, b: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """Sub-pixel shifts between batches of equally sized images
+
+    :param a: reference images as an array of shape (batch, height, width)
+    :param b: moving images of the same shape
+    :return: (shifts, peaks), where shifts[k] = (dx, dy) such that b[k](x, y) ~ a[k](x + dx, y + dy),
+        and peaks[k] is the height of the correlation peak between 0 and 1
+    """
+    if a.shape != b.shape or a.ndim != 3:
+        raise ValueError(f"Invalid batch shapes: {a.shape}, {b.shape}")
+    batch, height, width = a.shape
+    window = np.outer(_hann(height), _hann(width))
+    a = (a - a.mean(axis=(1, 2), keepdims=True)) * window
+    b = (b - b.mean(axis=(1, 2), keepdims=True)) * window
+
+    cross = np.fft.rfft2(a) * np.conj(np.fft.rfft2(b))
+    cross /= np.abs(cross) + 1e-9
+    corr = np.fft.irfft2(cross, s=(height, width))
+
+    flat = corr.reshape(batch, -1).argmax(axis=1)
+    peak_y, peak_x = np.unravel_index(flat, (height, width))
+    rows = np.arange(batch)
+    peaks = corr[rows, peak_y, peak_x]
+
+    def subpixel(prev: np.ndarray, centre: np.ndarray, nxt: np.ndarray) -> np.ndarray:
+        denom = prev - 2 * centre + nxt
+        safe = np.where(np.abs(denom) > 1e-12, denom, 1)
+        return np.where(np.abs(denom) > 1e-12, 0.5 * (prev - nxt) / safe, 0)
+
+    dy = peak_y + subpixel(
+        corr[rows, (peak_y - 1) % height, peak_x], peaks, corr[rows, (peak_y + 1) % height, peak_x])
+    dx = peak_x + subpixel(
+        corr[rows, peak_y, (peak_x - 1) % width], peaks, corr[rows, peak_y, (peak_x + 1) % width])
+    # The correlation is circular, so large shifts are negative ones
+    dy = np.where(dy > height / 2, dy - height, dy)
+    dx = np.where(dx > width / 2, dx - width, dx)
+    return np.stack([dx, dy], axis=1), peaks
+
+
+def find_pairs(offsets: np.ndarray, tile_shape: tp.Tuple[int, int], min_overlap: int = MIN_OVERLAP) -> np.ndarray:
+    """Find the pairs of tiles that overlap
+
+    :param offsets: nominal (x, y) offsets of the tiles as an array of shape (n, 2)
+    :param tile_shape: (width, height) of the tiles
+    :param min_overlap: minimum overlap along both axes in pixels
+    :return: array of shape (m, 2) of tile index pairs (i, j) with i < j
+    """
+    width, height = tile_shape
+    pairs = []
+    # Compared in chunks to limit the memory usage with thousands of tiles
+    for start in range(0, len(offsets), 1024):
+        diff = np.abs(offsets[start:start + 1024, np.newaxis, :] - offsets[np.newaxis, :, :])
+        overlapping = (width - diff[..., 0] >= min_overlap) & (height - diff[..., 1] >= min_overlap)
+        i, j = np.nonzero(overlapping)
+        i += start
+        keep = i < j
+        pairs.append(np.stack([i[keep], j[keep]], axis=1))
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=int)
+
+
+def _windows(offset_i: np.ndarray, offset_j: np.ndarray, tile_shape: tp.Tuple[int, int], max_window: int) \
+        -> tp.Tuple[tp.Tuple[slice, slice], tp.Tuple[slice, slice]]:
+    """Slices of the nominal overlap of two tiles, as (rows, columns) of tile i and of tile j"""
+    width, height = tile_shape
+    x0 = max(offset_i[0], offset_j[0])
+    x1 = min(offset_i[0], offset_j[0]) + width
+    y0 = max(offset_i[1], offset_j[1])
+    y1 = min(offset_i[1], offset_j[1]) + height
+    # Crop to the centre of the overlap
+    crop_x = max(x1 - x0 - max_window, 0) // 2
+    crop_y = max(y1 - y0 - max_window, 0) // 2
+    x0, x1 = x0 + crop_x, x1 - crop_x
+    y0, y1 = y0 + crop_y, y1 - crop_y
+    win_i = (slice(y0 - offset_i[1], y1 - offset_i[1]), slice(x0 - offset_i[0], x1 - offset_i[0]))
+    win_j = (slice(y0 - offset_j[1], y1 - offset_j[1]), slice(x0 - offset_j[0], x1 - offset_j[0]))
+    return win_i, win_j
+
+
+class _TileCache:
+    """Keeps the most recently used tiles in memory as grayscale images"""
+    def __init__(self, tiles: tp.Sequence[stitching.Tile], size: int):
+        self.__tiles = tiles
+        self.__size = size
+        self.__cache: tp.OrderedDict[int, np.ndarray] = collections.OrderedDict()
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index in self.__cache:
+            self.__cache.move_to_end(index)
+            return self.__cache[index]
+        tile = self.__tiles[index]
+        if isinstance(tile, str):
+            img = stitching.read_image(tile, 1)
+        else:
+            img = stitching.convert_channels(tile, 1)
+        self.__cache[index] = img
+        if len(self.__cache) > self.__size:
+            self.__cache.popitem(last=False)
+        return img
+
+
+def measure_pairs(
+        tiles: tp.Sequence[stitching.Tile],
+        offsets: np.ndarray,
+        pairs: np.ndarray,
+        tile_shape: tp.Tuple[int, int],
+        max_window: int = MAX_WINDOW,
+        cache_size: int = 192) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """Measure the offsets between overlapping tiles
+
+    The pairs are correlated in batches of equally sized overlaps. Tiles given as paths are loaded on demand,
+    so the pairs should be ordered so that the tiles needed together are close to each other.
+    :param tiles: images or paths to image files
+    :param offsets: nominal (x, y) offsets of the tiles as an array of shape (n, 2)
+    :param pairs: tile index pairs as an array of shape (m, 2)
+    :param tile_shape: (width, height) of the tiles
+    :param max_window: maximum size of the correlated area along each axis
+    :param cache_size: number of tiles to keep in memory
+    :return: (measured, peaks), where measured[k] is the measured offset of tile j relative to tile i
+    """
+    cache = _TileCache(tiles, cache_size)
+    measured = np.zeros((len(pairs), 2), dtype=np.float64)
+    peaks = np.zeros(len(pairs), dtype=np.float64)
+    # The pairs are batched by the shape of their overlap, as only equally sized windows can be stacked
+    pending: tp.Dict[tp.Tuple[int, int], tp.List[tp.Tuple[int, np.ndarray, np.ndarray]]] = \
+        collections.defaultdict(list)
+
+    def correlate(batch: tp.List[tp.Tuple[int, np.ndarray, np.ndarray]]) -> None:
+        indices = np.array([k for k, _, _ in batch])
+        a = np.stack([win_a for _, win_a, _ in batch]).astype(np.float32)
+        b = np.stack([win_b for _, _, win_b in batch]).astype(np.float32)
+        shifts, batch_peaks = phase_correlate(a, b)
+        # If the overlap in tile j matches that of tile i shifted by s, tile j is displaced by s
+        measured[indices] = offsets[pairs[indices, 1]] - offsets[pairs[indices, 0]] + shifts
+        peaks[indices] = batch_peaks
+
+    for k, (i, j) in enumerate(pairs):
+        win_i, win_j = _windows(offsets[i], offsets[j], tile_shape, max_window)
+        shape = (win_i[0].stop - win_i[0].start, win_i[1].stop - win_i[1].start)
+        pending[shape].append((k, cache[i][win_i], cache[j][win_j]))
+        if len(pending[shape]) >= BATCH_SIZE:
+            correlate(pending.pop(shape))
+    for batch in pending.values():
+        correlate(batch)
+    return measured, peaks
+
+
+def _solve(
+        count: int,
+        pairs: np.ndarray,
+        measured: np.ndarray,
+        weights: np.ndarray,
+        nominal: np.ndarray,
+        prior_weight: float,
+        tolerance: float = 1e-6,
+        max_iterations: int = 1000) -> np.ndarray:
+    """Solve the weighted least-squares positions with the conjugate gradient method
+
+    Minimises sum(w * |p_j - p_i - m_ij|^2) + prior_weight * sum(|p_k - nominal_k|^2).
+    The normal equations form a sparse graph Laplacian, which is applied with vectorized bincounts.
+    """
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    def matvec(x: np.ndarray) -> np.ndarray:
+        diff = (x[j] - x[i]) * weights[:, np.newaxis]
+        out = prior_weight * x
+        for axis in range(2):
+            out[:, axis] += np.bincount(j, diff[:, axis], minlength=count)
+            out[:, axis] -= np.bincount(i, diff[:, axis], minlength=count)
+        return out
+
+    rhs = prior_weight * nominal
+    weighted = measured * weights[:, np.newaxis]
+    for axis in range(2):
+        rhs[:, axis] += np.bincount(j, weighted[:, axis], minlength=count)
+        rhs[:, axis] -= np.bincount(i, weighted[:, axis], minlength=count)
+
+    x = nominal.astype(np.float64)
+    residual = rhs - matvec(x)
+    direction = residual.copy()
+    res_norm = np.sum(residual ** 2, axis=0)
+    rhs_norm = max(float(np.sum(rhs ** 2)), 1e-12)
+    for _ in range(max_iterations):
+        if res_norm.sum() <= tolerance ** 2 * rhs_norm:
+            break
+        product = matvec(direction)
+        alpha = res_norm / np.maximum(np.sum(direction * product, axis=0), 1e-300)
+        x += alpha * direction
+        residual -= alpha * product
+        new_norm = np.sum(residual ** 2, axis=0)
+        direction = residual + (new_norm / np.maximum(res_norm, 1e-300)) * direction
+        res_norm = new_norm
+    return x
+
+
+def register(
+        tiles: tp.Sequence[tp.Tuple[stitching.Tile, stitching.Offset]],
+        tile_shape: tp.Tuple[int, int] = None,
+        min_peak: float = MIN_PEAK,
+        max_shift: float = MAX_SHIFT,
+        prior_weight: float = PRIOR_WEIGHT,
+        cache_size: int = 192) -> tp.List[tp.Tuple[stitching.Tile, stitching.Offset]]:
+    """Refine the offsets of the tiles of a scan by registering the overlaps of neighbouring tiles
+
+    :param tiles: (tile, nominal offset) pairs in the order they were taken
+    :param tile_shape: (width, height) of the tiles, or None to read it from the first tile
+    :param min_peak: minimum correlation peak for a measurement to be used
+    :param max_shift: maximum deviation of a measurement from the nominal offset in pixels
+    :param prior_weight: weight of the nominal positions relative to the measurements
+    :param cache_size: number of tiles to keep in memory
+    :return: (tile, offset) pairs with the registered offsets, in the original order
+    """
+    start_time = time.perf_counter()
+    images = [tile for tile, _ in tiles]
+    nominal = np.array([offset for _, offset in tiles], dtype=np.int64).reshape(-1, 2)
+    if len(tiles) < 2:
+        return list(tiles)
+    if tile_shape is None:
+        first = images[0] if not isinstance(images[0], str) else stitching.read_image(images[0], 1)
+        tile_shape = (first.shape[1], first.shape[0])
+
+    pairs = find_pairs(nominal, tile_shape)
+    # Process the pairs in the order of their later tile, so that the tiles are loaded roughly once
+    pairs = pairs[np.argsort(pairs.max(axis=1), kind="stable")]
+    measured, peaks = measure_pairs(images, nominal, pairs, tile_shape, cache_size=cache_size)
+
+    deviation = np.abs(measured - (nominal[pairs[:, 1]] - nominal[pairs[:, 0]])).max(axis=1)
+    valid = (peaks >= min_peak) & (deviation <= max_shift)
+    logger.debug("Registration: %d of %d overlaps usable", int(valid.sum()), len(pairs))
+
+    positions = _solve(len(tiles), pairs[valid], measured[valid], peaks[valid], nominal.astype(np.float64),
+                       prior_weight)
+    offsets = np.rint(positions).astype(int)
+    logger.info(
+        "Registered %d tiles in %.2f s, maximum correction %d px",
+        len(tiles), time.perf_counter() - start_time, int(np.abs(offsets - nominal).max())
+    )
+    return [(image, (int(x), int(y))) for image, (x, y) in zip(images, offsets)]
@@ -0,0 +1,156 @@
+"""This module provides image-based settle detection for ORC Dark Spot Mapper
+
+The stage commands return immediately, so the measurements used to wait for a fixed time after every move. Instead,
+consecutive camera frames are compared, and the stage is considered settled as soon as the image stops moving.
+The image shift between the frames is measured by phase correlation, which is insensitive to the camera noise.
+In featureless areas the shift is unreliable, and the mean absolute difference of the frames is used instead.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import logging
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+from devices import camera
+
+logger = logging.getLogger(__name__)
+
+# The frames are downsampled by this factor, which also averages out most of the noise
+SCALE = 4
+# Maximum image shift of a still image in full-resolution pixels
+MAX_SHIFT = 1.0
+# Phase correlation peaks below this are considered unreliable
+MIN_RESPONSE = 0.1
+# Maximum mean absolute difference of still downsampled frames in grey levels
+MAX_DIFFERENCE = 2.0
+# Number of consecutive still frame pairs required
+STABLE_FRAMES = 2
+
+
+class SettleResult(tp.NamedTuple):
+    settled: bool
+    # Time from the start of waiting in seconds
+    elapsed: float
+    frames: int
+    # Whether the image was seen moving at all
+    moved: bool
+
+
+class SettleDetector:
+    """Decides from consecutive frames whether the image is still"""
+    def __init__(
+            self,
+            max_shift: float = MAX_SHIFT,
+            max_difference: float = MAX_DIFFERENCE,
+            min_response: float = MIN_RESPONSE,
+            scale: int = SCALE):
+        """
+        :param max_shift: maximum image shift of a still image in full-resolution pixels
+        :param max_difference: maximum mean absolute difference of still downsampled frames in grey levels
+        :param min_response: minimum phase correlation peak for the shift to be used
+        :param scale: downsampling factor
+        """
+        self.max_shift = max_shift
+        self.max_difference = max_difference
+        self.min_response = min_response
+        self.scale = scale
+        self.__previous: tp.Optional[np.ndarray] = None
+        self.__window: tp.Optional[np.ndarray] = None
+        # Measurements of the latest frame pair
+        self.shift = (0.0, 0.0)
+        self.response = 0.0
+        self.difference = 0.0
+
+    def reset(self) -> None:
+        self.__previous = None
+
+    def __prepare(self, frame: np.ndarray) -> np.ndarray:
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = frame.shape
+        small = cv2.resize(frame, (width // self.scale, height // self.scale), interpolation=cv2.INTER_AREA)
+        return small.astype(np.float32)
+
+    def update(self, frame: np.ndarray) -> tp.Optional[bool]:
+        """Compare a frame to the previous one
+
+        :param frame: frame
+        :return: whether the image is still, or None for the first frame
+        """
+        current = self.__prepare(frame)
+        previous = self.__previous
+        self.__previous = current
+        if previous is None or previous.shape != current.shape:
+            return None
+        if self.__window is None or self.__window.shape != current.shape[::-1]:
+            self.__window = cv2.createHanningWindow(current.shape[::-1], cv2.CV_32F)
+
+        self.difference = float(cv2.norm(current, previous, cv2.NORM_L1)) / current.size
+        # The mean is removed so that the window itself does not produce a peak at zero shift
+        (dx, dy), self.response = cv2.phaseCorrelate(
+            (previous - previous.mean()) * self.__window,
+            (current - current.mean()) * self.__window
+        )
+        if not np.isfinite(self.response):
+            self.response = 0.0
+        self.shift = (dx * self.scale, dy * self.scale)
+        if self.response >= self.min_response:
+            return abs(self.shift[0]) <= self.max_shift and abs(self.shift[1]) <= self.max_shift
+        return self.difference <= self.max_difference
+
+
+def wait_until_still(
+        cam: camera.Camera,
+        timeout: float,
+        min_time: float = 0,
+        stable_frames: int = STABLE_FRAMES,
+        detector: tp.Optional[SettleDetector] = None,
+        unmoved_min_time: tp.Optional[float] = None) -> SettleResult:
+    """Wait until the camera image stops moving
+
+    A still image before the stage has started to move looks the same as a settled one. If the image has not been
+    seen moving, it is therefore accepted only after unmoved_min_time, which should cover the whole move.
+    :param cam: camera, preferably grabbing in the background so that the frames are fresh
+    :param timeout: maximum waiting time in seconds
+    :param min_time: minimum waiting time in seconds after the image has been seen moving
+    :param stable_frames: number of consecutive still frame pairs required
+    :param detector: detector with custom limits
+    :param unmoved_min_time: minimum waiting time in seconds if the image has not been seen moving, by default min_time
+    :return: result
+    """
+    if unmoved_min_time is None:
+        unmoved_min_time = min_time
+    if detector is None:
+        detector = SettleDetector()
+    detector.reset()
+    start_time = time.perf_counter()
+    count = 0
+    still = 0
+    moved = False
+    for frame in cam.frames(2**31):
+        count += 1
+        elapsed = time.perf_counter() - start_time
+        is_still = detector.update(frame)
+        if is_still is not None:
+            if is_still:
+                still += 1
+            else:
+                still = 0
+                moved = True
+            if still >= stable_frames and elapsed >= (min_time if moved else unmoved_min_time):
+                return SettleResult(True, elapsed, count, moved)
+        if elapsed >= timeout:
+            logger.warning(
+                "The image did not settle within %.2f s, shift %s px, difference %.1f",
+                timeout, detector.shift, detector.difference
+            )
+            return SettleResult(False, elapsed, count, moved)
+    return SettleResult(False, time.perf_counter() - start_time, count, moved)
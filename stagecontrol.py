@@ -16,6 +16,12 @@ logger = logging.getLogger(__name__)
 # Misc parameters
 MAX_INC_STEPS: int = 40000000
 AXES = ("TTL232R", "TTL232R2", "TTL232R3")
+# INCTARGET takes a 16-bit value, so the incremental moves are split into chunks of this size
+INC_CHUNK_STEPS = 32000
+# Maximum following error of a settled axis in steps, about a pixel of the camera
+SETTLE_TOLERANCE = 50
+# Maximum time to wait for the axes to settle in seconds
+SETTLE_TIMEOUT = 10.0
 
 # Experimental values from SL309 Dark Spot Mapper
 MM_TO_STEPS = 51122.04724409449
@@ -29,7 +35,16 @@ class StageControl:
             mm_to_steps: float = MM_TO_STEPS,
             vx: float = VX,
             vy: float = VY,
-            axes: tp.List[str] = AXES):
+            axes: tp.List[str] = AXES,
+            absolute: bool = True):
+        """
+        :param mm_to_steps: steps per mm
+        :param vx: velocity of the x axis in steps/s
+        :param vy: velocity of the y axis in steps/s
+        :param axes: device names of the x, y and z axes
+        :param absolute: whether to move with absolute targets once the axes have been homed,
+            otherwise the moves are incremental
+        """
 
         # Device names for TTL adapters
         self.__axis1 = axes[0]
@@ -40,6 +55,17 @@ class StageControl:
         self.__y: int = 0
         self.__abort = False
 
+        # The drives track their absolute targets from the homed zero
+        self.__drives = {axis: sm.Axis(axis, INC_CHUNK_STEPS, absolute) for axis in axes[:3]}
+        # Axes that have been commanded to move since they last settled -> estimated end of the move,
+        # None for the z axis, the speed of which is not known
+        self.__moving: tp.Dict[str, tp.Optional[float]] = {}
+
+        # Time of the first move command of the ongoing moves and the estimated end of the moves,
+        # for comparing the actual move times to the estimates
+        self.__move_start: tp.Optional[float] = None
+        self.__move_end = 0.0
+
         # Experimental values from SL309 Dark Spot Mapper
         self.mm_to_steps = mm_to_steps
         # Velocities (steps / s)
@@ -52,11 +78,32 @@ class StageControl:
         time.sleep(10)
         self.__abort = False
         self.reset_coords()
+        self.__forget_targets()
+        self.__moving.clear()
 
     def goto(self, x: int, y: int) -> None:
         self.moveinc(self.__axis1, x - self.__x)
         self.moveinc(self.__axis2, y - self.__y)
 
+    def __forget_targets(self) -> None:
+        """The drives may have stopped anywhere, so they move incrementally until the next homing"""
+        for drive in self.__drives.values():
+            drive.forget_target()
+
+    def home(self, axes: tp.Iterable[str] = ("x", "y"), timeout: float = sm.HOMING_TIMEOUT) -> None:
+        """Run the homing of the axes, after which they move with absolute targets
+
+        The homing moves the stage, so the stage coordinates are zeroed.
+        :param axes: x, y and/or z
+        :param timeout: maximum time for homing in seconds
+        """
+        names = {"x": self.__axis1, "y": self.__axis2, "z": self.__axis3}
+        devices = [names[axis] for axis in axes]
+        sm.home([self.__drives[device] for device in devices], timeout)
+        for device in devices:
+            self.__moving.pop(device, None)
+        self.reset_coords()
+
     def moveinc(self, axis: str, steps: int) -> bool:
         """Move incremental steps
 
@@ -65,36 +112,94 @@ class StageControl:
         :return: bool of success
         """
 
+        if self.__abort:
+            self.__abort_move()
+
         if abs(steps) > MAX_INC_STEPS:
-            logger.error("Error: too many steps %s")
+            logger.error(f"Error: too many steps {steps}")
             return False
 
         if axis == self.__axis1:
             self.__x += steps
         elif axis == self.__axis2:
             self.__y += steps
+        end = self.__estimate(axis, steps)
+        if steps:
+            self.__moving[axis] = max(end, self.__moving.get(axis) or 0.0) if axis != self.__axis3 else None
 
         # Axis x is inverted in the Dark Spot Mapper
         if axis == self.__axis1:
             steps *= -1
 
-        while abs(steps) > 32760:
-            if self.__abort:
-                self.reset_coords()
-                raise dsm_exceptions.AbortException
-
-            if steps < 0:
-                sm.move_inc(axis, -32000)
-                steps += 32000
-            elif steps > 0:
-                sm.move_inc(axis, 32000)
-                steps -= 32000
-            else:
-                raise ValueError
-
-        sm.move_inc(axis, steps)
+        if not self.__drives[axis].move(steps, lambda: self.__abort):
+            self.__abort_move()
         return True
 
+    def __abort_move(self) -> None:
+        """Stop sending moves during an abort
+
+        :raises dsm_exceptions.AbortException: always
+        """
+        self.reset_coords()
+        self.__forget_targets()
+        self.__moving.clear()
+        raise dsm_exceptions.AbortException
+
+    def __estimate(self, axis: str, steps: int) -> float:
+        """Record the start and the estimated end of a move
+
+        :return: estimated end of the move of this axis as time.monotonic()
+        """
+        now = time.monotonic()
+        if self.__move_start is None or now > self.__move_end:
+            self.__move_start = now
+            self.__move_end = now
+        if axis == self.__axis1:
+            duration = self.time(steps, 0)
+        elif axis == self.__axis2:
+            duration = self.time(0, steps)
+        else:
+            duration = 0.0
+        self.__move_end = max(self.__move_end, now + duration)
+        return now + duration
+
+    def wait_until_settled(
+            self,
+            axes: tp.Iterable[str] = ("x", "y"),
+            tolerance: int = SETTLE_TOLERANCE,
+            timeout: float = SETTLE_TIMEOUT) -> float:
+        """Wait until the axes have reached their targets according to the drives
+
+        :param axes: x, y and/or z
+        :param tolerance: maximum following error in steps
+        :param timeout: maximum waiting time in seconds
+        :return: time from the first move command until the axes settled in seconds
+        """
+        names = {"x": self.__axis1, "y": self.__axis2, "z": self.__axis3}
+        # The axes that have not moved are not waited for, since they would never be seen moving
+        devices = [names[axis] for axis in axes if names[axis] in self.__moving]
+        # A target reached bit is accepted once the estimated move time has passed even if the axis was not seen
+        # moving, so the axes of earlier moves that nobody waited for, such as the moves from the GUI, settle at once
+        now = time.monotonic()
+        min_times = {
+            device: max(0.0, self.__moving[device] - now) for device in devices if self.__moving[device] is not None
+        }
+        move_start = self.__move_start
+        sm.wait_until_settled(devices, tolerance, timeout, min_times)
+        for device in devices:
+            del self.__moving[device]
+        if move_start is None:
+            return 0.0
+        now = time.monotonic()
+        elapsed = now - move_start
+        logger.debug(
+            "Move took %.3f s, estimated %.3f s, waiting with the estimate would have taken %.3f s longer",
+            elapsed, self.__move_end - move_start, self.__move_end - now
+        )
+        if self.__move_start == move_start:
+            self.__move_start = None
+        return elapsed
+
     def moveinc_mm(self, axis: str, mm: float) -> bool:
         return self.moveinc(axis, int(round(mm * self.mm_to_steps)))
 
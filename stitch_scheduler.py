@@ -0,0 +1,185 @@
+"""This module provides parallel stitching for ORC Dark Spot Mapper
+
+Stitches are run in a process pool, so independent stitches use all the cores of the computer.
+A stitch can depend on other stitches, in which case it is started once all of them have finished.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import concurrent.futures
+import logging
+import os.path
+import threading
+import typing as tp
+
+import pyramid
+import registration
+import stitching
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyError(RuntimeError):
+    """Raised for a job whose dependency failed"""
+
+
+class StitchScheduler:
+    """Bounded process pool with dependencies between the jobs"""
+    def __init__(self, max_workers: tp.Optional[int] = None, max_pending: tp.Optional[int] = None):
+        """
+        :param max_workers: number of worker processes, by default the number of cores
+        :param max_pending: number of unfinished jobs after which submit() blocks, by default unlimited
+        """
+        self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        self.__slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.__lock = threading.Lock()
+        # Number of jobs waiting for their dependencies
+        self.__waiting = 0
+        # Jobs that have been handed to the pool but have not finished yet
+        self.__jobs: tp.Set[concurrent.futures.Future] = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs that have been submitted but have not started yet"""
+        with self.__lock:
+            return self.__waiting + sum(not job.running() for job in self.__jobs)
+
+    @property
+    def active(self) -> int:
+        """Number of jobs that have been submitted but have not finished yet"""
+        with self.__lock:
+            return self.__waiting + len(self.__jobs)
+
+    def submit(
+            self,
+            fn: tp.Callable,
+            *args,
+            depends_on: tp.Iterable[concurrent.futures.Future] = (),
+            **kwargs) -> concurrent.futures.Future:
+        """Schedule a job
+
+        The function and its arguments are sent to a worker process, so they must be picklable.
+        :param fn: function to be run
+        :param args: positional arguments for the function
+        :param depends_on: futures of the jobs that have to finish before this job is started
+        :param kwargs: keyword arguments for the function
+        :return: future of the result of the job
+        """
+        if self.__slots is not None:
+            self.__slots.acquire()
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if self.__slots is not None:
+            future.add_done_callback(lambda _: self.__slots.release())
+        with self.__lock:
+            self.__waiting += 1
+
+        dependencies = list(depends_on)
+        remaining = [len(dependencies)]
+        remaining_lock = threading.Lock()
+
+        def dependency_done(_: concurrent.futures.Future) -> None:
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self.__start(future, dependencies, fn, args, kwargs)
+
+        if dependencies:
+            for dependency in dependencies:
+                dependency.add_done_callback(dependency_done)
+        else:
+            self.__start(future, dependencies, fn, args, kwargs)
+        return future
+
+    def __start(
+            self,
+            future: concurrent.futures.Future,
+            dependencies: tp.List[concurrent.futures.Future],
+            fn: tp.Callable,
+            args: tuple,
+            kwargs: dict) -> None:
+        with self.__lock:
+            self.__waiting -= 1
+        failed = [dependency for dependency in dependencies if dependency.cancelled() or dependency.exception()]
+        if failed:
+            future.set_exception(DependencyError(f"{len(failed)} of {len(dependencies)} dependencies failed"))
+            return
+        if not future.set_running_or_notify_cancel():
+            return
+        with self.__lock:
+            try:
+                job = self.__executor.submit(_run, fn, args, kwargs)
+            except RuntimeError as e:
+                # The pool has been shut down
+                future.set_exception(e)
+                return
+            self.__jobs.add(job)
+        job.add_done_callback(lambda done: self.__finish(future, done))
+
+    def __finish(self, future: concurrent.futures.Future, job: concurrent.futures.Future) -> None:
+        with self.__lock:
+            self.__jobs.discard(job)
+        if job.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            future.set_result(job.result())
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the worker processes
+
+        :param wait: whether to wait for the running jobs to finish
+        :return: -
+        """
+        self.__executor.shutdown(wait=wait)
+
+
+def _run(fn: tp.Callable, args: tuple, kwargs: dict):
+    return fn(*args, **kwargs)
+
+
+# Jobs
+# These are run in the worker processes and therefore return only the path of the result instead of the image
+
+def stitch_9_job(directory: str, path: str, register: bool = True, extension: str = ".png") -> str:
+    """Stitch a set of 9 pictures into a file
+
+    :param directory: directory in which the images are
+    :param path: path of the stitch
+    :param register: whether to refine the positions by registering the overlapping pictures
+    :param extension: file extension of the pictures, see image_writer.FORMATS
+    :return: path of the stitch
+    """
+    tiles = [
+        (stitching.read_image(tile), offset) for tile, offset in stitching.nine_tiles(directory, extension=extension)
+    ]
+    if register:
+        tiles = registration.register(tiles)
+    stitching.stitch_to_file(tiles, stitching.NINE_CANVAS, path)
+    return path
+
+
+def stitch_wafer_job(wafer_path: str, path: str, write_pyramid: bool = True) -> str:
+    """Stitch the site stitches of a wafer measurement into a file
+
+    :param wafer_path: directory of the wafer measurement
+    :param path: path of the stitch
+    :param write_pyramid: whether to write a Deep Zoom pyramid next to the stitch
+    :return: path of the stitch
+    """
+    wafer_img = stitching.stitch_wafer(wafer_path, path)
+    if write_pyramid:
+        # The pyramid allows viewing the stitch without loading all of it
+        pyramid.write_pyramid(wafer_img, os.path.splitext(path)[0] + ".dzi")
+    return path
@@ -0,0 +1,332 @@
+"""This module provides in-process image stitching for ORC Dark Spot Mapper
+
+The tiles are composed into a preallocated NumPy canvas instead of running ImageMagick in a shell.
+"""
+
+__author__ = "Mika Mäki"
+__copyright__ = "Copyright 2016-2020, Tampere University"
+__credits__ = ["Mika Mäki"]
+__maintainer__ = "Mika Mäki"
+__email__ = "mika.maki@tuni.fi"
+
+import glob
+import logging
+import os.path
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (x, y) of the top left corner of a tile on the canvas, in pixels
+Offset = tp.Tuple[int, int]
+# A tile can be given either as an image or as a path to an image file
+Tile = tp.Union[str, np.ndarray]
+
+# Distance between neighbouring pictures of a 36000-step grid, in pixels
+PITCH: int = 760
+
+# Canvas sizes as (width, height). These match background_3x3.png and background_wafer.png.
+NINE_CANVAS: tp.Tuple[int, int] = (2800, 2480)
+WAFER_CANVAS: tp.Tuple[int, int] = (14400, 12800)
+
+# Picture number -> offset for the 3x3 stitches
+# The pictures are taken in a serpentine order, and therefore the middle row is reversed.
+# The tiles are composed in this order, so the later tiles cover the overlapping parts of the earlier ones.
+NINE_LAYOUT: tp.Dict[int, Offset] = {
+    1: (0, 0),
+    2: (760, 0),
+    3: (1520, 0),
+    6: (0, 760),
+    5: (760, 760),
+    4: (1520, 760),
+    7: (0, 1520),
+    8: (760, 1520),
+    9: (1520, 1520),
+}
+
+# For non-rotated images
+NINE_LAYOUT_NON_ROTATED: tp.Dict[int, Offset] = {
+    9: (0, 0),
+    8: (760, 0),
+    7: (1520, 0),
+    4: (0, 760),
+    5: (760, 760),
+    6: (1520, 760),
+    3: (0, 1520),
+    2: (760, 1520),
+    1: (1520, 1520),
+}
+
+# Site folder -> offset for the 13-site wafer stitch
+WAFER_LAYOUT: tp.Dict[str, Offset] = {
+    "00x20": (5800, 0),
+    "00x10": (5800, 2580),
+    "-10x10": (2900, 2580),
+    "10x10": (8700, 2580),
+    "00x00": (5800, 5160),
+    "-20x00": (0, 5160),
+    "-10x00": (2900, 5160),
+    "10x00": (8700, 5160),
+    "20x00": (11600, 5160),
+    "00x-10": (5800, 7740),
+    "-10x-10": (2900, 7740),
+    "10x-10": (8700, 7740),
+    "00x-20": (5800, 10320),
+}
+
+
+class StitchError(IOError):
+    """Raised when a stitch cannot be created"""
+
+
+def read_image(path: str, channels: tp.Optional[int] = None) -> np.ndarray:
+    """Read an image file
+
+    :param path: path to the image, raw NumPy .npy files are also supported
+    :param channels: 1 for grayscale, 3 for BGR or None to keep the channels of the file
+    :return: image
+    """
+    if path.lower().endswith(".npy"):
+        try:
+            img = np.load(path)
+        except (OSError, ValueError) as e:
+            raise StitchError(f"Could not read image {path}: {e}") from e
+        return img if channels is None else convert_channels(img, channels)
+    if channels is None:
+        flags = cv2.IMREAD_UNCHANGED
+    elif channels == 1:
+        flags = cv2.IMREAD_GRAYSCALE
+    elif channels == 3:
+        flags = cv2.IMREAD_COLOR
+    else:
+        raise ValueError(f"Invalid channel count: {channels}")
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise StitchError(f"Could not read image: {path}")
+    return img
+
+
+def write_image(path: str, img: np.ndarray, params: tp.Sequence[int] = ()) -> None:
+    """Write an image file, the format is determined by the file extension
+
+    :param path: path of the output file, .npy writes the raw array
+    :param img: image
+    :param params: OpenCV encoding parameters such as (cv2.IMWRITE_PNG_COMPRESSION, 1)
+    :return: -
+    """
+    if path.lower().endswith(".npy"):
+        try:
+            np.save(path, img)
+        except OSError as e:
+            raise StitchError(f"Could not write image {path}: {e}") from e
+        return
+    try:
+        ret = cv2.imwrite(path, img, list(params))
+    except cv2.error as e:
+        raise StitchError(f"Could not write image {path}: {e}") from e
+    if not ret:
+        raise StitchError(f"Could not write image: {path}")
+
+
+def find_tile(pattern: str) -> str:
+    """Find the single file matching a glob pattern
+
+    :param pattern: glob pattern such as directory/*1.png
+    :return: path of the file
+    """
+    matches = glob.glob(pattern)
+    if not matches:
+        raise StitchError(f"No image found for {pattern}")
+    if len(matches) > 1:
+        raise StitchError(f"Multiple images found for {pattern}: {sorted(matches)}")
+    return matches[0]
+
+
+def find_newest(pattern: str) -> str:
+    """Find the newest file matching a glob pattern
+
+    Files with the same modification time are ordered by their paths, so the choice does not depend on the order
+    of the directory listing.
+    :param pattern: glob pattern such as directory/*stitch.png
+    :return: path of the file
+    """
+    matches = glob.glob(pattern)
+    if not matches:
+        raise StitchError(f"No image found for {pattern}")
+    return max(matches, key=lambda path: (os.path.getmtime(path), path))
+
+
+def convert_channels(img: np.ndarray, channels: int) -> np.ndarray:
+    """Convert an image to the given channel count
+
+    :param img: grayscale, BGR or BGRA image
+    :param channels: 1 or 3
+    :return: converted image or the original image if no conversion is needed
+    """
+    img_channels = 1 if img.ndim == 2 else img.shape[2]
+    if img_channels == channels:
+        return img
+    if channels == 1:
+        code = cv2.COLOR_BGR2GRAY if img_channels == 3 else cv2.COLOR_BGRA2GRAY
+    elif channels == 3:
+        code = cv2.COLOR_GRAY2BGR if img_channels == 1 else cv2.COLOR_BGRA2BGR
+    else:
+        raise ValueError(f"Invalid channel count: {channels}")
+    return cv2.cvtColor(img, code)
+
+
+def paste(canvas: np.ndarray, img: np.ndarray, offset: Offset) -> None:
+    """Copy an image onto the canvas in place
+
+    Parts of the image that fall outside the canvas are cropped, as with ImageMagick -composite.
+    :param canvas: canvas to be modified
+    :param img: image with the same channel count as the canvas
+    :param offset: (x, y) of the top left corner of the image on the canvas
+    :return: -
+    """
+    x, y = offset
+    height, width = canvas.shape[:2]
+    img_height, img_width = img.shape[:2]
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + img_width, width)
+    y1 = min(y + img_height, height)
+    if x0 >= x1 or y0 >= y1:
+        logger.warning("Tile at %s is outside of the canvas", offset)
+        return
+    canvas[y0:y1, x0:x1] = img[y0 - y:y1 - y, x0 - x:x1 - x]
+
+
+def stitch(
+        tiles: tp.Iterable[tp.Tuple[Tile, Offset]],
+        canvas_size: tp.Tuple[int, int],
+        channels: tp.Optional[int] = None,
+        out: tp.Optional[np.ndarray] = None) -> np.ndarray:
+    """Compose tiles into a single image
+
+    The tiles are composed in the given order, so later tiles cover the earlier ones where they overlap.
+    :param tiles: (tile, offset) pairs, where a tile is an image or a path to an image file
+    :param canvas_size: (width, height) of the canvas
+    :param channels: channel count of the canvas, or None to use that of the first tile
+    :param out: preallocated canvas to compose onto, its contents are overwritten
+    :return: the stitched image
+    """
+    width, height = canvas_size
+    canvas = out
+    if canvas is not None:
+        if canvas.shape[:2] != (height, width):
+            raise ValueError(f"Canvas shape {canvas.shape} does not match the size {canvas_size}")
+        canvas[...] = 0
+        channels = 1 if canvas.ndim == 2 else canvas.shape[2]
+
+    for tile, offset in tiles:
+        if isinstance(tile, str):
+            img = read_image(tile, channels)
+        else:
+            img = tile
+        if canvas is None:
+            if channels is None:
+                channels = 1 if img.ndim == 2 else img.shape[2]
+            shape = (height, width) if channels == 1 else (height, width, channels)
+            canvas = np.zeros(shape, dtype=img.dtype)
+        paste(canvas, convert_channels(img, channels), offset)
+
+    if canvas is None:
+        raise StitchError("No tiles to stitch")
+    return canvas
+
+
+def stitch_to_file(
+        tiles: tp.Iterable[tp.Tuple[Tile, Offset]],
+        canvas_size: tp.Tuple[int, int],
+        path: str,
+        channels: tp.Optional[int] = None) -> np.ndarray:
+    """Compose tiles into a single image and write it to a file
+
+    :param tiles: (tile, offset) pairs
+    :param canvas_size: (width, height) of the canvas
+    :param path: path of the output file
+    :param channels: channel count of the canvas, or None to use that of the first tile
+    :return: the stitched image
+    """
+    start_time = time.perf_counter()
+    canvas = stitch(tiles, canvas_size, channels)
+    write_image(path, canvas)
+    logger.debug("Stitching %s took %.2f s", path, time.perf_counter() - start_time)
+    return canvas
+
+
+def grid_layout(columns: int, rows: int, pitch: int = PITCH, serpentine: bool = True) -> tp.List[Offset]:
+    """Offsets of the pictures of a grid measurement in the order they were taken
+
+    The measurement begins from the upper left corner and proceeds row by row.
+    :param columns: number of pictures per row
+    :param rows: number of rows
+    :param pitch: distance between neighbouring pictures in pixels
+    :param serpentine: whether every other row is taken from right to left
+    :return: list of offsets
+    """
+    offsets = []
+    for row in range(rows):
+        cols = range(columns)
+        if serpentine and row % 2 == 1:
+            cols = reversed(cols)
+        offsets.extend((col * pitch, row * pitch) for col in cols)
+    return offsets
+
+
+def nine_tiles(
+        directory: str,
+        layout: tp.Dict[int, Offset] = None,
+        extension: str = ".png") -> tp.List[tp.Tuple[str, Offset]]:
+    """Find the pictures of a 3x3 measurement
+
+    :param directory: directory in which the images are
+    :param layout: picture number -> offset
+    :param extension: file extension of the pictures, see image_writer.FORMATS
+    :return: (path, offset) pairs
+    """
+    if layout is None:
+        layout = NINE_LAYOUT
+    return [
+        (find_tile(os.path.join(directory, f"*{number}{extension}")), offset) for number, offset in layout.items()
+    ]
+
+
+def wafer_tiles(wafer_path: str, layout: tp.Dict[str, Offset] = None) -> tp.List[tp.Tuple[str, Offset]]:
+    """Find the site stitches of a wafer measurement
+
+    A site may have several stitches if it has been re-stitched under another name, and the newest one is used.
+    :param wafer_path: directory of the wafer measurement
+    :param layout: site folder -> offset
+    :return: (path, offset) pairs
+    """
+    if layout is None:
+        layout = WAFER_LAYOUT
+    return [(find_newest(os.path.join(wafer_path, site, "*stitch.png")), offset) for site, offset in layout.items()]
+
+
+def stitch_9(directory: str, path: str, layout: tp.Dict[int, Offset] = None, extension: str = ".png") -> np.ndarray:
+    """Stitch a set of 9 pictures
+
+    :param directory: directory in which the images are
+    :param path: path of the output file
+    :param layout: picture number -> offset
+    :param extension: file extension of the pictures, see image_writer.FORMATS
+    :return: the stitched image
+    """
+    return stitch_to_file(nine_tiles(directory, layout, extension), NINE_CANVAS, path)
+
+
+def stitch_wafer(wafer_path: str, path: str, layout: tp.Dict[str, Offset] = None) -> np.ndarray:
+    """Stitch the site stitches of a wafer measurement
+
+    :param wafer_path: directory of the wafer measurement
+    :param path: path of the output file
+    :param layout: site folder -> offset
+    :return: the stitched image
+    """
+    return stitch_to_file(wafer_tiles(wafer_path, layout), WAFER_CANVAS, path)
@@ -0,0 +1,107 @@
+import os.path
+import time
+import unittest
+
+import numpy as np
+
+from devices import camera
+from devices import camera_group
+
+
+class SlowCamera(camera.Camera):
+    """Camera that takes a fixed time to read a frame"""
+    def __init__(self, value: int, delay: float = 0.1, fail: bool = False):
+        super().__init__(value)
+        self.value = value
+        self.delay = delay
+        self.fail = fail
+
+    def get_frame(self, output_array=None):
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError("Could not read frame from the camera")
+        return np.full((4, 6), self.value, dtype=np.uint8)
+
+
+class ClosableCamera(SlowCamera):
+    def __init__(self, value: int, fail: bool = False):
+        super().__init__(value, delay=0)
+        self.closed = False
+        self.fail_close = fail
+
+    def close(self):
+        self.closed = True
+        if self.fail_close:
+            raise IOError("Could not release the camera")
+
+
+class GrabbingCamera(SlowCamera):
+    """Camera with a frame grabber, which stamps the frames"""
+    grabbing = True
+
+    def get_frame_after(self, timestamp, timeout=5):
+        return self.get_frame(), timestamp + 0.01
+
+
+class CameraGroupTest(unittest.TestCase):
+    def test_cameras_are_read_in_parallel(self):
+        with camera_group.CameraGroup({"main": SlowCamera(1), "filter": SlowCamera(2)}) as group:
+            start_time = time.monotonic()
+            frames = group.grab()
+            elapsed = time.monotonic() - start_time
+        self.assertLess(elapsed, 0.18)
+        self.assertEqual(list(frames), ["main", "filter"])
+        self.assertEqual(frames["filter"].frame[0, 0], 2)
+        self.assertLessEqual(abs(frames["main"].timestamp - frames["filter"].timestamp), 0.05)
+        # The frames are stamped when the reads began, not when they ended
+        self.assertLess(frames["main"].timestamp - start_time, 0.05)
+
+    def test_grabber_timestamps_are_used(self):
+        with camera_group.CameraGroup({"main": GrabbingCamera(1), "filter": SlowCamera(2)}) as group:
+            start_time = time.monotonic()
+            frames = group.grab()
+        self.assertEqual(frames["main"].frame[0, 0], 1)
+        self.assertAlmostEqual(frames["main"].timestamp - start_time, 0.01, delta=0.04)
+
+    def test_averaging(self):
+        with camera_group.CameraGroup({"main": SlowCamera(3, delay=0)}) as group:
+            frames = group.grab(n=4)
+        self.assertEqual(frames["main"].frame[0, 0], 3)
+
+    def test_error_is_raised(self):
+        with camera_group.CameraGroup({"main": SlowCamera(1), "filter": SlowCamera(2, fail=True)}) as group:
+            with self.assertRaises(IOError):
+                group.grab()
+
+    def test_tile_paths(self):
+        with camera_group.CameraGroup({"main": SlowCamera(1), "filter": SlowCamera(2)}) as group:
+            self.assertEqual(group.primary, "main")
+            path = os.path.join("wafer", "A", "sample_A_1.png")
+            self.assertEqual(group.tile_path(path, "main"), path)
+            self.assertEqual(
+                group.tile_path(path, "filter"), os.path.join("wafer", "A", "filter", "filter_sample_A_1.png"))
+            with self.assertRaises(KeyError):
+                group.tile_path(path, "other")
+
+    def test_cameras_are_closed(self):
+        cameras = {"main": ClosableCamera(1), "filter": ClosableCamera(2)}
+        with camera_group.CameraGroup(cameras):
+            pass
+        self.assertFalse(any(cam.closed for cam in cameras.values()))
+        # An error does not keep the other cameras open
+        cameras = {"main": ClosableCamera(1, fail=True), "other": SlowCamera(2), "filter": ClosableCamera(3)}
+        group = camera_group.CameraGroup(cameras)
+        with self.assertLogs(camera_group.logger, "WARNING"):
+            group.close(close_cameras=True)
+        self.assertTrue(cameras["main"].closed)
+        self.assertTrue(cameras["filter"].closed)
+
+    def test_invalid_names(self):
+        with self.assertRaises(ValueError):
+            camera_group.CameraGroup({})
+        with self.assertRaises(ValueError):
+            camera_group.CameraGroup({os.path.join("a", "b"): SlowCamera(1)})
+
+
+if __name__ == "__main__":
+    unittest.main()
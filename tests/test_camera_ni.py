@@ -16,7 +16,18 @@ class NICameraTest(unittest.TestCase):
         self.camera.set_cam_setting(camera_ni.CameraSettings.SHUTTER, 500)
 
     def test_take_pic(self):
-        self.camera.take_pic()
+        frame = self.camera.take_pic()
+        width, height = self.camera.resolution
+        self.assertEqual(frame.shape, (height, width))
+
+    def test_frame_is_read_into_the_given_array(self):
+        frame = self.camera.get_frame()
+        self.assertIs(self.camera.get_frame(output_array=frame), frame)
+
+    def test_view_is_flipped_frame(self):
+        view = self.camera.grab_view()
+        self.assertFalse(view.flags.writeable)
+        self.assertEqual(view.shape, self.camera.get_frame().shape)
 
     def test_save_pic(self):
         path = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,78 @@
+import tempfile
+import threading
+import unittest
+
+from devices import camera_opencv as cam_cv
+
+
+class CountingCapture:
+    """Stand-in for cv2.VideoCapture that counts the property round trips"""
+    def __init__(self):
+        self.values = {}
+        self.gets = 0
+        self.sets = 0
+
+    def get(self, prop):
+        self.gets += 1
+        return self.values.get(prop, 0.0)
+
+    def set(self, prop, value):
+        self.sets += 1
+        if prop == cam_cv.Props.ZOOM:
+            return False
+        self.values[prop] = value
+        return True
+
+    def release(self):
+        pass
+
+
+def counting_camera():
+    cam = cam_cv.CameraCV.__new__(cam_cv.CameraCV)
+    cam._cam = CountingCapture()
+    cam._cam_lock = threading.Lock()
+    cam._grabber = None
+    cam._props = {}
+    return cam
+
+
+class CameraPropertiesTest(unittest.TestCase):
+    def test_only_changed_values_are_sent(self):
+        cam = counting_camera()
+        values = {cam_cv.Props.BRIGHTNESS: 1500, cam_cv.Props.GAIN: 0}
+        self.assertEqual(cam.set_props(values), 2)
+        self.assertEqual(cam.set_props(values), 0)
+        self.assertEqual(cam.set_props({cam_cv.Props.BRIGHTNESS: 1400, cam_cv.Props.GAIN: 0}), 1)
+        self.assertEqual(cam._cam.sets, 3)
+
+    def test_values_are_cached(self):
+        cam = counting_camera()
+        cam.get_prop(cam_cv.Props.GAMMA)
+        cam.get_prop(cam_cv.Props.GAMMA)
+        self.assertEqual(cam._cam.gets, 1)
+        cam.get_prop(cam_cv.Props.GAMMA, refresh=True)
+        self.assertEqual(cam._cam.gets, 2)
+
+    def test_unsupported_property(self):
+        cam = counting_camera()
+        with self.assertRaises(ValueError):
+            cam.set_props({cam_cv.Props.ZOOM: 2, cam_cv.Props.GAIN: 5})
+        self.assertEqual(cam.get_prop(cam_cv.Props.GAIN), 5)
+
+    def test_profile_round_trip(self):
+        values = {cam_cv.Props.BRIGHTNESS: 1500, cam_cv.Props.EXPOSURE: 230}
+        with tempfile.TemporaryDirectory() as directory:
+            cam_cv.save_profile("thin_film", values, directory)
+            self.assertEqual(cam_cv.list_profiles(directory), ["thin_film"])
+            self.assertEqual(cam_cv.load_profile("thin_film", directory), values)
+            cam = counting_camera()
+            cam.apply_profile("thin_film", directory)
+            self.assertEqual(cam.get_prop(cam_cv.Props.EXPOSURE), 230)
+
+    def test_invalid_profile_name(self):
+        with self.assertRaises(ValueError):
+            cam_cv.profile_path("../escape")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import connection
+from unittest import mock
+
+import numpy as np
+
+from devices import camera_opencv
+from devices import camera_service
+from devices import shared_frames
+
+ADDRESS = ("localhost", 6123)
+
+
+def setUpModule():
+    # The key file of the user is not touched
+    directory = tempfile.TemporaryDirectory()
+    patch = mock.patch.object(camera_service, "AUTHKEY_PATH", os.path.join(directory.name, "camera.key"))
+    patch.start()
+    unittest.addModuleCleanup(directory.cleanup)
+    unittest.addModuleCleanup(patch.stop)
+
+
+class SharedFrameBufferTest(unittest.TestCase):
+    def test_write_and_read(self):
+        with shared_frames.SharedFrameBuffer(shape=(4, 6, 3)) as writer:
+            reader = shared_frames.SharedFrameBuffer(writer.name)
+            self.assertEqual(reader.shape, (4, 6, 3))
+            self.assertEqual(reader.dtype, np.uint8)
+            with self.assertRaises(TimeoutError):
+                reader.read(timeout=0.01)
+            for value in range(1, 4):
+                writer.write(np.full((4, 6, 3), value, dtype=np.uint8), timestamp=value)
+            frame, number, timestamp = reader.read()
+            self.assertEqual((frame[0, 0, 0], number, timestamp), (3, 3, 3))
+            with self.assertRaises(TimeoutError):
+                reader.read(after=number, timeout=0.01)
+            reader.close()
+
+    def test_peek_without_copying(self):
+        with shared_frames.SharedFrameBuffer(shape=(4, 6), slots=2) as buffer:
+            self.assertIsNone(buffer.peek())
+            buffer.write(np.full((4, 6), 1, dtype=np.uint8), timestamp=1)
+            frame, number, timestamp = buffer.peek()
+            self.assertEqual((frame[0, 0], number, timestamp), (1, 1, 1))
+            self.assertFalse(frame.flags.writeable)
+            self.assertIsNone(buffer.peek(after=number))
+            # Writing the other slot leaves the frame intact
+            buffer.write(np.full((4, 6), 2, dtype=np.uint8))
+            self.assertTrue(buffer.is_current(number))
+            self.assertEqual(frame[0, 0], 1)
+            # The slot of the frame is being written
+            buffer.begin_write()
+            self.assertFalse(buffer.is_current(number))
+            self.assertEqual(buffer.peek()[1], 2)
+            del frame
+
+    def test_frame_info(self):
+        with shared_frames.SharedFrameBuffer(shape=(4, 6, 3), info_size=3) as writer:
+            reader = shared_frames.SharedFrameBuffer(writer.name)
+            self.assertEqual(reader.info_size, 3)
+            number = writer.write(np.zeros((4, 6, 3), dtype=np.uint8), info=np.array([1.0, 2.0, 3.0]))
+            np.testing.assert_array_equal(reader.info(number), [1, 2, 3])
+            number = writer.write(np.zeros((4, 6, 3), dtype=np.uint8))
+            self.assertTrue(np.all(np.isnan(reader.info(number))))
+            writer.write(np.zeros((4, 6, 3), dtype=np.uint8))
+            writer.write(np.zeros((4, 6, 3), dtype=np.uint8))
+            # The slot has been overwritten
+            self.assertIsNone(reader.info(number))
+            reader.close()
+
+    def test_closed_buffer(self):
+        writer = shared_frames.SharedFrameBuffer(shape=(2, 2), dtype=np.uint16)
+        reader = shared_frames.SharedFrameBuffer(writer.name)
+        self.assertEqual(reader.dtype, np.uint16)
+        writer.close()
+        self.assertTrue(reader.closed)
+        with self.assertRaises(IOError):
+            reader.read(timeout=0.01)
+        reader.close()
+
+
+class LoopCapture:
+    """Stand-in for cv2.VideoCapture that gives numbered frames at 100 fps"""
+    def __init__(self):
+        self.values = {camera_opencv.Props.FRAME_WIDTH: 64, camera_opencv.Props.FRAME_HEIGHT: 48}
+        self.count = 0
+
+    def read(self, image=None):
+        time.sleep(0.01)
+        self.count += 1
+        shape = (
+            int(self.values[camera_opencv.Props.FRAME_HEIGHT]), int(self.values[camera_opencv.Props.FRAME_WIDTH]), 3)
+        if image is None or image.shape != shape:
+            image = np.empty(shape, dtype=np.uint8)
+        image[...] = self.count % 256
+        return True, image
+
+    def get(self, prop):
+        return self.values.get(prop, 0.0)
+
+    def set(self, prop, value):
+        if prop == camera_opencv.Props.ZOOM:
+            return False
+        self.values[prop] = value
+        return True
+
+    def getBackendName(self):  # pylint: disable=invalid-name
+        return "LOOP"
+
+    def release(self):
+        pass
+
+
+def loop_camera():
+    cam = camera_opencv.CameraCV.__new__(camera_opencv.CameraCV)
+    cam._cam = LoopCapture()
+    cam._cam_lock = threading.Lock()
+    cam._grabber = None
+    cam._props = {}
+    return cam
+
+
+class CameraServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.service_camera = loop_camera()
+        self.service = camera_service.CameraService(self.service_camera, ADDRESS)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.start()
+        self.client = camera_service.CameraClient(ADDRESS, start=False)
+
+    def tearDown(self):
+        self.client.shutdown_service()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+
+    def test_frames(self):
+        frame = self.client.get_frame()
+        self.assertEqual(frame.shape, (48, 64, 3))
+        values = [int(frame[0, 0, 0]) for frame in self.client.frames(3)]
+        self.assertEqual(len(set(values)), 3)
+        self.assertEqual(self.client.backend_name, "LOOP")
+
+    def test_properties(self):
+        self.assertEqual(self.client.set_props({camera_opencv.Props.GAIN: 5}), 1)
+        self.assertEqual(self.client.get_prop(camera_opencv.Props.GAIN), 5)
+        with self.assertRaises(ValueError):
+            self.client.set_prop(camera_opencv.Props.ZOOM, 2)
+
+    def test_errors_are_raised_in_the_client(self):
+        with mock.patch.object(self.service_camera, "set_resolution", side_effect=RuntimeError("unplugged")):
+            with self.assertRaisesRegex(RuntimeError, "unplugged"):
+                self.client.set_resolution(32, 24)
+
+        # The errors that cannot be pickled or are not built in are raised as IOErrors
+        class CameraError(Exception):
+            def __init__(self):
+                super().__init__("camera error")
+                self.lock = threading.Lock()
+
+        with mock.patch.object(self.service_camera, "set_resolution", side_effect=CameraError()):
+            with self.assertRaisesRegex(IOError, "CameraError: camera error"):
+                self.client.set_resolution(32, 24)
+        self.assertEqual(self.client.resolution, (64, 48))
+
+    def test_wrong_key_is_rejected(self):
+        with self.assertRaises(connection.AuthenticationError):
+            camera_service.CameraClient(ADDRESS, authkey=b"dark-spot-mapper", start=False)
+
+    def test_resolution_change(self):
+        self.client.set_resolution(32, 24)
+        self.assertEqual(self.client.resolution, (32, 24))
+        self.assertEqual(self.client.get_frame().shape, (24, 32, 3))
+
+
+class AuthkeyTest(unittest.TestCase):
+    def test_key_is_created_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "camera.key")
+            key = camera_service.load_authkey(path)
+            self.assertEqual(len(key), camera_service.AUTHKEY_BYTES)
+            self.assertEqual(camera_service.load_authkey(path), key)
+            if sys.platform != "win32":
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+                os.chmod(path, 0o644)
+                with self.assertRaises(PermissionError):
+                    camera_service.load_authkey(path)
+
+
+class CameraServiceStartTest(unittest.TestCase):
+    def test_service_is_started_from_the_program_directory(self):
+        with mock.patch.object(camera_service.subprocess, "Popen") as popen:
+            with self.assertRaises(IOError):
+                camera_service.CameraClient(("localhost", 6124), timeout=0)
+        args = popen.call_args
+        self.assertEqual(args[0][0][1:3], ["-m", "devices.camera_service"])
+        self.assertTrue(os.path.isfile(os.path.join(args[1]["cwd"], "devices", "camera_service.py")))
+
+
+if __name__ == "__main__":
+    unittest.main()
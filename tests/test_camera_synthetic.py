@@ -0,0 +1,81 @@
+import os.path
+import tempfile
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+import pipeline_benchmark
+from devices import camera_synthetic
+
+
+class SyntheticCameraTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.wafer = camera_synthetic.synthetic_wafer(2048, spots=300)
+
+    def test_frames_follow_the_stage(self):
+        stage = camera_synthetic.SimulatedStage(move_time=False)
+        cam = camera_synthetic.SyntheticCamera(
+            self.wafer, stage.position, resolution=(320, 240), fps=None, noise=0, channels=1)
+        before = cam.get_frame().copy()
+        stage.step_right(int(100 * camera_synthetic.STEPS_PER_PIXEL))
+        after = cam.get_frame()
+        np.testing.assert_array_equal(after[:, :-100], before[:, 100:])
+        stage.step_up(int(50 * camera_synthetic.STEPS_PER_PIXEL))
+        np.testing.assert_array_equal(cam.get_frame()[50:, :-100], before[:-50, 100:])
+
+    def test_outside_of_the_wafer_is_black(self):
+        stage = camera_synthetic.SimulatedStage(move_time=False)
+        cam = camera_synthetic.SyntheticCamera(self.wafer, stage.position, resolution=(320, 240), fps=None, noise=0)
+        stage.goto(int(2000 * camera_synthetic.STEPS_PER_PIXEL), 0)
+        frame = cam.get_frame()
+        self.assertEqual(frame.shape, (240, 320, 3))
+        self.assertEqual(frame.max(), 0)
+
+    def test_frame_rate_is_limited(self):
+        cam = camera_synthetic.SyntheticCamera(self.wafer, resolution=(320, 240), fps=50)
+        frame = cam.get_frame()
+        start_time = time.monotonic()
+        for _ in range(5):
+            frame = cam.get_frame(frame)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.09)
+
+    def test_noise(self):
+        cam = camera_synthetic.SyntheticCamera(self.wafer, resolution=(320, 240), fps=None, noise=3, channels=1)
+        difference = cam.get_frame().astype(np.float32) - cam.get_frame().astype(np.float32)
+        self.assertGreater(difference.std(), 2)
+        self.assertLess(difference.std(), 6)
+
+    def test_stage_moves_take_time(self):
+        stage = camera_synthetic.SimulatedStage(vx=10000, vy=10000)
+        stage.step_right(1000)
+        self.assertEqual(stage.where(), (1000, 0))
+        self.assertLess(stage.position()[0], 1000)
+        self.assertGreater(stage.wait_until_settled(), 0.05)
+        self.assertEqual(stage.position(), (1000, 0))
+        self.assertEqual(stage.wait_until_settled(), 0)
+
+    def test_instant_stage_moves(self):
+        stage = camera_synthetic.SimulatedStage(move_time=False)
+        stage.step_down(100000)
+        self.assertEqual(stage.position(), (0, -100000))
+        self.assertEqual(stage.wait_until_settled(), 0)
+
+
+class PipelineTest(unittest.TestCase):
+    def test_area_mosaic_matches_the_wafer(self):
+        wafer = camera_synthetic.synthetic_wafer(4096, spots=1000)
+        with tempfile.TemporaryDirectory() as directory:
+            timings = pipeline_benchmark.run(
+                directory, columns=3, rows=2, move_time=False, wafer=wafer, fps=None, noise=0, channels=1)
+            self.assertIn("stitching", timings)
+            result = cv2.imread(os.path.join(directory, "area_mosaic.tif"), cv2.IMREAD_UNCHANGED)
+        x = 2048 - 640 - 760
+        y = 2048 - 480 - 380
+        np.testing.assert_array_equal(result, wafer[y:y + result.shape[0], x:x + result.shape[1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import contextlib
+import io
+import os
+import os.path
+import tempfile
+import unittest
+
+import cross_stitcher
+import stitching
+
+
+def touch(path: str, mtime: float) -> None:
+    with open(path, "wb"):
+        pass
+    os.utime(path, (mtime, mtime))
+
+
+class CrossStitcherTest(unittest.TestCase):
+    def test_needs_update(self):
+        with tempfile.TemporaryDirectory() as directory:
+            picture = os.path.join(directory, "picture_1.png")
+            stitch = os.path.join(directory, "stitch.png")
+            touch(picture, 1000)
+            self.assertTrue(cross_stitcher.needs_update(stitch, [picture]))
+            touch(stitch, 2000)
+            self.assertFalse(cross_stitcher.needs_update(stitch, [picture]))
+            touch(picture, 3000)
+            self.assertTrue(cross_stitcher.needs_update(stitch, [picture]))
+
+    @staticmethod
+    def make_wafer(wafer_path: str) -> None:
+        """Create an up-to-date wafer measurement of empty files"""
+        for site in stitching.WAFER_LAYOUT:
+            site_path = os.path.join(wafer_path, site)
+            os.makedirs(site_path)
+            for number in range(1, 10):
+                touch(os.path.join(site_path, f"wafer_{site}_{number}.png"), 1000)
+            touch(os.path.join(site_path, f"wafer_{site}_stitch.png"), 2000)
+        touch(os.path.join(wafer_path, cross_stitcher.WAFER_STITCH_NAME), 3000)
+
+    def test_up_to_date_wafer_is_skipped(self):
+        with tempfile.TemporaryDirectory() as wafer_path:
+            self.make_wafer(wafer_path)
+            written, _ = cross_stitcher.restitch_wafer(wafer_path)
+            self.assertEqual(written, 0)
+
+    def test_site_with_several_stitches(self):
+        with tempfile.TemporaryDirectory() as wafer_path:
+            self.make_wafer(wafer_path)
+            site_path = os.path.join(wafer_path, next(iter(stitching.WAFER_LAYOUT)))
+            newest = os.path.join(site_path, "wafer_2020_stitch.png")
+            touch(os.path.join(site_path, "wafer_2019_stitch.png"), 1500)
+            touch(newest, 2500)
+            self.assertEqual(cross_stitcher.site_stitch_path(site_path), newest)
+            # The wafer composite of the Dark Spot Mapper uses the same stitch
+            self.assertEqual(stitching.wafer_tiles(wafer_path)[0][0], newest)
+            # The composite is older than the newest site stitch
+            touch(os.path.join(wafer_path, cross_stitcher.WAFER_STITCH_NAME), 2200)
+            # The empty files cannot be read, but the composite is made of the newest stitch
+            with self.assertRaisesRegex(stitching.StitchError, f"Could not read image: {newest}"):
+                cross_stitcher.restitch_wafer(wafer_path, write_pyramid=False)
+
+    def test_failed_wafer_does_not_stop_the_batch(self):
+        with tempfile.TemporaryDirectory() as wafer_path:
+            self.make_wafer(wafer_path)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                # An invalid path raises a TypeError in the worker
+                failures = cross_stitcher.restitch_all([wafer_path, None], jobs=2)
+            self.assertEqual(failures, 1)
+            self.assertIn("None: failed: TypeError", output.getvalue())
+            self.assertIn(f"{wafer_path}: up to date", output.getvalue())
+            self.assertIn("Stitched 1 of 2 wafers", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
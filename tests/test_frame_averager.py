@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+
+from devices import camera
+
+
+class SequenceCamera(camera.Camera):
+    """Camera that returns the given frames in turn"""
+    def __init__(self, frames):
+        super().__init__("sequence")
+        self.frames_left = list(frames)
+
+    def get_frame(self, output_array=None):
+        frame = self.frames_left.pop(0)
+        if output_array is None:
+            return frame.copy()
+        np.copyto(output_array, frame)
+        return output_array
+
+
+class FrameAveragerTest(unittest.TestCase):
+    def test_mean(self):
+        averager = camera.FrameAverager((2, 2), 4)
+        for value in (10, 11, 11, 11):
+            averager.add(np.full((2, 2), value, dtype=np.uint8))
+        result = averager.result()
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertTrue((result == 11).all())
+
+    def test_mean_does_not_overflow(self):
+        averager = camera.FrameAverager((1, 1), 8)
+        for _ in range(8):
+            averager.add(np.full((1, 1), 255, dtype=np.uint8))
+        self.assertEqual(averager.result()[0, 0], 255)
+
+    def test_uint16_keeps_precision(self):
+        averager = camera.FrameAverager((1, 1), 2)
+        averager.add(np.array([[100]], dtype=np.uint8))
+        averager.add(np.array([[101]], dtype=np.uint8))
+        result = averager.result(np.uint16)
+        self.assertEqual(result.dtype, np.uint16)
+        self.assertEqual(result[0, 0], round(100.5 * 257))
+
+    def test_sigma_clip_rejects_outlier(self):
+        averager = camera.FrameAverager((1, 1), 8, method="sigma_clip", sigma=2)
+        for value in (50, 51, 50, 49, 50, 51, 49, 250):
+            averager.add(np.array([[value]], dtype=np.uint8))
+        self.assertEqual(averager.result()[0, 0], 50)
+
+    def test_median(self):
+        averager = camera.FrameAverager((1, 1), 3, method="median")
+        for value in (1, 200, 3):
+            averager.add(np.array([[value]], dtype=np.uint8))
+        self.assertEqual(averager.result()[0, 0], 3)
+
+    def test_camera_average_frames(self):
+        rng = np.random.default_rng(0)
+        truth = rng.integers(50, 200, (8, 8)).astype(np.float32)
+        frames = [np.clip(truth + rng.normal(0, 8, truth.shape), 0, 255).astype(np.uint8) for _ in range(16)]
+        cam = SequenceCamera(frames)
+        averaged = cam.average_frames(16)
+        single_error = np.abs(frames[0] - truth).mean()
+        averaged_error = np.abs(averaged - truth).mean()
+        self.assertLess(averaged_error, single_error / 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import time
+import unittest
+
+import numpy as np
+
+from devices import camera
+
+
+class CountingSource:
+    """Produces frames filled with a running number"""
+    def __init__(self, period: float = 0.005, fail_after: int = None):
+        self.period = period
+        self.fail_after = fail_after
+        self.number = 0
+
+    def read(self, out=None):
+        time.sleep(self.period)
+        if self.fail_after is not None and self.number >= self.fail_after:
+            raise IOError("Camera disconnected")
+        if out is None:
+            out = np.empty((4, 6), dtype=np.uint8)
+        out.fill(self.number % 256)
+        self.number += 1
+        return out
+
+
+class FrameGrabberTest(unittest.TestCase):
+    def test_latest(self):
+        with camera.FrameGrabber(CountingSource().read, buffer_size=4) as grabber:
+            time.sleep(0.05)
+            frame, timestamp = grabber.latest()
+            self.assertEqual(frame[0, 0], grabber.count - 1)
+            self.assertLessEqual(timestamp, time.monotonic())
+
+    def test_next_after(self):
+        with camera.FrameGrabber(CountingSource().read, buffer_size=4) as grabber:
+            time.sleep(0.03)
+            start = time.monotonic()
+            frame, timestamp = grabber.next_after(start)
+            self.assertGreater(timestamp, start)
+            # A frame read before the given time is found from the buffer
+            earlier, earlier_timestamp = grabber.next_after(start - 0.011)
+            self.assertLess(earlier[0, 0], frame[0, 0])
+            self.assertGreater(earlier_timestamp, start - 0.011)
+
+    def test_consecutive(self):
+        with camera.FrameGrabber(CountingSource().read, buffer_size=3) as grabber:
+            frames, timestamps = grabber.consecutive(10)
+        self.assertEqual(frames.shape, (10, 4, 6))
+        np.testing.assert_array_equal(np.diff(frames[:, 0, 0].astype(int)), 1)
+        self.assertTrue((np.diff(timestamps) > 0).all())
+
+    def test_error_is_raised_to_consumers(self):
+        with camera.FrameGrabber(CountingSource(fail_after=3).read) as grabber:
+            with self.assertRaises(IOError):
+                grabber.consecutive(10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import cv2
+import numpy as np
+
+import frame_metrics
+from devices import camera_synthetic
+
+
+class FrameMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.frame = camera_synthetic.SyntheticCamera(
+            camera_synthetic.synthetic_wafer(size=2048, spots=200), resolution=(640, 480), fps=None).get_frame()
+
+    def test_subsample_is_strided(self):
+        for step in (1, 2, 3, 4, 7):
+            sub = frame_metrics.subsample(self.frame, step)
+            self.assertEqual(sub.shape[:2], (480 // step, 640 // step))
+            np.testing.assert_array_equal(sub, self.frame[::step, ::step][:480 // step, :640 // step])
+
+    def test_focus_decreases_with_blur(self):
+        for method in frame_metrics.FOCUS_METHODS:
+            scores = [
+                frame_metrics.measure(cv2.GaussianBlur(self.frame, (0, 0), sigma) if sigma else self.frame,
+                                      focus_method=method).focus
+                for sigma in (0, 1, 2, 4)
+            ]
+            self.assertEqual(scores, sorted(scores, reverse=True), method)
+        with self.assertRaises(ValueError):
+            frame_metrics.measure(self.frame, focus_method="unknown")
+
+    def test_exposure(self):
+        frame = np.full((100, 100, 3), 100, dtype=np.uint8)
+        frame[:10, :, 2] = 255
+        metrics = frame_metrics.measure(frame, step=1, bins=256)
+        self.assertAlmostEqual(metrics.saturation, 0.1)
+        self.assertAlmostEqual(metrics.histogram.sum(), 1)
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.assertAlmostEqual(metrics.mean, gray.mean())
+        self.assertAlmostEqual(metrics.histogram[100], 0.9)
+        self.assertAlmostEqual(metrics.focus, frame_metrics.focus_score(gray))
+
+        metrics = frame_metrics.measure(np.full((100, 100), 255, dtype=np.uint8))
+        self.assertEqual(metrics.saturation, 1)
+        self.assertEqual(metrics.histogram[-1], 1)
+        self.assertEqual(metrics.focus, 0)
+
+    def test_array_round_trip(self):
+        metrics = frame_metrics.measure(self.frame)
+        array = metrics.to_array()
+        self.assertEqual(array.shape, (frame_metrics.FrameMetrics.array_size(),))
+        restored = frame_metrics.FrameMetrics.from_array(array)
+        self.assertEqual(restored[:3], metrics[:3])
+        np.testing.assert_array_equal(restored.histogram, metrics.histogram)
+
+    def test_other_types_are_rejected(self):
+        with self.assertRaises(ValueError):
+            frame_metrics.measure(self.frame.astype(np.uint16))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from devices import camera
+
+
+class PatternCamera(camera.Camera):
+    """Camera that fills the frames with a running number"""
+    def __init__(self, shape=(4, 6)):
+        super().__init__("pattern")
+        self.shape = shape
+        self.number = 0
+
+    def get_frame(self, output_array=None):
+        if output_array is None or output_array.shape != self.shape:
+            output_array = np.empty(self.shape, dtype=np.uint8)
+        output_array.fill(self.number)
+        self.number += 1
+        return output_array
+
+
+class FramePoolTest(unittest.TestCase):
+    def test_frames_are_recycled(self):
+        pool = camera.FramePool((4, 6), size=2)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(pool.extra_allocations, 0)
+
+    def test_empty_pool_allocates(self):
+        pool = camera.FramePool((4, 6), size=1)
+        pool.acquire()
+        frame = pool.acquire()
+        self.assertEqual(frame.shape, (4, 6))
+        self.assertEqual(pool.extra_allocations, 1)
+
+    def test_foreign_frames_are_discarded(self):
+        pool = camera.FramePool((4, 6), size=1)
+        frame = pool.acquire()
+        pool.release(np.empty((2, 2), dtype=np.uint8))
+        pool.release(frame)
+        self.assertIs(pool.acquire(), frame)
+
+    def test_camera_reuses_released_frames(self):
+        cam = PatternCamera()
+        frames = [cam.acquire_frame() for _ in range(3)]
+        self.assertEqual([frame[0, 0] for frame in frames], [0, 1, 2])
+        cam.release_frame(frames[1])
+        self.assertIs(cam.acquire_frame(), frames[1])
+        self.assertEqual(frames[1][0, 0], 3)
+
+    def test_camera_pool_follows_resolution(self):
+        cam = PatternCamera()
+        cam.release_frame(cam.acquire_frame())
+        cam.shape = (2, 3)
+        self.assertEqual(cam.acquire_frame().shape, (2, 3))
+        self.assertEqual(cam.acquire_frame().shape, (2, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
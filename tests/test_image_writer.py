@@ -0,0 +1,84 @@
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+import image_writer
+import stitching
+
+
+class ImageWriterTest(unittest.TestCase):
+    def test_pictures_are_written(self):
+        img = np.random.default_rng(0).integers(0, 255, (48, 64), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            with image_writer.ImageWriter() as writer:
+                for i in range(10):
+                    writer.write(os.path.join(directory, f"picture_{i}.png"), img)
+                writer.flush()
+                self.assertEqual(writer.queue_depth, 0)
+            for i in range(10):
+                np.testing.assert_array_equal(
+                    cv2.imread(os.path.join(directory, f"picture_{i}.png"), cv2.IMREAD_UNCHANGED), img)
+
+    def test_queue_is_bounded(self):
+        release = threading.Event()
+        active = []
+
+        def slow_write(path, img, fmt):
+            active.append(path)
+            release.wait()
+
+        writer = image_writer.ImageWriter(max_workers=1, max_pending=2, write=slow_write)
+        writer.write("a", None)
+        writer.write("b", None)
+        blocked = threading.Thread(target=writer.write, args=("c", None))
+        blocked.start()
+        time.sleep(0.1)
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        writer.close()
+        self.assertEqual(active, ["a.png", "b.png", "c.png"])
+
+    def test_errors_are_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = image_writer.ImageWriter()
+            writer.write(os.path.join(directory, "missing", "picture"), np.zeros((4, 4), dtype=np.uint8))
+            with self.assertRaises(image_writer.WriteError):
+                writer.flush()
+            # The error is reported only once
+            writer.flush()
+            writer.close()
+
+    def test_formats_round_trip(self):
+        img = np.random.default_rng(0).integers(0, 255, (48, 64), dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            for fmt, image_format in image_writer.FORMATS.items():
+                path = image_writer.save_image(os.path.join(directory, fmt), img, fmt)
+                self.assertTrue(path.endswith(image_format.extension))
+                np.testing.assert_array_equal(stitching.read_image(path), img)
+
+    def test_format_path(self):
+        self.assertEqual(image_writer.format_path("/d/x1.5mm_2026_01", "png"), "/d/x1.5mm_2026_01.png")
+        self.assertEqual(image_writer.format_path("/d/x1.5mm_2026_01", "npy"), "/d/x1.5mm_2026_01.npy")
+        self.assertEqual(image_writer.format_path("/d/sample.PNG", "tiff"), "/d/sample.PNG")
+        self.assertEqual(image_writer.format_path("/d/sample.tif", "png"), "/d/sample.tif")
+        with self.assertRaises(ValueError):
+            image_writer.format_path("/d/sample", "gif")
+
+    def test_benchmark(self):
+        img = np.random.default_rng(0).integers(0, 255, (48, 64), dtype=np.uint8)
+        results = image_writer.benchmark([img, img], ["png_fast", "npy"])
+        self.assertEqual(set(results), {"png_fast", "npy"})
+        speed, size = results["npy"]
+        self.assertGreater(speed, 0)
+        self.assertGreater(size, img.nbytes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import os.path
+import time
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+import frame_metrics
+import live_view
+from devices import camera_synthetic
+from devices import shared_frames
+
+
+class LevelsTest(unittest.TestCase):
+    def test_lut_maps_the_levels_to_black_and_white(self):
+        lut = live_view.levels_lut(20, 220)
+        self.assertEqual(lut.dtype, np.uint8)
+        self.assertEqual(lut.shape, (256,))
+        self.assertEqual(lut[0], 0)
+        self.assertEqual(lut[20], 0)
+        self.assertEqual(lut[120], 128)
+        self.assertEqual(lut[220], 255)
+        self.assertEqual(lut[255], 255)
+        self.assertTrue(np.all(np.diff(lut.astype(int)) >= 0))
+
+    def test_lut_is_cached_and_read_only(self):
+        lut = live_view.levels_lut(10, 100)
+        self.assertIs(live_view.levels_lut(10, 100), lut)
+        with self.assertRaises(ValueError):
+            lut[0] = 1
+
+    def test_auto_levels_stretch_the_contrast(self):
+        frame = np.random.default_rng(0).integers(100, 151, (480, 640), dtype=np.uint8)
+        low, high = live_view.auto_levels(frame)
+        self.assertLessEqual(100, low)
+        self.assertLessEqual(high, 150)
+        self.assertLess(low, high)
+
+    def test_auto_levels_of_a_flat_frame(self):
+        low, high = live_view.auto_levels(np.full((100, 100), 50, dtype=np.uint8))
+        self.assertEqual((low, high), (50, 51))
+
+
+class RateMeterTest(unittest.TestCase):
+    def test_rate(self):
+        meter = live_view.RateMeter(interval=1.0)
+        self.assertFalse(meter.tick(now=0.0))
+        for i in range(1, 20):
+            self.assertFalse(meter.tick(now=i * 0.05))
+        self.assertTrue(meter.tick(now=1.0))
+        self.assertAlmostEqual(meter.rate, 20)
+        self.assertFalse(meter.tick(5, now=1.5))
+        self.assertTrue(meter.tick(5, now=2.0))
+        self.assertAlmostEqual(meter.rate, 10)
+
+
+class LiveRendererTest(unittest.TestCase):
+    def setUp(self):
+        self.frame = np.random.default_rng(0).integers(0, 256, (96, 128, 3), dtype=np.uint8)
+
+    def test_full_range_gray_frame_is_not_copied(self):
+        gray = self.frame[..., 0].copy()
+        renderer = live_view.LiveRenderer()
+        self.assertIs(renderer.render(gray), gray)
+
+    def test_colour_frame_is_converted_to_gray(self):
+        display = live_view.LiveRenderer().render(self.frame)
+        np.testing.assert_array_equal(display, cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY))
+
+    def test_colour_frame_is_converted_to_rgb(self):
+        display = live_view.LiveRenderer(grayscale=False).render(self.frame)
+        np.testing.assert_array_equal(display, self.frame[..., ::-1])
+
+    def test_levels_are_applied(self):
+        gray = self.frame[..., 0].copy()
+        display = live_view.LiveRenderer(levels=(50, 200)).render(gray)
+        np.testing.assert_array_equal(display, live_view.levels_lut(50, 200)[gray])
+
+    def test_16_bit_frame_is_scaled(self):
+        frame = np.array([[0, 65535]], dtype=np.uint16)
+        display = live_view.LiveRenderer().render(frame)
+        self.assertEqual(display.dtype, np.uint8)
+        np.testing.assert_array_equal(display, [[0, 255]])
+
+    def test_buffers_are_reused(self):
+        renderer = live_view.LiveRenderer(levels=(50, 200))
+        first = renderer.render(self.frame)
+        second = renderer.render(self.frame[::-1].copy())
+        self.assertIs(first, second)
+
+    def test_auto_levels_are_updated_periodically(self):
+        renderer = live_view.LiveRenderer(auto_levels=True)
+        renderer.render(np.full((64, 64), 10, dtype=np.uint8))
+        levels = renderer.current_levels
+        self.assertEqual(levels, (10, 11))
+        bright = np.full((64, 64), 200, dtype=np.uint8)
+        for _ in range(live_view.AUTO_LEVELS_INTERVAL - 1):
+            renderer.render(bright)
+            self.assertEqual(renderer.current_levels, levels)
+        renderer.render(bright)
+        self.assertEqual(renderer.current_levels, (200, 201))
+
+
+class FramePublisherTest(unittest.TestCase):
+    def setUp(self):
+        wafer = camera_synthetic.synthetic_wafer(size=1024, spots=50)
+        self.stage = camera_synthetic.SimulatedStage(move_time=False)
+        self.cam = camera_synthetic.SyntheticCamera(
+            wafer, self.stage.position, resolution=(160, 120), fps=100, noise=0, channels=1)
+
+    def test_viewer_gets_the_latest_frames(self):
+        with live_view.FramePublisher(self.cam, interval=0.005, decimation=1) as publisher:
+            buffer = shared_frames.SharedFrameBuffer(publisher.name)
+            self.assertEqual(buffer.shape, (120, 160))
+            self.assertEqual(buffer.slots, 2)
+            viewer = live_view.LiveViewer(buffer, live_view.LiveRenderer())
+            first = viewer.next_frame()
+            np.testing.assert_array_equal(first, self.cam.get_frame())
+            # Frames that were not displayed are skipped
+            self.stage.step_right(2000)
+            time.sleep(0.1)
+            display = viewer.next_frame()
+            np.testing.assert_array_equal(display, self.cam.get_frame())
+            self.assertFalse(buffer.closed)
+        self.assertTrue(buffer.closed)
+        buffer.close()
+
+    def test_closed_handles(self):
+        with live_view.FramePublisher(self.cam, interval=0.005) as publisher:
+            buffer = shared_frames.SharedFrameBuffer(publisher.name)
+            buffer.close()
+            self.assertTrue(buffer.closed)
+            self.assertFalse(publisher.buffer.closed)
+        self.assertTrue(publisher.buffer.closed)
+
+    def test_displayed_frame_is_not_in_shared_memory(self):
+        with live_view.FramePublisher(self.cam, interval=0.005, decimation=1) as publisher:
+            buffer = shared_frames.SharedFrameBuffer(publisher.name)
+            display = live_view.LiveViewer(buffer, live_view.LiveRenderer()).next_frame()
+            view = buffer.peek()[0]
+            self.assertFalse(np.may_share_memory(display, view))
+            del view
+            buffer.close()
+
+    def test_metrics_are_published_with_the_frames(self):
+        with live_view.FramePublisher(self.cam, interval=0.005) as publisher:
+            buffer = shared_frames.SharedFrameBuffer(publisher.name)
+            viewer = live_view.LiveViewer(buffer, live_view.LiveRenderer())
+            self.assertIsNone(viewer.metrics)
+            viewer.next_frame()
+            # The metrics are of the full frame, not of the preview
+            expected = frame_metrics.measure(self.cam.get_frame())
+            self.assertAlmostEqual(viewer.metrics.focus, expected.focus)
+            self.assertAlmostEqual(publisher.metrics.mean, expected.mean)
+            buffer.close()
+        with live_view.FramePublisher(self.cam, metrics=False) as publisher:
+            self.assertEqual(publisher.buffer.info_size, 0)
+            self.assertIsNone(publisher.metrics)
+
+    def test_preview_is_decimated(self):
+        for decimation in (2, 4):
+            with live_view.FramePublisher(self.cam, interval=0.005, decimation=decimation) as publisher:
+                buffer = shared_frames.SharedFrameBuffer(publisher.name)
+                shape = (120 // decimation, 160 // decimation)
+                self.assertEqual(buffer.shape, shape)
+                preview = live_view.LiveViewer(buffer, live_view.LiveRenderer()).next_frame()
+                # Each pixel is the average of a block of the frame
+                blocks = self.cam.get_frame().reshape(shape[0], decimation, shape[1], decimation).mean(axis=(1, 3))
+                np.testing.assert_allclose(preview, blocks, atol=1)
+                buffer.close()
+
+    def test_rate_label_is_updated_while_rendering(self):
+        with live_view.FramePublisher(self.cam, interval=0.005) as publisher:
+            buffer = shared_frames.SharedFrameBuffer(publisher.name)
+            viewer = live_view.LiveViewer(buffer, live_view.LiveRenderer())
+            labels = []
+            start = time.perf_counter()
+            while time.perf_counter() - start < 2.5 * live_view.LABEL_INTERVAL:
+                # The renderer ticks its frame rate meter just before the label is checked
+                viewer.next_frame()
+                labels.append(viewer.rate_label())
+                time.sleep(0.01)
+            labels = [label for label in labels if label is not None]
+            self.assertEqual(len(labels), 2)
+            self.assertRegex(labels[-1], r"^[1-9]\d*\.\d fps")
+            buffer.close()
+
+    def test_viewer_is_started_from_the_program_directory(self):
+        with mock.patch.object(live_view.subprocess, "Popen") as popen:
+            live_view.start_viewer("buffer", auto_levels=True)
+        args = popen.call_args
+        self.assertEqual(args[0][0][1:3], ["-m", "live_viewer"])
+        self.assertIn("--auto-levels", args[0][0])
+        self.assertTrue(os.path.isfile(os.path.join(args[1]["cwd"], "live_viewer.py")))
+
+    def test_preview_shape(self):
+        self.assertEqual(live_view.preview_shape((960, 1280, 3), 4), (240, 320, 3))
+        self.assertEqual(live_view.preview_shape((960, 1280), 2), (480, 640))
+        with self.assertRaises(ValueError):
+            live_view.FramePublisher(self.cam, decimation=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
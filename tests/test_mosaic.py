@@ -0,0 +1,85 @@
+import os.path
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import image_writer
+import mosaic
+import stitching
+
+
+class MosaicTest(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        offsets = stitching.grid_layout(columns=3, rows=2, pitch=100)
+        self.tiles = [(rng.integers(0, 256, (96, 128, 3), dtype=np.uint8), offset) for offset in offsets]
+        self.canvas_size = (328, 196)
+
+    def test_grayscale_matches_in_memory_stitch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mosaic.tif")
+            mosaic.write_mosaic(self.tiles, self.canvas_size, path, channels=1, tile_size=64)
+            expected = stitching.stitch(self.tiles, self.canvas_size, channels=1)
+            np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+
+    def test_colour_matches_in_memory_stitch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mosaic.tif")
+            mosaic.write_mosaic(self.tiles, self.canvas_size, path, channels=3, tile_size=64)
+            expected = stitching.stitch(self.tiles, self.canvas_size, channels=3)
+            np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_COLOR), expected)
+
+    def test_invalid_tile_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(ValueError):
+                mosaic.MosaicWriter(os.path.join(directory, "mosaic.tif"), self.canvas_size, tile_size=100)
+
+    def test_streaming_matches_in_memory_stitch(self):
+        steps_per_pixel = 2.5
+        origin = (1000, 5000)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mosaic.tif")
+            with mosaic.StreamingMosaic(
+                    path, self.canvas_size, origin, steps_per_pixel, overview_scale=4, channels=1) as stream:
+                for tile, (x, y) in self.tiles:
+                    position = (origin[0] + int(x * steps_per_pixel), origin[1] - int(y * steps_per_pixel))
+                    stream.add(tile, position)
+            expected = stitching.stitch(self.tiles, self.canvas_size, channels=1)
+            np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+            self.assertEqual(stream.overview.shape, (49, 82))
+            self.assertGreater(stream.overview.mean(), 0)
+
+    def test_streaming_takes_the_type_of_the_first_frame(self):
+        tiles = [((tile.astype(np.uint16) << 8) + 255, offset) for tile, offset in self.tiles]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mosaic.tif")
+            with mosaic.StreamingMosaic(path, self.canvas_size, (0, 0), 1, overview_scale=4) as stream:
+                self.assertIsNone(stream.overview)
+                for tile, (x, y) in tiles:
+                    stream.add(tile, (x, -y))
+            expected = stitching.stitch(tiles, self.canvas_size, channels=3)
+            self.assertEqual(expected.dtype, np.uint16)
+            np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+            self.assertEqual(stream.overview.dtype, np.uint16)
+            self.assertEqual(stream.overview.shape, (49, 82, 3))
+
+    def test_streaming_rejects_other_types(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stream = mosaic.StreamingMosaic(
+                os.path.join(directory, "mosaic.tif"), self.canvas_size, (0, 0), 1, dtype=np.uint8)
+            stream.add(self.tiles[0][0].astype(np.uint16), (0, 0))
+            with self.assertRaisesRegex(ValueError, "uint16"):
+                stream.close()
+
+    def test_stitch_area_follows_the_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for i, (tile, _) in enumerate(self.tiles):
+                image_writer.save_image(os.path.join(directory, f"area_{i}"), tile[..., 0], "tiff")
+            path = os.path.join(directory, "mosaic.tif")
+            mosaic.stitch_area(directory, path, columns=3, pitch=100, tile_shape=(128, 96), register=False, fmt="tiff")
+            expected = stitching.stitch([(tile[..., 0], offset) for tile, offset in self.tiles], self.canvas_size)
+            np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+            with self.assertRaises(stitching.StitchError):
+                mosaic.stitch_area(directory, path, columns=3, register=False)
@@ -0,0 +1,53 @@
+import os.path
+import tempfile
+import unittest
+
+import numpy as np
+
+import pyramid
+
+
+class PyramidTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.img = np.random.default_rng(0).integers(0, 256, (300, 520, 3), dtype=np.uint8)
+        cls.dzi_path = os.path.join(cls.tmp_dir.name, "stitch.dzi")
+        pyramid.write_pyramid(cls.img, cls.dzi_path, tile_size=128)
+        cls.reader = pyramid.PyramidReader(cls.dzi_path)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tmp_dir.cleanup()
+
+    def test_levels(self):
+        self.assertEqual(self.reader.max_level, 10)
+        self.assertEqual(self.reader.level_size(10), (520, 300))
+        self.assertEqual(self.reader.level_size(9), (260, 150))
+        self.assertEqual(self.reader.level_size(0), (1, 1))
+        self.assertTrue(os.path.isfile(os.path.join(pyramid.files_dir(self.dzi_path), "0", "0_0.png")))
+
+    def test_level_for_scale(self):
+        self.assertEqual(self.reader.level_for_scale(1), 10)
+        self.assertEqual(self.reader.level_for_scale(0.5), 9)
+        self.assertEqual(self.reader.level_for_scale(0.3), 9)
+        self.assertEqual(self.reader.level_for_scale(1e-6), 0)
+
+    def test_tiles_in_viewport(self):
+        self.assertEqual(self.reader.tiles_in_viewport((100, 0, 60, 10), 10), [(0, 0), (1, 0)])
+        self.assertEqual(
+            self.reader.tiles_in_viewport((0, 0, 520, 300), 9),
+            [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]
+        )
+        self.assertEqual(self.reader.tiles_in_viewport((600, 0, 10, 10), 10), [])
+
+    def test_read_viewport_full_resolution(self):
+        img, level = self.reader.read_viewport((100, 50, 200, 150))
+        self.assertEqual(level, 10)
+        np.testing.assert_array_equal(img, self.img[50:200, 100:300])
+
+    def test_read_viewport_downsampled(self):
+        img, level = self.reader.read_viewport((0, 0, 520, 300), scale=0.25)
+        self.assertEqual(level, 8)
+        self.assertEqual(img.shape, (75, 130, 3))
+        np.testing.assert_allclose(img[0, 0], self.img[:4, :4].reshape(-1, 3).mean(axis=0), atol=1)
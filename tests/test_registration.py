@@ -0,0 +1,42 @@
+import unittest
+
+import cv2
+import numpy as np
+
+import registration
+import stitching
+
+
+class RegistrationTest(unittest.TestCase):
+    @staticmethod
+    def scene(height: int, width: int) -> np.ndarray:
+        noise = np.random.default_rng(0).integers(0, 256, (height, width), dtype=np.uint8)
+        return cv2.GaussianBlur(noise, (0, 0), 2)
+
+    def test_phase_correlate(self):
+        scene = self.scene(300, 300).astype(np.float32)
+        a = scene[50:150, 50:150]
+        b = scene[57:157, 53:153]
+        shifts, peaks = registration.phase_correlate(a[np.newaxis], b[np.newaxis])
+        np.testing.assert_allclose(shifts[0], (3, 7), atol=0.2)
+        self.assertGreater(peaks[0], 0.1)
+
+    def test_find_pairs(self):
+        offsets = np.array(stitching.grid_layout(3, 1, pitch=60))
+        np.testing.assert_array_equal(registration.find_pairs(offsets, (128, 96)), [[0, 1], [1, 2]])
+
+    def test_register_3x3(self):
+        scene = self.scene(2600, 2900)
+        rng = np.random.default_rng(1)
+        nominal = stitching.grid_layout(3, 3)
+        true = [(x + int(rng.integers(-15, 16)), y + int(rng.integers(-15, 16))) for x, y in nominal]
+        tiles = [(scene[y + 50:y + 1010, x + 50:x + 1330], offset) for (x, y), offset in zip(true, nominal)]
+        registered = np.array([offset for _, offset in registration.register(tiles)])
+        error = registered - np.array(true)
+        # The scan as a whole may be translated, but the relative positions must match
+        self.assertLessEqual(np.abs(error - error[0]).max(), 1)
+
+    def test_featureless_tiles_stay_nominal(self):
+        nominal = stitching.grid_layout(3, 3)
+        tiles = [(np.full((960, 1280), 100, dtype=np.uint8), offset) for offset in nominal]
+        self.assertEqual([offset for _, offset in registration.register(tiles)], nominal)
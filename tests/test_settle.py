@@ -0,0 +1,80 @@
+import unittest
+
+import cv2
+import numpy as np
+
+import settle
+from devices import camera
+
+
+def scene(shape=(480, 640), seed=0):
+    rng = np.random.default_rng(seed)
+    spots = rng.integers(0, 255, (shape[0] // 16, shape[1] // 16)).astype(np.uint8)
+    return cv2.resize(spots, shape[::-1], interpolation=cv2.INTER_CUBIC)
+
+
+class MovingCamera(camera.Camera):
+    """Camera looking at a scene that moves by the given shifts and then stays still"""
+    def __init__(self, shifts, img, noise=3.0):
+        super().__init__("moving")
+        self.positions = list(np.cumsum(shifts)) if shifts else []
+        self.img = img
+        self.noise = noise
+        self.rng = np.random.default_rng(1)
+        self.count = 0
+
+    def get_frame(self, output_array=None):
+        shift = self.positions[self.count] if self.count < len(self.positions) else \
+            (self.positions[-1] if self.positions else 0)
+        self.count += 1
+        frame = np.roll(self.img, int(shift), axis=1).astype(np.float32)
+        frame += self.rng.normal(0, self.noise, frame.shape)
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+class SettleTest(unittest.TestCase):
+    def test_detector(self):
+        img = scene()
+        detector = settle.SettleDetector()
+        self.assertIsNone(detector.update(img))
+        self.assertTrue(detector.update(img))
+        self.assertFalse(detector.update(np.roll(img, 12, axis=1)))
+        self.assertAlmostEqual(detector.shift[0], 12, delta=1)
+
+    def test_waits_until_still(self):
+        cam = MovingCamera([20] * 6, scene())
+        result = settle.wait_until_still(cam, timeout=10)
+        self.assertTrue(result.settled)
+        self.assertTrue(result.moved)
+        # The moving frames and the required still frames
+        self.assertGreaterEqual(result.frames, 6 + settle.STABLE_FRAMES)
+        self.assertLessEqual(result.frames, 6 + settle.STABLE_FRAMES + 2)
+
+    def test_featureless_image(self):
+        cam = MovingCamera([], np.full((480, 640), 128, dtype=np.uint8))
+        result = settle.wait_until_still(cam, timeout=10)
+        self.assertTrue(result.settled)
+        self.assertFalse(result.moved)
+
+    def test_still_image_before_the_move(self):
+        # The stage starts to move only after 10 still frames
+        cam = MovingCamera([0] * 10 + [20] * 6, scene())
+        result = settle.wait_until_still(cam, timeout=10, unmoved_min_time=10)
+        self.assertTrue(result.settled)
+        self.assertTrue(result.moved)
+        self.assertGreaterEqual(result.frames, 16 + settle.STABLE_FRAMES)
+        # Without any motion the full time is waited
+        cam = MovingCamera([], scene())
+        result = settle.wait_until_still(cam, timeout=10, unmoved_min_time=0.1)
+        self.assertTrue(result.settled)
+        self.assertFalse(result.moved)
+        self.assertGreaterEqual(result.elapsed, 0.1)
+
+    def test_timeout(self):
+        cam = MovingCamera([20] * 10000, scene())
+        result = settle.wait_until_still(cam, timeout=0.2)
+        self.assertFalse(result.settled)
+
+
+if __name__ == "__main__":
+    unittest.main()
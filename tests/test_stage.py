@@ -0,0 +1,94 @@
+import unittest
+from unittest import mock
+
+from devices import simplemotion as sm
+from devices import stage_dummy
+from devices import stage_simplemotion
+
+ADDRESS = "TTL232R"
+
+
+class StageDummyTest(unittest.TestCase):
+    def test_position_is_tracked(self):
+        stage = stage_dummy.StageDummy(ADDRESS, mm_to_steps=1000, velocity=2000)
+        self.assertTrue(stage.move_inc_steps(300))
+        self.assertTrue(stage.move_inc_mm(-1.5))
+        self.assertEqual(stage.where(), -1200)
+        self.assertAlmostEqual(stage.where_mm(), -1.2)
+        self.assertAlmostEqual(stage.time(2000), 1.5)
+
+    def test_no_moves_during_abort(self):
+        stage = stage_dummy.StageDummy(ADDRESS, mm_to_steps=1000, velocity=2000)
+        with stage.abort_lock:
+            self.assertFalse(stage.move_inc_steps(300))
+        self.assertEqual(stage.where(), 0)
+
+
+class StageSimplemotionTest(unittest.TestCase):
+    def setUp(self):
+        # The drive is replaced with a log of the move commands
+        self.moves = []
+        patches = [
+            mock.patch.object(sm, "move_abs", side_effect=lambda axis, steps: self.moves.append(("abs", steps))),
+            mock.patch.object(sm, "move_inc", side_effect=lambda axis, steps: self.moves.append(("inc", steps))),
+            mock.patch.object(sm, "homing"),
+            mock.patch.object(sm, "wait_until_homed"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def stage(self, absolute: bool = True) -> stage_simplemotion.StageSimplemotion:
+        return stage_simplemotion.StageSimplemotion(
+            ADDRESS, mm_to_steps=1000, velocity=2000, max_inc_steps_per_command=30000, absolute=absolute)
+
+    def test_incremental_moves_before_homing(self):
+        stage = stage_simplemotion.StageSimplemotion(ADDRESS, mm_to_steps=1000, velocity=2000)
+        stage.move_inc_steps(-70000)
+        self.assertEqual(self.moves, [("inc", -32760), ("inc", -32760), ("inc", -4480)])
+
+    def test_target_is_tracked_after_homing(self):
+        stage = self.stage()
+        stage.move_inc_steps(100)
+        stage.home()
+        sm.homing.assert_called_once_with(ADDRESS)
+        self.assertEqual(stage.where(), 0)
+        stage.move_inc_steps(70000)
+        stage.move_inc_mm(-0.5)
+        self.assertEqual(self.moves, [("inc", 100), ("abs", 70000), ("abs", 69500)])
+        self.assertEqual(stage.where(), 69500)
+
+    def test_incremental_moves_when_absolute_moves_are_disabled(self):
+        stage = self.stage(absolute=False)
+        stage.home()
+        stage.move_inc_steps(70000)
+        self.assertEqual(self.moves, [("inc", 30000), ("inc", 30000), ("inc", 10000)])
+
+    def test_abort_stops_incremental_move(self):
+        stage = self.stage(absolute=False)
+        stage.home()
+        # The abort stops the chunked move halfway
+        sm.move_inc.side_effect = lambda axis, steps: stage.abort_lock.acquire(blocking=False)
+        self.assertFalse(stage.move_inc_steps(70000))
+        stage.abort_lock.release()
+        self.assertEqual(stage.where(), 0)
+        sm.move_inc.side_effect = None
+        self.assertTrue(stage.move_inc_steps(100))
+        sm.move_inc.assert_called_with(ADDRESS, 100)
+
+    def test_wait_until_settled(self):
+        with mock.patch.object(sm, "wait_until_settled", return_value={ADDRESS: 0.5}) as wait:
+            stage = self.stage()
+            self.assertEqual(stage.wait_until_settled(10, 1.0), 0)
+            stage.move_inc_steps(100)
+            self.assertEqual(stage.wait_until_settled(10, 1.0), 0.5)
+            # The estimated move time of 0.075 s is given as the minimum time
+            devices, tolerance, timeout, min_times = wait.call_args[0]
+            self.assertEqual((devices, tolerance, timeout), ([ADDRESS], 10, 1.0))
+            self.assertAlmostEqual(min_times[ADDRESS], 0.075, delta=0.05)
+            self.assertEqual(stage.wait_until_settled(10, 1.0), 0)
+            wait.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
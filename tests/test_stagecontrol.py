@@ -0,0 +1,266 @@
+import time
+import typing as tp
+import unittest
+from unittest import mock
+
+import dsm_exceptions
+import stagecontrol
+from devices import simplemotion as sm
+
+X, Y, Z = stagecontrol.AXES
+
+
+class StageControlTest(unittest.TestCase):
+    def setUp(self):
+        # The drives are replaced with a log of the move commands
+        self.moves = []
+        patches = [
+            mock.patch.object(sm, "move_abs", side_effect=lambda axis, steps: self.moves.append((axis, "abs", steps))),
+            mock.patch.object(sm, "move_inc", side_effect=lambda axis, steps: self.moves.append((axis, "inc", steps))),
+            mock.patch.object(sm, "homing"),
+            mock.patch.object(sm, "wait_until_homed"),
+            mock.patch.object(sm, "abort"),
+            mock.patch.object(stagecontrol.time, "sleep"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_incremental_moves_before_homing(self):
+        stage = stagecontrol.StageControl()
+        stage.step_up(100000)
+        self.assertEqual(
+            self.moves,
+            [(Y, "inc", 32000), (Y, "inc", 32000), (Y, "inc", 32000), (Y, "inc", 4000)]
+        )
+
+    def test_targets_are_tracked_after_homing(self):
+        stage = stagecontrol.StageControl()
+        stage.home()
+        self.assertEqual(sm.homing.call_args_list, [mock.call(X), mock.call(Y)])
+        sm.wait_until_homed.assert_called_once_with([X, Y], sm.HOMING_TIMEOUT)
+        stage.step_up(100000)
+        stage.step_down(300)
+        # Axis x is inverted
+        stage.step_right(2000)
+        stage.step_left(500)
+        self.assertEqual(self.moves, [
+            (Y, "abs", 100000), (Y, "abs", 99700), (X, "abs", -2000), (X, "abs", -1500)
+        ])
+        self.assertEqual(stage.where(), (1500, 99700))
+        # The tracked targets are independent of the user coordinates
+        self.moves.clear()
+        stage.reset_coords()
+        stage.goto(100, 0)
+        self.assertEqual(self.moves, [(X, "abs", -1600), (Y, "abs", 99700)])
+        # The z axis has not been homed
+        stage.step_zup(100)
+        self.assertEqual(self.moves[-1], (Z, "inc", 100))
+
+    def test_homing_zeroes_coordinates(self):
+        stage = stagecontrol.StageControl()
+        stage.step_up(100)
+        stage.home(("x", "y", "z"))
+        self.assertEqual(stage.where(), (0, 0))
+        stage.step_zup(100)
+        self.assertEqual(self.moves[-1], (Z, "abs", 100))
+
+    def test_incremental_moves_when_absolute_moves_are_disabled(self):
+        stage = stagecontrol.StageControl(absolute=False)
+        stage.home()
+        stage.step_up(100)
+        self.assertEqual(self.moves, [(Y, "inc", 100)])
+
+    def test_target_is_forgotten(self):
+        stage = stagecontrol.StageControl()
+        stage.home()
+        # A target out of the range of ABSTARGET is reached incrementally
+        with mock.patch.object(sm, "abs_target_valid", return_value=False):
+            stage.step_up(50000)
+        self.assertEqual(self.moves, [(Y, "inc", 32000), (Y, "inc", 18000)])
+        stage.step_up(100)
+        self.assertEqual(self.moves[-1], (Y, "inc", 100))
+        # A failed command may or may not have moved the drive
+        stage.home()
+        sm.move_abs.side_effect = sm.SmErrCommunication()
+        with self.assertRaises(sm.SmErrCommunication):
+            stage.step_up(100)
+        stage.step_up(100)
+        self.assertEqual(self.moves[-1], (Y, "inc", 100))
+
+    def test_only_moved_axes_are_waited_for(self):
+        with mock.patch.object(sm, "wait_until_settled", return_value={}) as wait:
+            stage = stagecontrol.StageControl(vy=1000)
+            stage.step_up(1000)
+            stage.step_right(0)
+            stage.step_zup(100)
+            stage.wait_until_settled()
+            devices, tolerance, timeout, min_times = wait.call_args[0]
+            self.assertEqual(devices, [Y])
+            # The estimated move time of 1.5 s is given, and none is known for the z axis
+            self.assertAlmostEqual(min_times[Y], 1.5, delta=0.1)
+            stage.wait_until_settled(("x", "y", "z"))
+            wait.assert_called_with([Z], stagecontrol.SETTLE_TOLERANCE, stagecontrol.SETTLE_TIMEOUT, {})
+            stage.wait_until_settled(("x", "y", "z"))
+            wait.assert_called_with([], stagecontrol.SETTLE_TOLERANCE, stagecontrol.SETTLE_TIMEOUT, {})
+
+    def test_earlier_moves_settle_at_once(self):
+        with mock.patch.object(sm, "wait_until_settled", return_value={}) as wait:
+            # A move from the GUI that nobody waited for
+            stage = stagecontrol.StageControl(vy=1e6)
+            stage.step_up(100)
+            time.sleep(0.01)
+            stage.wait_until_settled()
+            wait.assert_called_with([Y], stagecontrol.SETTLE_TOLERANCE, stagecontrol.SETTLE_TIMEOUT, {Y: 0.0})
+
+    def test_moves_are_rejected_during_abort(self):
+        for absolute in (True, False):
+            stage = stagecontrol.StageControl(absolute=absolute)
+            stage.home()
+            stage.step_up(100)
+            self.moves.clear()
+
+            def move_during_abort():
+                # This is what the scan thread does while the abort is waiting for the drives to stop
+                with self.assertRaises(dsm_exceptions.AbortException):
+                    stage.step_up(100)
+                with self.assertRaises(dsm_exceptions.AbortException):
+                    stage.step_right(100000)
+                self.assertEqual(stage.where(), (0, 0))
+
+            sm.abort.side_effect = move_during_abort
+            stage.abort()
+            sm.abort.assert_called_once()
+            sm.abort.reset_mock()
+            self.assertEqual(self.moves, [], absolute)
+
+            # The moves continue after the abort, and they are incremental until the next homing
+            stage.step_up(100)
+            self.assertEqual(self.moves, [(Y, "inc", 100)])
+            self.moves.clear()
+
+
+REACHED = sm.StatusBits.TARGET_REACHED | sm.StatusBits.ENABLED
+MOVING = sm.StatusBits.ENABLED
+
+
+class FakeDrives:
+    """Replaces the parameters of the drives with sequences of (status bits, following error)
+
+    The next state of an axis is taken each time its status bits are read, and the last one is repeated.
+    """
+    def __init__(self, states: tp.Dict[str, tp.List[tp.Tuple[int, int]]]):
+        self.states = states
+        self.index = {axis: -1 for axis in states}
+
+    def get_param(self, axis: str, param: sm.SmParam) -> int:
+        if param == sm.SmParam.STATUS_BITS:
+            self.index[axis] = min(self.index[axis] + 1, len(self.states[axis]) - 1)
+        status, following_error = self.states[axis][max(self.index[axis], 0)]
+        return {
+            sm.SmParam.STATUS_BITS: status,
+            sm.SmParam.FOLLOWING_ERROR: following_error,
+            sm.SmParam.SIMPLE_STATUS: 42,
+        }[param]
+
+
+class WaitUntilSettledTest(unittest.TestCase):
+    def wait(self, states, min_times=None, timeout=1.0):
+        drives = FakeDrives(states)
+        with mock.patch.object(sm, "get_param", side_effect=drives.get_param):
+            return sm.wait_until_settled(list(states), tolerance=10, timeout=timeout, min_times=min_times,
+                                         poll_interval=0), drives
+
+    def test_settled(self):
+        settled, drives = self.wait({
+            X: [(MOVING, 500), (MOVING, 100), (REACHED, 20), (REACHED, -5)],
+            Y: [(MOVING, 100), (REACHED, 0)],
+        })
+        self.assertEqual(set(settled), {X, Y})
+        self.assertEqual(drives.index, {X: 3, Y: 1})
+
+    def test_stale_target_reached_is_ignored(self):
+        # The drive has not started the move yet, so the bit is from the previous move
+        settled, drives = self.wait({X: [(REACHED, 0), (REACHED, 0), (MOVING, 300), (REACHED, 0)]})
+        self.assertEqual(drives.index[X], 3)
+        with self.assertRaises(TimeoutError):
+            self.wait({X: [(REACHED, 0)]}, timeout=0.01)
+
+    def test_target_reached_is_accepted_after_the_minimum_time(self):
+        # A move that was not seen, for example because it ended before the wait
+        start_time = time.monotonic()
+        self.wait({X: [(REACHED, 0)]}, {X: 0.05})
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.05)
+        settled, drives = self.wait({X: [(REACHED, 0)], Y: [(REACHED, 0)]}, {X: 0, Y: 0})
+        self.assertEqual(drives.index, {X: 0, Y: 0})
+
+    def test_fault(self):
+        with self.assertRaisesRegex(sm.SmException, "simple status 42"):
+            self.wait({X: [(MOVING, 100), (sm.StatusBits.FAULTSTOP, 100)]})
+
+    def test_timeout(self):
+        with self.assertRaisesRegex(TimeoutError, f"{Y}: status 0x0010, simple status 42, following error 100"):
+            self.wait({X: [(MOVING, 100), (REACHED, 0)], Y: [(MOVING, 100)]}, timeout=0.01)
+
+
+HOMING = sm.StatusBits.HOMING | sm.StatusBits.ENABLED
+
+
+class WaitUntilHomedTest(unittest.TestCase):
+    def wait(self, states, timeout=1.0):
+        drives = FakeDrives(states)
+        with mock.patch.object(sm, "get_param", side_effect=drives.get_param):
+            sm.wait_until_homed(list(states), timeout=timeout, poll_interval=0)
+        return drives
+
+    def test_homed(self):
+        drives = self.wait({X: [(REACHED, 0), (HOMING, 0), (HOMING, 0), (REACHED, 0)], Y: [(HOMING, 0), (REACHED, 0)]})
+        self.assertEqual(drives.index, {X: 3, Y: 1})
+
+    def test_homing_not_started(self):
+        with self.assertRaisesRegex(TimeoutError, f"Homing of {X} did not finish"):
+            self.wait({X: [(REACHED, 0)]}, timeout=0.01)
+
+    def test_fault(self):
+        with self.assertRaisesRegex(sm.SmException, "simple status 42"):
+            self.wait({X: [(HOMING, 0), (sm.StatusBits.FAULTSTOP, 0)]})
+
+
+class StageControlSettleTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(sm, "move_inc")
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.stage = stagecontrol.StageControl(vx=1e6, vy=1e6)
+
+    def wait(self, states, **kwargs):
+        drives = FakeDrives(states)
+        with mock.patch.object(sm, "get_param", side_effect=drives.get_param):
+            return self.stage.wait_until_settled(("x", "y", "z"), **kwargs)
+
+    def test_settled(self):
+        self.stage.step_right(100000)
+        self.stage.step_up(100)
+        with self.assertLogs(stagecontrol.logger, "DEBUG") as logs:
+            elapsed = self.wait({X: [(MOVING, 100), (REACHED, 0)], Y: [(MOVING, 100), (REACHED, 0)]})
+        self.assertGreater(elapsed, 0)
+        # The actual move time is compared to the estimate of 0.1 s
+        self.assertRegex(logs.output[0], r"Move took \d\.\d{3} s, estimated 0\.100 s")
+        # The axes have settled, so there is nothing to wait for
+        self.assertEqual(self.wait({}), 0)
+
+    def test_fault(self):
+        self.stage.step_zup(100)
+        with self.assertRaises(sm.SmException):
+            self.wait({Z: [(MOVING, 100), (sm.StatusBits.FAULTSTOP | MOVING, 100)]})
+
+    def test_timeout(self):
+        self.stage.step_up(100)
+        with self.assertRaises(TimeoutError):
+            self.wait({Y: [(MOVING, 100)]}, timeout=0.01)
+        # The axis is still waited for after the timeout
+        self.assertGreater(self.wait({Y: [(MOVING, 100), (REACHED, 0)]}), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import concurrent.futures
+import time
+import unittest
+
+import stitch_scheduler
+
+
+def _sleep_and_return(value, delay=0.0):
+    time.sleep(delay)
+    return value
+
+
+def _fail():
+    raise OSError("stitch failed")
+
+
+class StitchSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = stitch_scheduler.StitchScheduler(max_workers=2)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_dependent_job_waits(self):
+        sites = [self.scheduler.submit(_sleep_and_return, i, 0.2) for i in range(3)]
+        wafer = self.scheduler.submit(_sleep_and_return, "wafer", depends_on=sites)
+        self.assertEqual(wafer.result(timeout=10), "wafer")
+        self.assertTrue(all(site.done() for site in sites))
+        self.assertEqual([site.result() for site in sites], [0, 1, 2])
+        self.assertEqual(self.scheduler.active, 0)
+
+    def test_failure_propagates(self):
+        site = self.scheduler.submit(_fail)
+        wafer = self.scheduler.submit(_sleep_and_return, "wafer", depends_on=[site])
+        with self.assertRaises(OSError):
+            site.result(timeout=10)
+        with self.assertRaises(stitch_scheduler.DependencyError):
+            wafer.result(timeout=10)
+
+    def test_queue_depth(self):
+        jobs = [self.scheduler.submit(_sleep_and_return, i, 0.3) for i in range(4)]
+        self.assertGreater(self.scheduler.queue_depth, 0)
+        concurrent.futures.wait(jobs, timeout=10)
+        self.assertEqual(self.scheduler.queue_depth, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
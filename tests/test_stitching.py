@@ -0,0 +1,59 @@
+import os.path
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+import stitching
+
+
+class StitchingTest(unittest.TestCase):
+    def test_paste_crops_to_canvas(self):
+        canvas = np.zeros((4, 6), dtype=np.uint8)
+        tile = np.arange(1, 10, dtype=np.uint8).reshape(3, 3)
+        stitching.paste(canvas, tile, (4, -1))
+        np.testing.assert_array_equal(canvas[:2, 4:], tile[1:, :2])
+        self.assertEqual(canvas[:, :4].sum(), 0)
+        self.assertEqual(canvas[2:].sum(), 0)
+
+    def test_later_tiles_cover_earlier(self):
+        tiles = [
+            (np.full((2, 3), 1, dtype=np.uint8), (0, 0)),
+            (np.full((2, 3), 2, dtype=np.uint8), (2, 0)),
+        ]
+        canvas = stitching.stitch(tiles, (5, 2))
+        np.testing.assert_array_equal(canvas[0], [1, 1, 2, 2, 2])
+
+    def test_channel_conversion(self):
+        tiles = [(np.full((2, 2), 7, dtype=np.uint8), (0, 0))]
+        canvas = stitching.stitch(tiles, (2, 2), channels=3)
+        self.assertEqual(canvas.shape, (2, 2, 3))
+        self.assertTrue((canvas == 7).all())
+
+    def test_stitch_9_from_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for number in range(1, 10):
+                tile = np.full((960, 1280, 3), number, dtype=np.uint8)
+                cv2.imwrite(os.path.join(directory, f"chip_{number}.png"), tile)
+            path = os.path.join(directory, "chip_stitch.png")
+            canvas = stitching.stitch_9(directory, path)
+            self.assertEqual(canvas.shape, (2480, 2800, 3))
+            self.assertEqual(canvas[0, 0, 0], 1)
+            self.assertEqual(canvas[760, 0, 0], 6)
+            self.assertEqual(canvas[-1, -1, 0], 9)
+            np.testing.assert_array_equal(cv2.imread(path), canvas)
+
+    def test_missing_tile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(stitching.StitchError):
+                stitching.stitch_9(directory, os.path.join(directory, "stitch.png"))
+
+    def test_nine_tiles_of_another_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for number in range(1, 10):
+                np.save(os.path.join(directory, f"chip_{number}.npy"), np.full((96, 128), number, dtype=np.uint8))
+            tiles = stitching.nine_tiles(directory, extension=".npy")
+            self.assertEqual([os.path.basename(path)[5] for path, _ in tiles], list("123654789"))
+            with self.assertRaises(stitching.StitchError):
+                stitching.nine_tiles(directory)
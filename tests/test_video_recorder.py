@@ -0,0 +1,93 @@
+import os.path
+import tempfile
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+from devices import camera
+from devices import camera_synthetic
+
+
+def frame(value: int) -> np.ndarray:
+    return np.full((48, 64, 3), value, dtype=np.uint8)
+
+
+class VideoRecorderTest(unittest.TestCase):
+    def test_frames_are_taken_at_the_frame_rate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "video.avi")
+            recorder = camera.VideoRecorder(path, fps=30, queue_size=100)
+            # Two seconds of a 60 fps camera
+            for i in range(120):
+                recorder.offer(frame(i), timestamp=i / 60)
+            stats = recorder.stop()
+            self.assertEqual(stats.frames, 60)
+            self.assertEqual(stats.dropped, 0)
+            self.assertAlmostEqual(stats.fps, 30, delta=1)
+            video = cv2.VideoCapture(path)
+            self.assertEqual(int(video.get(cv2.CAP_PROP_FRAME_COUNT)), 60)
+            video.release()
+
+    def test_camera_at_the_frame_rate_is_not_thinned(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = camera.VideoRecorder(os.path.join(directory, "video.avi"), fps=30, queue_size=100)
+            rng = np.random.default_rng(0)
+            for i in range(60):
+                recorder.offer(frame(i), timestamp=i / 30 + rng.uniform(-0.002, 0.002))
+            self.assertEqual(recorder.stop().frames, 60)
+
+    def test_frames_are_dropped_when_the_queue_is_full(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = camera.VideoRecorder(os.path.join(directory, "video.avi"), fps=30, queue_size=2)
+            for i in range(200):
+                recorder.offer(frame(i), timestamp=i)
+            stats = recorder.stop()
+            self.assertGreater(stats.dropped, 0)
+            self.assertEqual(stats.frames + stats.dropped, 200)
+
+    def test_frame_size_changes_are_resized(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = camera.VideoRecorder(os.path.join(directory, "video.avi"), fps=30)
+            recorder.offer(frame(0), timestamp=0)
+            recorder.offer(np.zeros((96, 128, 3), dtype=np.uint8), timestamp=1)
+            self.assertEqual(recorder.stop().frames, 2)
+
+
+class CameraVideoTest(unittest.TestCase):
+    def test_recording(self):
+        cam = camera_synthetic.SyntheticCamera(
+            camera_synthetic.synthetic_wafer(1024, spots=10), resolution=(160, 120), fps=100)
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = cam.start_video(os.path.join(directory, "video.avi"), fps=50)
+            with self.assertRaises(RuntimeError):
+                cam.start_video(os.path.join(directory, "other.avi"))
+            time.sleep(0.3)
+            self.assertTrue(recorder.running)
+            stats = cam.stop_video()
+            self.assertGreater(stats.frames, 5)
+            self.assertLessEqual(stats.fps, 55)
+            self.assertIsNone(cam.stop_video())
+
+
+class FrameGrabberTapTest(unittest.TestCase):
+    def test_tap_gets_every_frame(self):
+        numbers = []
+
+        def read(out=None):
+            time.sleep(0.002)
+            out = np.empty((4, 6), dtype=np.uint8) if out is None else out
+            out.fill(len(numbers) % 256)
+            return out
+
+        grabber = camera.FrameGrabber(read)
+        grabber.tap = lambda img, timestamp: numbers.append(int(img[0, 0]))
+        with grabber:
+            time.sleep(0.05)
+        self.assertGreater(len(numbers), 5)
+        self.assertEqual(numbers, list(range(len(numbers))))
+
+
+if __name__ == "__main__":
+    unittest.main()